@@ -0,0 +1,259 @@
+"""
+Benchmark the metamage_quick subworkflows on synthetic metagenomes.
+
+    PYTHONPATH=. python benchmarks/run_benchmarks.py --scales 1M 10M --standin
+    PYTHONPATH=. python benchmarks/run_benchmarks.py --compare old.json new.json
+
+For each scale (read pairs; 1M, 10M and 100M by default) a synthetic
+community with skewed abundances and host contamination is generated, and
+assembly_wf, binning_wf (once per read mapper), kaiju_wf and functional_wf
+are run with the local executor. Throughput, peak memory and disk use of every subworkflow are
+written to a JSON file tagged with the current commit.
+"""
+
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import synthetic
+from latch.types import LatchFile
+
+from wf import local
+from wf.types import ProdigalOutput, ReadMapper, Sample, TaxonRank, fARGeneModel
+
+SCALES = {"1M": 1_000_000, "10M": 10_000_000, "100M": 100_000_000}
+
+
+def parse_scale(scale: str) -> int:
+    if scale in SCALES:
+        return SCALES[scale]
+    multiplier = {"k": 1_000, "M": 1_000_000}.get(scale[-1], 1)
+    return int(float(scale.rstrip("kM")) * multiplier)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def disk_usage(paths: List[Path]) -> int:
+    return sum(
+        f.stat().st_size for path in paths if path.exists() for f in path.rglob("*") if f.is_file()
+    )
+
+
+def measure(
+    name: str,
+    read_pairs: int,
+    ex: local.LocalExecutor,
+    tasks: List[str],
+    fn: Callable[[], List[Any]],
+) -> Tuple[Dict[str, Any], List[Any]]:
+    start = time.monotonic()
+    results = fn()
+    wall_time = time.monotonic() - start
+
+    tools = [
+        tool for result in results for metrics in result.metrics for tool in metrics.tools
+    ]
+    return {
+        "subworkflow": name,
+        "wall_time": round(wall_time, 3),
+        "read_pairs_per_second": round(read_pairs / wall_time, 1),
+        "tool_cpu_time": round(sum(t.cpu_time for t in tools), 3),
+        "peak_rss_kb": max((t.max_rss_kb for t in tools), default=0),
+        "disk_bytes": disk_usage([ex.workdir.joinpath(task) for task in tasks]),
+    }, results
+
+
+def run_scale(
+    scale: str,
+    args: argparse.Namespace,
+    refs: Dict[str, LatchFile],
+) -> Dict[str, Any]:
+    read_pairs = parse_scale(scale)
+    scale_dir = args.workdir.joinpath(scale)
+    if scale_dir.exists():
+        shutil.rmtree(scale_dir)
+
+    community = synthetic.make_community(args.abundance_skew, args.host_fraction)
+    start = time.monotonic()
+    read1, read2 = synthetic.write_metagenome(
+        scale_dir.joinpath("reads"), f"synthetic_{scale}", read_pairs, community
+    )
+    generation_time = time.monotonic() - start
+    input_bytes = read1.stat().st_size + read2.stat().st_size
+
+    samples = [
+        Sample(
+            sample_name=f"synthetic_{scale}",
+            read1=LatchFile(str(read1)),
+            read2=LatchFile(str(read2)),
+        )
+    ]
+
+    subworkflows = []
+    with local.LocalExecutor(scale_dir.joinpath("work"), args.workers) as ex:
+        stats, assembly = measure(
+            "assembly_wf",
+            read_pairs,
+            ex,
+            ["megahit", "evaluate_assembly"],
+            lambda: local.assembly_wf(ex, samples, 2, 21, 141, 12, 200),
+        )
+        subworkflows.append(stats)
+
+        binning_tasks = ["map_reads", "summarize_contig_depths", "metabat2"]
+        for mapper in ReadMapper:
+            # Start from empty task directories so each mapper's disk use
+            # is its own
+            for task in binning_tasks:
+                shutil.rmtree(ex.workdir.joinpath(task), ignore_errors=True)
+            stats, _ = measure(
+                f"binning_wf[{mapper.value}]",
+                read_pairs,
+                ex,
+                binning_tasks,
+                lambda: local.binning_wf(ex, samples, assembly, mapper),
+            )
+            subworkflows.append(stats)
+
+        stats, _ = measure(
+            "kaiju_wf",
+            read_pairs,
+            ex,
+            [
+                "split_kaiju_reads",
+                "taxonomy_classification_task",
+                "merge_kaiju_chunks",
+                "kaiju2table_task",
+            ],
+            lambda: local.kaiju_wf(
+                ex,
+                samples,
+                refs["db"],
+                refs["nodes"],
+                refs["names"],
+                TaxonRank.species,
+            ),
+        )
+        subworkflows.append(stats)
+
+        stats, _ = measure(
+            "functional_wf",
+            read_pairs,
+            ex,
+            ["prodigal", "macrel", "fargene", "gecco"],
+            lambda: local.functional_wf(
+                ex, assembly, ProdigalOutput.gff, [fARGeneModel.class_a]
+            ),
+        )
+        subworkflows.append(stats)
+
+    if not args.keep:
+        shutil.rmtree(scale_dir)
+
+    return {
+        "scale": scale,
+        "read_pairs": read_pairs,
+        "input_bytes": input_bytes,
+        "generation_seconds": round(generation_time, 3),
+        "subworkflows": subworkflows,
+    }
+
+
+def compare(old_path: Path, new_path: Path) -> str:
+    old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+    baseline = {
+        (s["scale"], w["subworkflow"]): w for s in old["scales"] for w in s["subworkflows"]
+    }
+
+    lines = [f"{old.get('commit')} -> {new.get('commit')}"]
+    lines.append("scale\tsubworkflow\twall_time\tpeak_rss_kb\tdisk_bytes")
+    for s in new["scales"]:
+        for w in s["subworkflows"]:
+            before = baseline.get((s["scale"], w["subworkflow"]))
+            if before is None:
+                continue
+            cells = [
+                f"{w[k] / before[k]:.2f}x" if before[k] else "n/a"
+                for k in ("wall_time", "peak_rss_kb", "disk_bytes")
+            ]
+            lines.append("\t".join([s["scale"], w["subworkflow"], *cells]))
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", nargs="+", default=list(SCALES))
+    parser.add_argument("--abundance-skew", type=float, default=1.0)
+    parser.add_argument("--host-fraction", type=float, default=0.1)
+    parser.add_argument("--workdir", type=Path, default=Path("bench_work"))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", type=Path, default=Path("bench_results.json"))
+    parser.add_argument("--keep", action="store_true", help="Keep generated data")
+    parser.add_argument("--standin", action="store_true")
+    parser.add_argument("--standin-profile", type=Path, default=None)
+    parser.add_argument("--kaiju-ref-db", type=Path)
+    parser.add_argument("--kaiju-ref-nodes", type=Path)
+    parser.add_argument("--kaiju-ref-names", type=Path)
+    parser.add_argument("--compare", type=Path, nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(*args.compare))
+        return 0
+
+    standin = bool(args.standin or args.standin_profile)
+    if standin:
+        local.use_standins(args.standin_profile)
+    else:
+        missing = [
+            f"--kaiju-ref-{key}"
+            for key in ("db", "nodes", "names")
+            if getattr(args, f"kaiju_ref_{key}") is None
+        ]
+        if missing:
+            parser.error(f"{', '.join(missing)} required without --standin")
+
+    args.workdir = args.workdir.resolve()
+    refs = {}
+    for key in ("db", "nodes", "names"):
+        path = getattr(args, f"kaiju_ref_{key}")
+        if path is None:
+            # Only reached with stand-ins, which never read the index
+            path = args.workdir.joinpath(f"placeholder_kaiju.{key}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("placeholder\n")
+        refs[key] = LatchFile(str(path.resolve()))
+
+    results = {
+        "commit": git_commit(),
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "standin": standin,
+        "abundance_skew": args.abundance_skew,
+        "host_fraction": args.host_fraction,
+        "scales": [run_scale(scale, args, refs) for scale in args.scales],
+    }
+
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
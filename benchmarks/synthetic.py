@@ -0,0 +1,189 @@
+"""
+Synthetic paired-end metagenomes for benchmarking.
+
+Reference genomes are generated deterministically from fixed seeds (so
+nothing large has to live in the repository) with distinct GC contents,
+plus a low-GC, repeat-rich "host" genome for contamination. Reads are
+sampled from them in vectorized batches: fragment start and insert size
+are drawn per pair, read 2 is the reverse complement of the fragment end,
+and substitution errors are sprinkled at a fixed rate.
+"""
+
+import gzip
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+READ_LENGTH = 150
+INSERT_MEAN = 350
+INSERT_SD = 40
+ERROR_RATE = 0.002
+BATCH_PAIRS = 100_000
+
+# (name, length, GC fraction) of the bundled community members
+REFERENCES: List[Tuple[str, int, float]] = [
+    ("bacteroides_like", 600_000, 0.43),
+    ("escherichia_like", 550_000, 0.51),
+    ("faecalibacterium_like", 400_000, 0.56),
+    ("bifidobacterium_like", 350_000, 0.60),
+    ("akkermansia_like", 300_000, 0.55),
+    ("clostridium_like", 450_000, 0.29),
+    ("streptococcus_like", 250_000, 0.39),
+    ("phage_like", 50_000, 0.47),
+]
+HOST = ("host_like", 2_000_000, 0.40)
+
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+_COMPLEMENT = np.zeros(256, dtype=np.uint8)
+_COMPLEMENT[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.frombuffer(
+    b"TGCA", dtype=np.uint8
+)
+
+
+@dataclass
+class Community:
+    abundance_skew: float = 1.0
+    host_fraction: float = 0.1
+    seed: int = 0
+    genomes: List[np.ndarray] = field(default_factory=list)
+    weights: np.ndarray = None
+    names: List[str] = field(default_factory=list)
+
+
+def make_genome(length: int, gc: float, seed: int, repeats: bool = False) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    p = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+    genome = _BASES[rng.choice(4, size=length, p=p)]
+
+    if repeats:
+        # Tile a few short elements across the genome, like host repeats
+        element = genome[:300].copy()
+        for start in rng.integers(0, length - 300, size=length // 2000):
+            genome[start : start + 300] = element
+    return genome
+
+
+def make_community(
+    abundance_skew: float = 1.0, host_fraction: float = 0.1, seed: int = 0
+) -> Community:
+    """Reference genomes with log-normal abundances of spread ``abundance_skew``"""
+    rng = np.random.default_rng(seed)
+    genomes = [
+        make_genome(length, gc, seed=1000 + i)
+        for i, (_, length, gc) in enumerate(REFERENCES)
+    ]
+    abundance = rng.lognormal(0.0, abundance_skew, size=len(genomes))
+    # Read share is proportional to abundance times genome length
+    share = abundance * np.array([len(g) for g in genomes])
+    share = share / share.sum() * (1 - host_fraction)
+
+    names = [name for name, _, _ in REFERENCES]
+    if host_fraction > 0:
+        genomes.append(make_genome(HOST[1], HOST[2], seed=999, repeats=True))
+        share = np.append(share, host_fraction)
+        names.append(HOST[0])
+
+    return Community(
+        abundance_skew=abundance_skew,
+        host_fraction=host_fraction,
+        seed=seed,
+        genomes=genomes,
+        weights=share,
+        names=names,
+    )
+
+
+def _records(prefix: bytes, ids: np.ndarray, mate: int, seqs: np.ndarray, quals: np.ndarray) -> bytes:
+    """Fixed-width FASTQ records for a batch, built as one byte matrix"""
+    n = len(ids)
+    id_width = 12
+    header = f"@{prefix.decode()}.".encode()
+    mate_suffix = f"/{mate}\n".encode()
+
+    digits = np.char.zfill(ids.astype(str), id_width).astype(f"S{id_width}")
+    digit_bytes = np.frombuffer(digits.tobytes(), dtype=np.uint8).reshape(n, id_width)
+
+    parts = [
+        np.broadcast_to(np.frombuffer(header, dtype=np.uint8), (n, len(header))),
+        digit_bytes,
+        np.broadcast_to(np.frombuffer(mate_suffix, dtype=np.uint8), (n, len(mate_suffix))),
+        seqs,
+        np.broadcast_to(np.frombuffer(b"\n+\n", dtype=np.uint8), (n, 3)),
+        quals,
+        np.broadcast_to(np.frombuffer(b"\n", dtype=np.uint8), (n, 1)),
+    ]
+    return np.concatenate(parts, axis=1).tobytes()
+
+
+def _batch(
+    community: Community, rng: np.random.Generator, n: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    source = rng.choice(len(community.genomes), size=n, p=community.weights)
+    inserts = np.clip(
+        rng.normal(INSERT_MEAN, INSERT_SD, size=n).astype(np.int64),
+        READ_LENGTH,
+        None,
+    )
+    offsets = np.arange(READ_LENGTH)
+
+    read1 = np.empty((n, READ_LENGTH), dtype=np.uint8)
+    read2 = np.empty((n, READ_LENGTH), dtype=np.uint8)
+    for g, genome in enumerate(community.genomes):
+        idx = np.nonzero(source == g)[0]
+        if len(idx) == 0:
+            continue
+        starts = rng.integers(0, len(genome) - inserts[idx])
+        read1[idx] = genome[starts[:, None] + offsets]
+        ends = starts + inserts[idx]
+        read2[idx] = _COMPLEMENT[genome[ends[:, None] - 1 - offsets]]
+
+    for reads in (read1, read2):
+        errors = rng.random(reads.shape) < ERROR_RATE
+        reads[errors] = _BASES[rng.integers(0, 4, size=errors.sum())]
+
+    return read1, read2
+
+
+def write_metagenome(
+    out_dir: Path,
+    sample_name: str,
+    read_pairs: int,
+    community: Community,
+    compresslevel: int = 1,
+) -> Tuple[Path, Path]:
+    """Write ``{sample_name}_1.fastq.gz`` and ``_2.fastq.gz`` with ``read_pairs`` pairs"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = (
+        out_dir.joinpath(f"{sample_name}_1.fastq.gz"),
+        out_dir.joinpath(f"{sample_name}_2.fastq.gz"),
+    )
+    rng = np.random.default_rng(community.seed + 1)
+    prefix = sample_name.encode()
+
+    with gzip.open(paths[0], "wb", compresslevel=compresslevel) as r1, gzip.open(
+        paths[1], "wb", compresslevel=compresslevel
+    ) as r2:
+        for start in range(0, read_pairs, BATCH_PAIRS):
+            n = min(BATCH_PAIRS, read_pairs - start)
+            ids = np.arange(start, start + n)
+            seq1, seq2 = _batch(community, rng, n)
+            quals = (rng.integers(30, 41, size=(n, READ_LENGTH)) + 33).astype(np.uint8)
+
+            r1.write(_records(prefix, ids, 1, seq1, quals))
+            r2.write(_records(prefix, ids, 2, seq2, quals[:, ::-1]))
+
+    return paths
+
+
+def write_references(out_dir: Path, community: Community) -> Path:
+    """The community genomes as FASTA, e.g. to build a matching Kaiju index"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    path = out_dir.joinpath("references.fa")
+    with open(path, "wb") as f:
+        for name, genome in zip(community.names, community.genomes):
+            f.write(f">{name}\n".encode())
+            for i in range(0, len(genome), 80):
+                f.write(genome[i : i + 80].tobytes() + b"\n")
+    return path
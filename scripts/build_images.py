@@ -0,0 +1,51 @@
+"""
+Build and push the per-stage task images.
+
+    python scripts/build_images.py 812206152185.dkr.ecr.us-west-2.amazonaws.com
+    METAMAGE_IMAGE_REGISTRY=812206152185.dkr.ecr.us-west-2.amazonaws.com latch register .
+
+Each image is built from docker/{stage}.Dockerfile with the repository as
+its context and tagged with the workflow version, see wf/images.py.
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+from wf.images import DOCKER_DIR, STAGES, image_name
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("registry")
+    parser.add_argument("--stage", choices=STAGES, action="append")
+    parser.add_argument("--no-push", action="store_true")
+    args = parser.parse_args()
+
+    for stage in args.stage or STAGES:
+        image = image_name(args.registry, stage)
+        subprocess.run(
+            [
+                "docker",
+                "build",
+                "-f",
+                str(DOCKER_DIR.joinpath(f"{stage}.Dockerfile")),
+                "--build-arg",
+                f"tag={image}",
+                "-t",
+                image,
+                str(ROOT),
+            ],
+            check=True,
+        )
+        if not args.no_push:
+            subprocess.run(["docker", "push", image], check=True)
+        print(image)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
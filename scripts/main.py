@@ -26,7 +26,7 @@ wf.metamage_quick(
     kaiju_ref_names=LatchFile("s3://latch-public/test-data/4318/virus_names.dmp"),
     taxon_rank=TaxonRank.species,
     prodigal_output_format=ProdigalOutput.gff,
-    fargene_hmm_model=fARGeneModel.class_b_1_2,
+    fargene_hmm_models=[fARGeneModel.class_b_1_2],
 )
 
 # wf.kaiju.kaiju_wf(
@@ -65,12 +65,22 @@ wf.metamage_quick(
 #         AssemblyOut(
 #             sample_name="SRR579291",
 #             assembly_data=LatchFile("latch:///metamage/SRR579291/SRR579291.contigs.fa"),
+#             contig_store=LatchFile("latch:///metamage/SRR579291/SRR579291.contigs.fa.gz"),
+#             contig_index=LatchFile("latch:///metamage/SRR579291/SRR579291.contigs.fa.gz.fai"),
+#             contig_block_index=LatchFile("latch:///metamage/SRR579291/SRR579291.contigs.fa.gz.gzi"),
+#             contig_tiers=[],
 #             evaluation=LatchDir("latch:///metamage/SRR579291/SRR579291_MetaQuast"),
+#             metrics=[],
 #         ),
 #         AssemblyOut(
 #             sample_name="SRR579292",
 #             assembly_data=LatchFile("latch:///metamage/SRR579292/SRR579292.contigs.fa"),
+#             contig_store=LatchFile("latch:///metamage/SRR579292/SRR579292.contigs.fa.gz"),
+#             contig_index=LatchFile("latch:///metamage/SRR579292/SRR579292.contigs.fa.gz.fai"),
+#             contig_block_index=LatchFile("latch:///metamage/SRR579292/SRR579292.contigs.fa.gz.gzi"),
+#             contig_tiers=[],
 #             evaluation=LatchDir("latch:///metamage/SRR579292/SRR579292_MetaQuast"),
+#             metrics=[],
 #         ),
 #     ],
 # )
@@ -0,0 +1,64 @@
+"""
+Keep a local history of metamage-quick run reports and check new runs
+against it.
+
+    python scripts/perf_history.py record run_report.json
+    python scripts/perf_history.py compare run_report.json --tolerance 0.3
+
+``compare`` exits with status 1 when a stage got slower or more
+memory-hungry than expected for its input size.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from wf.history import DEFAULT_DB, PerfHistory, format_regressions, load_report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--db", type=Path, default=DEFAULT_DB)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="Add run reports to the history")
+    record.add_argument("reports", type=Path, nargs="+")
+
+    compare = commands.add_parser(
+        "compare", help="Flag regressions of a run against the history"
+    )
+    compare.add_argument("report", type=Path)
+    compare.add_argument("--tolerance", type=float, default=0.25)
+    compare.add_argument("--min-runs", type=int, default=3)
+    compare.add_argument(
+        "--record",
+        action="store_true",
+        help="Also add the run to the history after comparing",
+    )
+
+    args = parser.parse_args()
+
+    with PerfHistory(args.db) as history:
+        if args.command == "record":
+            for path in args.reports:
+                added = history.record(load_report(path), source=str(path))
+                print(f"{path}: {added} measurements recorded")
+            return 0
+
+        report = load_report(args.report)
+        regressions = history.compare(
+            report, tolerance=args.tolerance, min_runs=args.min_runs
+        )
+        if args.record:
+            history.record(report, source=str(args.report))
+
+        if regressions:
+            print(format_regressions(regressions))
+            return 1
+
+        print("No regressions found")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Dry-run planner for a metamage_quick batch.
+
+    python scripts/plan_run.py samples.csv --kaiju-db kaiju_db_nr.fmi
+
+The sample sheet is a CSV/TSV (or a JSON list) with sample_name, read1 and
+read2 columns pointing at local or file:// FASTQ files. Estimates are
+calibrated from the performance history when one is available.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from wf.history import DEFAULT_DB, PerfHistory
+from wf.planner import (
+    CHUNK_READS,
+    SCATTER_MIN_READS,
+    calibrate,
+    estimate,
+    format_plan,
+    plan_sample,
+    read_sample_sheet,
+)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("samples", type=Path)
+    db = parser.add_mutually_exclusive_group(required=True)
+    db.add_argument("--kaiju-db", type=Path, help="Kaiju .fmi index")
+    db.add_argument("--kaiju-db-bytes", type=float, help="Size of the Kaiju index")
+    parser.add_argument("--history", type=Path, default=DEFAULT_DB)
+    parser.add_argument(
+        "--kaiju-scatter-min-reads", type=int, default=SCATTER_MIN_READS
+    )
+    parser.add_argument("--kaiju-chunk-reads", type=int, default=CHUNK_READS)
+    args = parser.parse_args()
+
+    db_bytes = (
+        args.kaiju_db.stat().st_size if args.kaiju_db else args.kaiju_db_bytes
+    )
+    samples = [plan_sample(name, reads) for name, reads in read_sample_sheet(args.samples)]
+
+    if args.history.exists():
+        with PerfHistory(args.history) as history:
+            models = calibrate(history)
+    else:
+        models = calibrate(None)
+
+    estimates = estimate(
+        samples,
+        models,
+        db_bytes,
+        scatter_min_reads=args.kaiju_scatter_min_reads,
+        chunk_reads=args.kaiju_chunk_reads,
+    )
+    print(format_plan(samples, estimates, models))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Run metamage_quick locally on a process pool.
+
+    python scripts/run_local.py samples.csv \
+        --kaiju-ref-db file:///data/kaiju_db.fmi \
+        --kaiju-ref-nodes file:///data/nodes.dmp \
+        --kaiju-ref-names file:///data/names.dmp \
+        --standin --standin-profile profile.json
+
+The sample sheet is a CSV/TSV (or a JSON list) with sample_name, read1 and
+read2 columns pointing at local or file:// FASTQ files. With --standin,
+every tool is replaced by scripts/standin_tool.py, so the workflow layer
+can be benchmarked without the toolchain.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from latch.types import LatchFile
+
+from wf import local
+from wf.planner import read_sample_sheet
+from wf.types import ReadMapper, Sample, TaxonRank, fARGeneModel
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("samples", type=Path)
+    parser.add_argument("--kaiju-ref-db", required=True)
+    parser.add_argument("--kaiju-ref-nodes", required=True)
+    parser.add_argument("--kaiju-ref-names", required=True)
+    parser.add_argument(
+        "--taxon-rank", type=TaxonRank, default=TaxonRank.species
+    )
+    parser.add_argument("--kaiju-scatter-min-reads", type=int, default=None)
+    parser.add_argument("--kaiju-chunk-reads", type=int, default=None)
+    parser.add_argument("--compact-kaiju-output", action="store_true")
+    parser.add_argument(
+        "--read-mapper", type=ReadMapper, default=ReadMapper.bowtie2
+    )
+    parser.add_argument(
+        "--fargene-model", type=fARGeneModel, action="append", default=None
+    )
+    parser.add_argument("--fargene-all-models", action="store_true")
+    parser.add_argument("--share-gene-calls", action="store_true")
+    parser.add_argument("--colocate-functional-tools", action="store_true")
+    parser.add_argument("--preview", action="store_true")
+    parser.add_argument("--preview-read-pairs", type=int, default=None)
+    parser.add_argument("--workdir", type=Path, default=Path("metamage_local"))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--standin", action="store_true")
+    parser.add_argument("--standin-profile", type=Path, default=None)
+    args = parser.parse_args()
+
+    if args.standin or args.standin_profile:
+        local.use_standins(args.standin_profile)
+
+    samples = [
+        Sample(
+            sample_name=name,
+            read1=LatchFile(str(read1.resolve())),
+            read2=LatchFile(str(read2.resolve())),
+        )
+        for name, (read1, read2) in read_sample_sheet(args.samples)
+    ]
+
+    def ref(path: str) -> LatchFile:
+        return LatchFile(str(Path(local.local_file(path)).resolve()))
+
+    start = time.monotonic()
+    with local.LocalExecutor(args.workdir, args.workers) as ex:
+        results = local.metamage_quick(
+            ex,
+            samples=samples,
+            kaiju_ref_db=ref(args.kaiju_ref_db),
+            kaiju_ref_nodes=ref(args.kaiju_ref_nodes),
+            kaiju_ref_names=ref(args.kaiju_ref_names),
+            taxon_rank=args.taxon_rank,
+            kaiju_scatter_min_reads=args.kaiju_scatter_min_reads,
+            kaiju_chunk_reads=args.kaiju_chunk_reads,
+            compact_kaiju_output=args.compact_kaiju_output,
+            read_mapper=args.read_mapper,
+            fargene_hmm_models=args.fargene_model,
+            fargene_all_models=args.fargene_all_models,
+            share_gene_calls=args.share_gene_calls,
+            colocate_functional_tools=args.colocate_functional_tools,
+            preview=args.preview,
+            preview_read_pairs=args.preview_read_pairs,
+        )
+
+    print(f"Finished in {time.monotonic() - start:.1f} s")
+    print(f"Run report: {results.run_report.path}")
+    print(f"Abundance matrix: {results.abundance_matrix.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
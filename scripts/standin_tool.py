@@ -0,0 +1,334 @@
+"""
+Stand-in for the bioinformatics tools called by the workflow.
+
+    standin_tool.py <tool> [tool arguments...]
+
+Writes small but well-formed versions of the outputs the real tool would
+produce (contigs, SAM/depth files, Kaiju assignments, ...) so the
+workflow layer can be exercised without the toolchain. Timing is tuned
+per tool with a JSON profile named by METAMAGE_STANDIN_PROFILE:
+
+    {"megahit": {"sleep": 2, "cpu": 5, "threads": 4, "per_gib": 60}}
+
+``sleep`` and ``cpu`` are seconds of idle and busy time (``cpu`` is split
+across ``threads`` processes); ``per_gib`` adds that many busy seconds per
+GiB of input files. Only the standard library is used.
+"""
+
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+DEFAULT_PROFILE = {"sleep": 0.0, "cpu": 0.0, "threads": 1, "per_gib": 0.0}
+
+
+def _burn(seconds: float):
+    end = time.process_time() + seconds
+    x = 0
+    while time.process_time() < end:
+        x = (x * 1103515245 + 12345) % 2**31
+
+
+def simulate_load(tool: str, args: List[str]):
+    profile = dict(DEFAULT_PROFILE)
+    profile_path = os.environ.get("METAMAGE_STANDIN_PROFILE")
+    if profile_path:
+        profile.update(json.loads(Path(profile_path).read_text()).get(tool, {}))
+
+    input_gib = sum(os.path.getsize(a) for a in args if os.path.isfile(a)) / 2**30
+    cpu = profile["cpu"] + profile["per_gib"] * input_gib
+    threads = max(int(profile["threads"]), 1)
+
+    time.sleep(profile["sleep"])
+    if cpu > 0:
+        workers = [
+            multiprocessing.Process(target=_burn, args=(cpu / threads,))
+            for _ in range(threads)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+
+def opt(args: List[str], *names: str, default: Optional[str] = None) -> Optional[str]:
+    for i, arg in enumerate(args[:-1]):
+        if arg in names:
+            return args[i + 1]
+    return default
+
+
+def _open(path: str):
+    return gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+
+
+def read_names(path: str, limit: int = 200000) -> List[str]:
+    """Names of the FASTQ reads, or FASTA records, of a file"""
+    names = []
+    with _open(path) as f:
+        fasta = f.read(1) == ">"
+        f.seek(0)
+        for i, line in enumerate(f):
+            if line.startswith(">") if fasta else i % 4 == 0:
+                names.append(line[1:].split()[0].rsplit("/", 1)[0])
+                if len(names) >= limit:
+                    break
+    return names
+
+
+def fasta_records(path: str) -> Dict[str, str]:
+    records: Dict[str, List[str]] = {}
+    name = None
+    with _open(path) as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                records[name] = []
+            elif name is not None:
+                records[name].append(line)
+    return {k: "".join(v) for k, v in records.items()}
+
+
+def write_fasta(path: Path, records: Dict[str, str]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for name, seq in records.items():
+            f.write(f">{name}\n")
+            for i in range(0, len(seq), 60):
+                f.write(seq[i : i + 60] + "\n")
+
+
+def random_seq(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def megahit(args: List[str]):
+    rng = random.Random(0)
+    reads = read_names(opt(args, "-1"))
+    out_dir = Path(opt(args, "--out-dir"))
+    prefix = opt(args, "--out-prefix")
+    min_len = int(opt(args, "--min-contig-len", default="200"))
+
+    n_contigs = max(len(reads) // 50, 5)
+    contigs = {
+        f"k141_{i} flag=1 multi=5.0000 len={length}": random_seq(rng, length)
+        for i, length in enumerate(
+            max(int(rng.lognormvariate(7, 1)), min_len) for _ in range(n_contigs)
+        )
+    }
+    write_fasta(out_dir.joinpath(f"{prefix}.contigs.fa"), contigs)
+
+
+def metaquast(args: List[str]):
+    out_dir = Path(opt(args, "-o"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    lengths = sorted((len(s) for s in fasta_records(args[-1]).values()), reverse=True)
+    out_dir.joinpath("report.tsv").write_text(
+        f"Assembly\t{opt(args, '-l')}\n# contigs\t{len(lengths)}\n"
+        f"Total length\t{sum(lengths)}\n"
+    )
+
+
+def bowtie2_build(args: List[str]):
+    positional = [a for a in args if not a.startswith("-") and a != opt(args, "--threads")]
+    fasta, prefix = positional[0], positional[1]
+    names = list(fasta_records(fasta))
+    lengths = [len(s) for s in fasta_records(fasta).values()]
+    for suffix in ("1", "2", "3", "4", "rev.1", "rev.2"):
+        Path(f"{prefix}.{suffix}.bt2").write_text(
+            "".join(f"{n}\t{l}\n" for n, l in zip(names, lengths))
+        )
+
+
+def bowtie2(args: List[str]):
+    index = Path(f"{opt(args, '-x')}.1.bt2").read_text().splitlines()
+    contigs = [line.split("\t") for line in index]
+    rng = random.Random(1)
+    out = sys.stdout
+    out.write("@HD\tVN:1.0\tSO:unsorted\n")
+    for name, length in contigs:
+        out.write(f"@SQ\tSN:{name}\tLN:{length}\n")
+    for read in read_names(opt(args, "-1")):
+        name, length = rng.choice(contigs)
+        pos = rng.randint(1, max(int(length) - 150, 1))
+        out.write(f"{read}\t99\t{name}\t{pos}\t42\t150M\t=\t{pos}\t150\t*\t*\n")
+
+
+def minimap2(args: List[str]):
+    positional = [a for a in args if not a.startswith("-") and a not in ("sr",)]
+    positional = [a for a in positional if a != opt(args, "-t")]
+    contigs, read1 = positional[0], positional[1]
+    records = fasta_records(contigs)
+    rng = random.Random(1)
+    out = sys.stdout
+    out.write("@HD\tVN:1.0\tSO:unsorted\n")
+    for name, seq in records.items():
+        out.write(f"@SQ\tSN:{name}\tLN:{len(seq)}\n")
+    names = list(records)
+    for read in read_names(read1):
+        name = rng.choice(names)
+        pos = rng.randint(1, max(len(records[name]) - 150, 1))
+        out.write(f"{read}\t99\t{name}\t{pos}\t60\t150M\t=\t{pos}\t150\t*\t*\n")
+
+
+def samtools(args: List[str]):
+    # SAM text passes through unchanged, "BAM" files are SAM as well
+    out_path = opt(args, "-o")
+    data = sys.stdin.read()
+    if out_path:
+        Path(out_path).write_text(data)
+    else:
+        sys.stdout.write(data)
+
+
+def jgi_summarize_bam_contig_depths(args: List[str]):
+    out_path = opt(args, "--outputDepth")
+    contigs = []
+    with open(args[-1]) as f:
+        for line in f:
+            if line.startswith("@SQ"):
+                fields = dict(x.split(":", 1) for x in line.rstrip().split("\t")[1:])
+                contigs.append((fields["SN"], fields["LN"]))
+    with open(out_path, "w") as f:
+        f.write("contigName\tcontigLen\ttotalAvgDepth\tbam\tbam-var\n")
+        for name, length in contigs:
+            f.write(f"{name}\t{length}\t5.0\t5.0\t1.0\n")
+
+
+def metabat2(args: List[str]):
+    prefix = Path(opt(args, "-o"))
+    prefix.parent.mkdir(parents=True, exist_ok=True)
+    records = fasta_records(opt(args, "-i"))
+    bins: Dict[int, Dict[str, str]] = {}
+    with open(prefix, "w") as cls:
+        for i, (name, seq) in enumerate(records.items()):
+            cls.write(f"{name}\t{i % 3 + 1}\n")
+            bins.setdefault(i % 3 + 1, {})[name] = seq
+    for n, members in bins.items():
+        write_fasta(Path(f"{prefix}.{n}.fa"), members)
+
+
+def kaiju(args: List[str]):
+    rng = random.Random(2)
+    out_path = opt(args, "-o")
+    with open(out_path, "w") if out_path else sys.stdout as f:
+        for read in read_names(opt(args, "-i")):
+            if rng.random() < 0.3:
+                f.write(f"U\t{read}\t0\n")
+            else:
+                f.write(f"C\t{read}\t{rng.choice([562, 1280, 1613, 28901])}\n")
+
+
+def kaiju2table(args: List[str]):
+    counts: Dict[str, int] = {}
+    with open(args[-1]) as f:
+        for line in f:
+            status, _, taxid = line.rstrip("\n").split("\t")[:3]
+            counts[taxid if status == "C" else "0"] = (
+                counts.get(taxid if status == "C" else "0", 0) + 1
+            )
+    total = sum(counts.values()) or 1
+    with open(opt(args, "-o"), "w") as f:
+        f.write("file\tpercent\treads\ttaxon_id\ttaxon_name\n")
+        for taxid, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+            name = "unclassified" if taxid == "0" else f"taxon {taxid}"
+            f.write(f"{args[-1]}\t{100 * n / total:.6f}\t{n}\t{taxid}\t{name}\n")
+
+
+def kaiju2krona(args: List[str]):
+    Path(opt(args, "-o")).write_text("1\tBacteria\n")
+
+
+def ktImportText(args: List[str]):
+    Path(opt(args, "-o")).write_text("<html><body>Krona stand-in</body></html>\n")
+
+
+def prodigal(args: List[str]):
+    records = fasta_records(opt(args, "-i"))
+    faa, fna = [], []
+    for name, seq in records.items():
+        for i, start in enumerate(range(0, len(seq) - 300, 900), start=1):
+            gene = f"{name}_{i} # {start + 1} # {start + 300} # 1 # ID=1_{i}"
+            faa.append(f">{gene}\nM{'K' * 99}\n")
+            fna.append(f">{gene}\n{seq[start:start + 300]}\n")
+    Path(opt(args, "-o")).write_text("".join(f"{n}\n" for n in records))
+    Path(opt(args, "-a")).write_text("".join(faa))
+    Path(opt(args, "-d")).write_text("".join(fna))
+    Path(opt(args, "-s")).write_text("")
+
+
+def macrel(args: List[str]):
+    out_dir = Path(opt(args, "--output"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tag = opt(args, "--tag", default="macrel")
+    with gzip.open(out_dir.joinpath(f"{tag}.prediction.gz"), "wt") as f:
+        f.write("# Prediction from macrel stand-in\n")
+        f.write("Access\tSequence\tAMP_family\tis_AMP\tAMP_probability\n")
+
+
+def fargene(args: List[str]):
+    out_dir = Path(opt(args, "-o"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_dir.joinpath("results_summary.txt").write_text(
+        "fARGene stand-in\nNumber of predicted genes: 0\n"
+    )
+
+
+def gecco(args: List[str]):
+    out_dir = Path(opt(args, "-o"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    name = Path(opt(args, "-g")).name.split(".")[0]
+    out_dir.joinpath(f"{name}.clusters.tsv").write_text(
+        "sequence_id\tbgc_id\tstart\tend\taverage_p\tmax_p\ttype\n"
+    )
+
+
+TOOLS = {
+    "megahit": megahit,
+    "metaquast.py": metaquast,
+    "bowtie2-build": bowtie2_build,
+    "bowtie2": bowtie2,
+    "minimap2": minimap2,
+    "samtools": samtools,
+    "jgi_summarize_bam_contig_depths": jgi_summarize_bam_contig_depths,
+    "metabat2": metabat2,
+    "kaiju": kaiju,
+    "kaiju2table": kaiju2table,
+    "kaiju2krona": kaiju2krona,
+    "ktImportText": ktImportText,
+    "prodigal": prodigal,
+    "macrel": macrel,
+    "fargene": fargene,
+    "gecco": gecco,
+}
+
+# Standard utilities the workflow uses to move data around, and its own
+# Python helpers, run for real
+PASSTHROUGH = {"cat", "gzip", "split"}
+
+
+def main() -> int:
+    tool, args = Path(sys.argv[1]).name, sys.argv[2:]
+    if args and args[0] in ("--version", "-v"):
+        print(f"{tool} stand-in 0.0.0")
+        return 0
+    if tool in PASSTHROUGH or tool.startswith("python"):
+        os.execvp(sys.argv[1], sys.argv[1:])
+    if tool not in TOOLS:
+        print(f"standin_tool: no stand-in for {tool}", file=sys.stderr)
+        return 2
+
+    simulate_load(tool, args)
+    TOOLS[tool](args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import zipfile
+from pathlib import Path
+
+import pytest
+from latch.types import LatchFile
+
+from wf import abundance, kaiju_format, taxonomy
+from wf.abundance import MatrixBuilder, ranked_rows
+from wf.kaiju import KaijuTableOut
+from wf.types import TaxonRank
+
+LINEAGE = [
+    (2, 1, "superkingdom", "Bacteria"),
+    (1224, 2, "phylum", "Proteobacteria"),
+    (1236, 1224, "class", "Gammaproteobacteria"),
+    (91347, 1236, "order", "Enterobacterales"),
+    (543, 91347, "family", "Enterobacteriaceae"),
+    (561, 543, "genus", "Escherichia"),
+    (562, 561, "species", "Escherichia coli"),
+]
+
+
+@pytest.fixture
+def dmp_files(tmp_path: Path):
+    nodes = tmp_path.joinpath("nodes.dmp")
+    names = tmp_path.joinpath("names.dmp")
+    rows = [(1, 1, "no rank", "root")] + LINEAGE
+    nodes.write_text("".join(f"{t}\t|\t{p}\t|\t{rank}\t|\n" for t, p, rank, _ in rows))
+    names.write_text(
+        "".join(
+            f"{t}\t|\t{name}\t|\t\t|\tscientific name\t|\n" for t, _, _, name in rows
+        )
+    )
+    return nodes, names
+
+
+@pytest.fixture
+def index(dmp_files, tmp_path: Path):
+    return taxonomy.TaxonomyIndex(
+        taxonomy.build_index(*dmp_files, tmp_path.joinpath("taxonomy.idx"))
+    )
+
+
+def write_counts(path: Path, counts):
+    lines = ["taxon_id\treads"] + [f"{t}\t{n}" for t, n in counts.items()]
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+
+@pytest.fixture
+def tables(tmp_path: Path):
+    return [
+        KaijuTableOut(
+            sample_name=name,
+            kaiju_table=LatchFile(str(tmp_path.joinpath(f"{name}.tsv"))),
+            taxon_counts=LatchFile(
+                str(write_counts(tmp_path.joinpath(f"{name}_taxa.tsv"), counts))
+            ),
+            metrics=[],
+        )
+        for name, counts in [("s1", {0: 3, 562: 10, 561: 4}), ("s2", {562: 7})]
+    ]
+
+
+def test_taxon_counts_of_both_formats(tmp_path: Path):
+    text = tmp_path.joinpath("kaiju.out")
+    text.write_bytes(b"C\tr1\t562\nU\tr2\t0\nC\tr3\t562\nC\tr4\t561\n")
+    compact = tmp_path.joinpath("kaiju.kjc")
+    with open(text, "rb") as f:
+        kaiju_format.encode(f, compact)
+
+    expected = {0: 1, 562: 2, 561: 1}
+    assert kaiju_format.taxon_counts(text) == expected
+    assert kaiju_format.taxon_counts(compact) == expected
+
+
+def test_ranked_rows_roll_up_every_rank(index):
+    rows = ranked_rows({0: 3, 562: 10, 561: 4, 999: 1}, index)
+
+    assert list(rows) == taxonomy.RANKS
+    assert rows["genus"] == [
+        ("NA", "unclassified", 3),
+        (
+            "561",
+            "Bacteria;Proteobacteria;Gammaproteobacteria;Enterobacterales;"
+            "Enterobacteriaceae;Escherichia",
+            10,
+        ),
+        (
+            "561",
+            "Bacteria;Proteobacteria;Gammaproteobacteria;Enterobacterales;"
+            "Enterobacteriaceae;Escherichia",
+            4,
+        ),
+        ("NA", "cannot be assigned to a genus", 1),
+    ]
+    # Reads classified to the genus cannot be assigned to a species
+    assert [row[0] for row in rows["species"]] == ["NA", "562", "NA", "NA"]
+    assert rows["species"][2] == ("NA", "cannot be assigned to a species", 4)
+
+
+def test_matrix_is_sparse_csr(tmp_path: Path):
+    builder = MatrixBuilder()
+    builder.add_sample("s1", [("562", "E. coli", 10), ("1280", "S. aureus", 5)])
+    builder.add_sample("s2", [("1280", "S. aureus", 7), ("562", "E. coli", 0)])
+    out = builder.write(tmp_path, TaxonRank.species)
+
+    assert list(builder.indptr) == [0, 2, 3]
+    assert list(builder.indices) == [0, 1, 1]
+    assert list(builder.data) == [10, 5, 7]
+    with zipfile.ZipFile(out.joinpath("species_counts.npz")) as npz:
+        assert sorted(npz.namelist()) == [
+            "data.npy",
+            "indices.npy",
+            "indptr.npy",
+            "shape.npy",
+        ]
+        assert npz.read("data.npy").startswith(b"\x93NUMPY\x01\x00")
+    assert out.joinpath("species_samples.tsv").read_text().splitlines()[1:] == [
+        "0\ts1",
+        "1\ts2",
+    ]
+
+
+@pytest.mark.parametrize(
+    "preview, root",
+    [
+        (False, "latch:///metamage/abundance_matrix/2"),
+        (True, "latch:///metamage/abundance_matrix/preview/2"),
+    ],
+)
+def test_matrices_for_every_rank(
+    tables, dmp_files, tmp_path, monkeypatch, preview, root
+):
+    monkeypatch.chdir(tmp_path)
+    nodes, names = (LatchFile(str(path)) for path in dmp_files)
+    matrix = abundance.build_abundance_matrix.task_function(
+        tables, nodes, names, preview
+    )
+
+    assert matrix.matrix.remote_path.startswith(root)
+    out = tmp_path.joinpath("abundance_matrix")
+    for rank in TaxonRank:
+        assert out.joinpath(f"{rank.value}_counts.npz").exists()
+    genus_taxa = out.joinpath("genus_taxa.tsv").read_text().splitlines()
+    assert [line.split("\t")[1] for line in genus_taxa[1:]] == ["NA", "561"]
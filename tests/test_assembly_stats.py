@@ -0,0 +1,55 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from wf.assembly_stats import assembly_stats, write_report
+
+
+@pytest.fixture
+def contigs(tmp_path: Path) -> Path:
+    path = tmp_path.joinpath("contigs.fa")
+    wrapped = "\n".join(["ACGT" * 15] * 100)
+    path.write_text(
+        f">k141_1 flag=1\n{wrapped}\n>k141_2\n{'gc' * 1000}\n>k141_3\n{'A' * 500}\n"
+    )
+    return path
+
+
+def test_stats(contigs: Path):
+    stats = assembly_stats(contigs)
+
+    assert stats["contigs"] == 3
+    assert stats["total_length"] == 8500
+    assert stats["largest_contig"] == 6000
+    assert stats["gc_percent"] == round(100 * 5000 / 8500, 2)
+    assert (stats["N50"], stats["L50"]) == (6000, 1)
+    assert (stats["N75"], stats["L75"]) == (2000, 2)
+    assert (stats["N90"], stats["L90"]) == (2000, 2)
+    assert stats["contigs_ge_1000"] == 2
+    assert stats["total_length_ge_1000"] == 8000
+    assert stats["contigs_ge_0"] == 3
+    assert stats["length_histogram"][">=500"] == 1
+    assert stats["length_histogram"][">=5000"] == 1
+    assert stats["gc_histogram"]["0-5"] == 1
+    assert stats["gc_histogram"]["50-55"] == 1
+    assert stats["gc_histogram"]["100-105"] == 1
+
+
+def test_empty_assembly(tmp_path: Path):
+    path = tmp_path.joinpath("empty.fa")
+    path.write_text("")
+    stats = assembly_stats(path)
+    assert stats["contigs"] == stats["N50"] == stats["L50"] == 0
+    assert stats["gc_percent"] == 0.0
+
+
+def test_report(contigs: Path, tmp_path: Path):
+    out = write_report(assembly_stats(contigs), "s1", tmp_path.joinpath("stats"))
+
+    report = json.loads(out.joinpath("report.json").read_text())
+    assert report["assembly"] == "s1"
+    lines = out.joinpath("report.tsv").read_text().splitlines()
+    assert lines[0] == "Assembly\ts1"
+    assert "contigs\t3" in lines
+    assert "length_histogram >=5000\t1" in lines
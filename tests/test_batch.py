@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+from wf import local
+from wf.batch import (
+    OOM_MARKERS_ENV,
+    by_sample,
+    failed_inputs,
+    out_of_memory_inputs,
+    records_out_of_memory,
+)
+from wf.runner import OutOfMemoryError, ToolError
+
+
+@dataclass
+class Element:
+    sample_name: str
+
+
+@records_out_of_memory()
+def runs_out(element: Element) -> str:
+    if element.sample_name == "oom":
+        raise OutOfMemoryError("megahit", "was killed for running out of memory")
+    if element.sample_name == "broken":
+        raise ToolError("megahit", "exited with status 1")
+    return element.sample_name
+
+
+def test_failed_inputs():
+    inputs = [Element("a"), Element("b"), Element("c")]
+    results = [Element("a"), None, Element("c")]
+    assert failed_inputs(inputs, results) == [Element("b")]
+    assert sorted(by_sample(results)) == ["a", "c"]
+
+
+def test_marker_left_on_out_of_memory(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(OOM_MARKERS_ENV, str(tmp_path))
+    assert runs_out.__name__ == "runs_out"
+    assert runs_out(Element("ok")) == "ok"
+    with pytest.raises(OutOfMemoryError):
+        runs_out(element=Element("oom"))
+    with pytest.raises(ToolError):
+        runs_out(Element("broken"))
+
+    assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == ["oom"]
+
+
+def test_only_out_of_memory_is_retried(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(OOM_MARKERS_ENV, "")
+    monkeypatch.setattr(local, "MIN_SUCCESS_RATIO", 0.3)
+    inputs = [Element("ok"), Element("oom"), Element("broken")]
+    with local.LocalExecutor(tmp_path, max_workers=2) as ex:
+        results = ex.map(runs_out, element=inputs)
+        assert results == ["ok", None, None]
+        assert out_of_memory_inputs(runs_out, inputs, results) == [Element("oom")]
+
+
+def test_markers_do_not_outlive_the_executor_run(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(OOM_MARKERS_ENV, "")
+    monkeypatch.setattr(local, "MIN_SUCCESS_RATIO", 0.0)
+    with local.LocalExecutor(tmp_path, max_workers=1) as ex:
+        ex.map(runs_out, element=[Element("oom")])
+    with local.LocalExecutor(tmp_path, max_workers=1):
+        # A later run that fails for another reason is not retried
+        assert out_of_memory_inputs(runs_out, [Element("oom")], [None]) == []
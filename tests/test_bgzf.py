@@ -0,0 +1,56 @@
+import gzip
+import random
+import struct
+import zlib
+from pathlib import Path
+
+from wf import bgzf
+
+
+def compress(data: bytes, path: Path):
+    with open(path, "wb") as f:
+        writer = bgzf.BgzfWriter(f, threads=2)
+        # Uneven writes, so blocks are cut across them
+        for i in range(0, len(data), 7919):
+            writer.write(data[i : i + 7919])
+        return writer.close()
+
+
+def test_round_trip(tmp_path: Path):
+    rng = random.Random(0)
+    data = bytes(rng.choice(b"ACGT\n") for _ in range(300_000))
+    path = tmp_path.joinpath("data.gz")
+    blocks = compress(data, path)
+
+    assert gzip.decompress(path.read_bytes()) == data
+    assert len(blocks) == -(-len(data) // bgzf.BLOCK_DATA_BYTES)
+
+
+def test_blocks_start_where_indexed(tmp_path: Path):
+    data = bytes(range(256)) * 1000
+    path = tmp_path.joinpath("data.gz")
+    blocks = compress(data, path)
+    raw = path.read_bytes()
+
+    for compressed, uncompressed in blocks:
+        assert raw[compressed : compressed + 4] == b"\x1f\x8b\x08\x04"
+        rest = zlib.decompressobj(31).decompress(raw[compressed:])
+        assert data[uncompressed:].startswith(rest)
+    assert raw.endswith(bgzf._EOF_BLOCK)
+
+
+def test_empty(tmp_path: Path):
+    path = tmp_path.joinpath("empty.gz")
+    assert compress(b"", path) == []
+    assert gzip.decompress(path.read_bytes()) == b""
+
+
+def test_gzi_layout(tmp_path: Path):
+    blocks = [(0, 0), (100, 65280), (230, 130560)]
+    path = bgzf.write_gzi(blocks, tmp_path.joinpath("data.gz.gzi"))
+    raw = path.read_bytes()
+
+    # bgzip -i leaves out the first block
+    assert struct.unpack_from("<Q", raw) == (2,)
+    assert [struct.unpack_from("<QQ", raw, 8 + 16 * i) for i in range(2)] == blocks[1:]
+    assert len(raw) == 8 + 16 * 2
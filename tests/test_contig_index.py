@@ -0,0 +1,47 @@
+import gzip
+from pathlib import Path
+
+from wf import contig_index
+
+
+def write_assembly(path: Path) -> dict:
+    contigs = {
+        "k141_1": "ACGT" * 30,
+        "k141_2": "GGCC" * 300,
+        "k141_3": "AT" * 1100,
+    }
+    with open(path, "w") as f:
+        for name, seq in contigs.items():
+            f.write(f">{name} flag=1 multi=2.0 len={len(seq)}\n")
+            for i in range(0, len(seq), 60):
+                f.write(seq[i : i + 60] + "\n")
+    return contigs
+
+
+def test_index_and_tiers(tmp_path: Path):
+    fasta = tmp_path.joinpath("s1.contigs.fa")
+    contigs = write_assembly(fasta)
+    files = contig_index.index_and_tiers(fasta, [1000, 2000, 5000], tmp_path / "out")
+
+    assert files.store.name == "s1.contigs.fa.gz"
+    assert gzip.decompress(files.store.read_bytes()) == fasta.read_bytes()
+    assert files.block_index.name == "s1.contigs.fa.gz.gzi"
+
+    # The .fai offsets point at each sequence in the uncompressed FASTA
+    plain = fasta.read_bytes()
+    for line in files.index.read_text().splitlines():
+        name, length, offset, line_bases, line_width = line.split("\t")
+        assert int(length) == len(contigs[name])
+        assert (int(line_bases), int(line_width)) == (60, 61)
+        assert plain[int(offset) : int(offset) + 60].decode() == contigs[name][:60]
+
+    # No contig reaches 5000, so that tier is left out
+    assert sorted(files.tiers) == [1000, 2000]
+    assert files.tiers[1000].name == "s1.contigs.min1000.fa"
+    headers = [
+        line.split()[0][1:]
+        for line in files.tiers[1000].read_text().splitlines()
+        if line.startswith(">")
+    ]
+    assert headers == ["k141_2", "k141_3"]
+    assert ">k141_3 flag=1" in files.tiers[2000].read_text()
@@ -0,0 +1,95 @@
+import builtins
+import os
+import threading
+
+import pytest
+
+from wf import coschedule
+from wf.coschedule import CoScheduler, Job, partition, task_cpus
+
+
+def job(name, weight=1.0, max_cpus=None, mem_kb=0.0, after=()):
+    return Job(
+        name=name,
+        fn=lambda on_start: None,
+        weight=weight,
+        max_cpus=max_cpus,
+        mem_kb=mem_kb,
+        after=list(after),
+    )
+
+
+def test_task_cpus_without_affinity(monkeypatch):
+    monkeypatch.delattr(os, "sched_getaffinity", raising=False)
+    monkeypatch.delattr(os, "sched_setaffinity", raising=False)
+    assert task_cpus() == list(range(os.cpu_count() or 1))
+    # Pinning is skipped rather than failing
+    coschedule._set_affinity([os.getpid()], [0])
+
+
+def test_memory_without_proc(monkeypatch):
+    real_open = builtins.open
+
+    def no_proc(path, *args, **kwargs):
+        if str(path).startswith(("/proc", "/sys")):
+            raise FileNotFoundError(path)
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", no_proc)
+    monkeypatch.setattr(coschedule.Path, "read_text", lambda self: no_proc(self))
+    assert coschedule.available_memory_kb() == float("inf")
+
+
+def test_partition_by_weight():
+    shares = partition(list(range(8)), [job("a", 3.0), job("b", 1.0)])
+    assert len(shares["a"]) + len(shares["b"]) == 8
+    assert len(shares["a"]) > len(shares["b"]) >= 1
+    assert not set(shares["a"]) & set(shares["b"])
+
+
+def test_partition_respects_max_cpus():
+    shares = partition(list(range(8)), [job("a", 1.0, max_cpus=1), job("b", 1.0)])
+    assert len(shares["a"]) == 1
+    assert len(shares["b"]) == 7
+
+
+def test_partition_more_jobs_than_cpus():
+    shares = partition([0, 1], [job(name) for name in "abc"])
+    assert all(len(cpus) == 1 for cpus in shares.values())
+
+
+def test_dependencies_run_in_order():
+    order = []
+    lock = threading.Lock()
+
+    def work(name):
+        def fn(on_start):
+            with lock:
+                order.append(name)
+
+        return fn
+
+    scheduler = CoScheduler(cpus=[0, 1], mem_budget_kb=100)
+    scheduler.add(Job("first", work("first"), 1.0, None, 60))
+    scheduler.add(Job("big", work("big"), 1.0, None, 60, after=["first"]))
+    scheduler.add(Job("last", work("last"), 1.0, None, 10, after=["big"]))
+    scheduler.run()
+
+    assert order == ["first", "big", "last"]
+
+
+def test_failure_is_raised():
+    def fail(on_start):
+        raise RuntimeError("tool failed")
+
+    scheduler = CoScheduler(cpus=[0], mem_budget_kb=100)
+    scheduler.add(Job("bad", fail, 1.0, None, 1))
+    with pytest.raises(RuntimeError, match="tool failed"):
+        scheduler.run()
+
+
+def test_unknown_dependency():
+    scheduler = CoScheduler(cpus=[0], mem_budget_kb=100)
+    scheduler.add(job("a", after=["missing"]))
+    with pytest.raises(ValueError, match="missing"):
+        scheduler.run()
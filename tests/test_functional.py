@@ -0,0 +1,85 @@
+from pathlib import Path
+
+import pytest
+from latch.types import LatchDir, LatchFile
+
+from wf import functional
+from wf.batch import OOM_MARKERS_ENV
+from wf.runner import OutOfMemoryError
+from wf.settings import write_settings
+from wf.types import ProdigalOutput, fARGeneModel
+
+
+@pytest.fixture
+def fargene_cmds(tmp_path: Path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cmds = []
+    monkeypatch.setattr(
+        functional, "run", lambda cmd, outputs=(), on_start=None: cmds.append(cmd)
+    )
+    return cmds
+
+
+@pytest.mark.parametrize(
+    "models",
+    [[fARGeneModel.class_a], [fARGeneModel.class_a, fARGeneModel.qnr]],
+    ids=["one-model", "two-models"],
+)
+def test_fargene_mode_does_not_depend_on_model_count(
+    fargene_cmds, tmp_path: Path, models
+):
+    contigs = tmp_path.joinpath("contigs.fa")
+    contigs.write_text(">k141_1\nACGT\n")
+    functional._run_fargene(contigs, models)
+
+    assert sorted(cmd[cmd.index("--hmm-model") + 1] for cmd in fargene_cmds) == sorted(
+        model.value for model in models
+    )
+    for cmd in fargene_cmds:
+        assert cmd[cmd.index("-i") + 1] == str(contigs)
+        assert "--amino" not in cmd
+
+
+def test_fargene_proteins_are_searched_as_amino(fargene_cmds, tmp_path: Path):
+    proteins = tmp_path.joinpath("s1.faa")
+    proteins.write_text(">k141_1_1\nMK\n")
+    functional._run_fargene(
+        proteins, [fARGeneModel.class_a, fARGeneModel.qnr], amino=True
+    )
+    assert all("--amino" in cmd for cmd in fargene_cmds)
+
+
+def test_shared_gene_call_tools_retry_out_of_memory(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(OOM_MARKERS_ENV, str(tmp_path.joinpath("markers")))
+
+    def runs_out(*args, **kwargs):
+        raise OutOfMemoryError("macrel", "was killed for running out of memory")
+
+    monkeypatch.setattr(functional, "_run_macrel", runs_out)
+    fasta = LatchFile(str(tmp_path.joinpath("s1.fa")))
+    settings = write_settings(
+        functional.FunctionalSettings(
+            prodigal_output_format=ProdigalOutput.gff,
+            fargene_hmm_models=[fARGeneModel.class_a],
+        )
+    )
+    gene_calls_ins = [
+        functional.GeneCallsInput(
+            functional_in=functional.FunctionalInput(
+                sample_name=name,
+                assembly_data=fasta,
+                bgc_assembly_data=fasta,
+                settings=settings,
+            ),
+            gene_calls=LatchDir(str(tmp_path)),
+        )
+        for name in ("s1", "s2")
+    ]
+    with pytest.raises(OutOfMemoryError):
+        functional.macrel_peptides.task_function(gene_calls_ins[0])
+
+    # s2 failed for another reason, only s1 gets a bigger node
+    retried = functional.failed_gene_calls_inputs.task_function(
+        gene_calls_ins, [None, None], "macrel_peptides"
+    )
+    assert retried == gene_calls_ins[:1]
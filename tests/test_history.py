@@ -0,0 +1,49 @@
+from pathlib import Path
+
+from wf.history import PerfHistory
+
+
+def report(run_id: str, wall_times) -> dict:
+    def tool(wall_time: float) -> dict:
+        return {
+            "tool": "megahit",
+            "command": ["megahit", "--k-min", "21", "-o", "/tmp/out"],
+            "input_bytes": 1000,
+            "wall_time": wall_time,
+            "cpu_time": wall_time,
+            "max_rss_kb": 1000,
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "output_bytes": 0,
+        }
+
+    def stage(wall_time: float) -> dict:
+        return {
+            "stage": "megahit",
+            "wall_time": wall_time,
+            "cpu_time": wall_time,
+            "max_rss_kb": 1000,
+            "input_bytes": 1000,
+            "output_bytes": 0,
+            "tools": [tool(wall_time)],
+        }
+
+    return {
+        "generated_at": run_id,
+        "samples": {f"s{i}": [stage(t)] for i, t in enumerate(wall_times)},
+    }
+
+
+def test_baseline_counts_runs_not_samples(tmp_path: Path):
+    slow = report("run-new", [1000.0])
+    with PerfHistory(tmp_path.joinpath("perf.sqlite")) as history:
+        # One earlier run with three samples is still a single run
+        history.record(report("run-1", [100.0, 100.0, 100.0]))
+        assert history.compare(slow, min_runs=3) == []
+
+        history.record(report("run-2", [100.0]))
+        history.record(report("run-3", [100.0]))
+        (regression,) = history.compare(slow, min_runs=3)
+
+    assert regression.metric == "wall_time"
+    assert regression.baseline_runs == 3
@@ -0,0 +1,66 @@
+import math
+from pathlib import Path
+
+import pytest
+
+from wf import hit_table
+
+SCHEMA = [("contig", "str"), ("start", "int"), ("score", "float")]
+ROWS = [("k141_1", 10, 0.5), ("k141_2", hit_table.NO_POSITION, float("nan"))]
+
+
+def test_round_trip(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(hit_table, "BLOCK_ROWS", 1)
+    path = tmp_path.joinpath("s1.fht")
+    assert hit_table.write_table(path, SCHEMA, ROWS) == 2
+
+    assert hit_table.read_schema(path) == SCHEMA
+    assert len(list(hit_table.read_blocks(path))) == 2
+    rows = list(hit_table.read_rows(path))
+    assert rows[0] == ROWS[0]
+    assert rows[1][:2] == ROWS[1][:2] and math.isnan(rows[1][2])
+
+
+def test_selected_columns_in_requested_order(tmp_path: Path):
+    path = tmp_path.joinpath("s1.fht")
+    hit_table.write_table(path, SCHEMA, ROWS)
+    assert list(hit_table.read_rows(path, ["start", "contig"])) == [
+        (10, "k141_1"),
+        (0, "k141_2"),
+    ]
+    with pytest.raises(KeyError, match="model"):
+        list(hit_table.read_rows(path, ["model"]))
+
+
+def test_empty_table_keeps_its_schema(tmp_path: Path):
+    path = tmp_path.joinpath("empty.fht")
+    assert hit_table.write_table(path, SCHEMA, []) == 0
+    assert list(hit_table.read_blocks(path)) == [
+        {"contig": [], "start": [], "score": []}
+    ]
+
+
+def test_unknown_type(tmp_path: Path):
+    with pytest.raises(ValueError, match="bool"):
+        hit_table.write_table(tmp_path.joinpath("t.fht"), [("hit", "bool")], [])
+
+
+def test_scan_reads_only_requested_samples(tmp_path: Path):
+    for sample, contig in (("s1", "a"), ("s2", "b")):
+        tool_dir = tmp_path.joinpath("macrel")
+        tool_dir.mkdir(exist_ok=True)
+        hit_table.write_table(
+            tool_dir.joinpath(f"{sample}{hit_table.SUFFIX}"),
+            [("contig", "str")],
+            [(contig,)],
+        )
+
+    assert list(hit_table.scan(tmp_path, "macrel")) == [("a",), ("b",)]
+    assert list(hit_table.scan(tmp_path, "macrel", samples=["s2", "s3"])) == [("b",)]
+
+
+def test_cat(tmp_path: Path, capsys):
+    path = tmp_path.joinpath("s1.fht")
+    hit_table.write_table(path, SCHEMA, ROWS)
+    assert hit_table.main(["cat", str(path), "contig", "score"]) == 0
+    assert capsys.readouterr().out == "contig\tscore\nk141_1\t0.5\nk141_2\t\n"
@@ -0,0 +1,31 @@
+"""
+Every module imports and every workflow compiles, as on registration
+"""
+
+import compileall
+import importlib
+import pkgutil
+from pathlib import Path
+
+import pytest
+
+import wf
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_workflow_compiles():
+    # Importing the package builds every workflow's graph
+    assert callable(wf.metamage_quick)
+
+
+@pytest.mark.parametrize(
+    "module", sorted(info.name for info in pkgutil.iter_modules(wf.__path__))
+)
+def test_module_imports(module: str):
+    importlib.import_module(f"wf.{module}")
+
+
+@pytest.mark.parametrize("directory", ["scripts", "benchmarks"])
+def test_scripts_compile(directory: str):
+    assert compileall.compile_dir(ROOT.joinpath(directory), quiet=1)
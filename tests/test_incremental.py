@@ -0,0 +1,158 @@
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from latch.types import LatchFile
+
+from wf import incremental
+from wf.incremental import (
+    CohortState,
+    SampleManifest,
+    input_fingerprint,
+    is_up_to_date,
+    params_hash,
+    write_manifests,
+)
+from wf.types import Sample
+
+
+class FakeLPath:
+    """Stands in for latch's LPath, with metadata per remote path"""
+
+    metadata = {}
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch_metadata(self):
+        if self.path not in self.metadata:
+            raise RuntimeError("no such Latch file or directory")
+
+    def size(self):
+        return self.metadata[self.path][0]
+
+    def version_id(self):
+        return self.metadata[self.path][1]
+
+    def modify_time(self):
+        return self.metadata[self.path][2]
+
+
+def remote_sample() -> Sample:
+    return Sample(
+        read1=LatchFile("latch:///reads/s1_1.fq.gz"),
+        read2=LatchFile("latch:///reads/s1_2.fq.gz"),
+        sample_name="s1",
+    )
+
+
+def test_local_fingerprint_follows_size_and_mtime(tmp_path: Path):
+    reads = [tmp_path.joinpath(f"s1_{mate}.fq.gz") for mate in (1, 2)]
+    for path in reads:
+        path.write_bytes(b"reads")
+    sample = Sample(LatchFile(str(reads[0])), LatchFile(str(reads[1])), "s1")
+
+    before = input_fingerprint(sample)
+    assert input_fingerprint(sample) == before
+
+    reads[0].write_bytes(b"other reads")
+    assert input_fingerprint(sample) != before
+
+
+def test_remote_fingerprint_follows_metadata(monkeypatch):
+    monkeypatch.setattr(incremental, "LPath", FakeLPath)
+    modified = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    monkeypatch.setattr(
+        FakeLPath,
+        "metadata",
+        {
+            "latch:///reads/s1_1.fq.gz": (100, "v1", modified),
+            "latch:///reads/s1_2.fq.gz": (100, "v1", modified),
+        },
+    )
+
+    before = input_fingerprint(remote_sample())
+    assert input_fingerprint(remote_sample()) == before
+
+    # Replaced under the same path
+    FakeLPath.metadata["latch:///reads/s1_2.fq.gz"] = (100, "v2", modified)
+    assert input_fingerprint(remote_sample()) != before
+
+
+def test_remote_fingerprint_without_metadata_never_matches(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(incremental, "LPath", FakeLPath)
+    monkeypatch.setattr(FakeLPath, "metadata", {})
+    monkeypatch.setattr(
+        incremental, "message", lambda kind, data: warnings.append(data["title"])
+    )
+    assert input_fingerprint(remote_sample()) != input_fingerprint(remote_sample())
+    assert warnings[0] == "Incremental mode is off for latch:///reads/s1_1.fq.gz"
+
+
+def test_s3_fingerprint_follows_etag(monkeypatch):
+    heads = {
+        key: {"ContentLength": 100, "ETag": '"abc"'}
+        for key in ("reads/s1_1.fq.gz", "reads/s1_2.fq.gz")
+    }
+    monkeypatch.setattr(incremental, "_s3_head", lambda bucket, key: heads[key])
+    sample = Sample(
+        read1=LatchFile("s3://bucket/reads/s1_1.fq.gz"),
+        read2=LatchFile("s3://bucket/reads/s1_2.fq.gz"),
+        sample_name="s1",
+    )
+
+    before = input_fingerprint(sample)
+    assert input_fingerprint(sample) == before
+
+    heads["reads/s1_1.fq.gz"] = {"ContentLength": 100, "ETag": '"def"'}
+    assert input_fingerprint(sample) != before
+
+
+def test_params_hash_ignores_order():
+    assert params_hash({"a": 1, "b": [2, 3]}) == params_hash({"b": [2, 3], "a": 1})
+    assert params_hash({"a": 1}) != params_hash({"a": 2})
+
+
+def test_is_up_to_date(monkeypatch):
+    outputs = {
+        "kaiju2table_outs": "latch:///metamage/s1/s1_kaiju.tsv",
+        "kaiju_taxon_counts": "latch:///metamage/s1/s1_kaiju_taxa.tsv",
+    }
+    existing = set(outputs.values())
+    monkeypatch.setattr(incremental, "_remote_exists", lambda path: path in existing)
+    manifest = SampleManifest(
+        sample_name="s1",
+        input_fingerprint="reads",
+        params_hash="params",
+        outputs=outputs,
+    )
+
+    assert is_up_to_date(manifest, "reads", "params")
+    assert not is_up_to_date(None, "reads", "params")
+    assert not is_up_to_date(manifest, "other reads", "params")
+    assert not is_up_to_date(manifest, "reads", "other params")
+    # Written before the per-taxon counts were recorded
+    older = SampleManifest(
+        "s1", "reads", "params", {"kaiju2table_outs": outputs["kaiju2table_outs"]}
+    )
+    assert not is_up_to_date(older, "reads", "params")
+    existing.clear()
+    assert not is_up_to_date(manifest, "reads", "params")
+
+
+def test_write_manifests_skips_previews(tmp_path: Path):
+    cohort = CohortState(
+        params_hash="params",
+        input_fingerprints={"s1": "reads", "s2.preview": "preview reads"},
+        complete=[],
+    )
+    outputs = {
+        "s1": {"kaiju2table_outs": "latch:///metamage/s1/s1_kaiju.tsv"},
+        "s2.preview": {"kaiju2table_outs": "latch:///metamage/s2/preview/t.tsv"},
+    }
+    (manifest,) = write_manifests(cohort, outputs, tmp_path)
+
+    assert manifest.remote_path == "latch:///metamage/s1/manifest.json"
+    written = SampleManifest.from_json(Path(os.fspath(manifest.path)).read_text())
+    assert written == SampleManifest("s1", "reads", "params", outputs["s1"])
@@ -0,0 +1,43 @@
+from pathlib import Path
+
+from latch.types import LatchFile
+
+from wf import kaiju
+from wf.kaiju import KaijuOut, KaijuSettings
+from wf.runner import STANDIN_ENV
+from wf.settings import write_settings
+from wf.types import TaxonRank
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_krona_tasks_report_metrics(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(STANDIN_ENV, str(ROOT.joinpath("scripts", "standin_tool.py")))
+    monkeypatch.chdir(tmp_path)
+    kaiju_file = tmp_path.joinpath("s1_kaiju.out")
+    kaiju_file.write_text("C\tr1\t562\nU\tr2\t0\n")
+    refs = [tmp_path.joinpath(name) for name in ("db.fmi", "nodes.dmp", "names.dmp")]
+    for ref in refs:
+        ref.touch()
+    settings = write_settings(
+        KaijuSettings(*(str(ref) for ref in refs), taxon_rank=TaxonRank.species)
+    )
+
+    krona_input = kaiju.kaiju2krona_task.task_function(
+        KaijuOut(
+            sample_name="s1",
+            kaiju_out=LatchFile(str(kaiju_file)),
+            settings=settings,
+            metrics=[],
+        )
+    )
+    # The plot task gets the table through its local copy
+    krona_input.krona_txt = LatchFile(str(tmp_path.joinpath("s1_kaiju2krona.out")))
+    krona = kaiju.plot_krona_task.task_function(krona_input)
+
+    assert [m.stage for m in krona.metrics] == ["kaiju2krona", "krona_plot"]
+    assert [[t.tool for t in m.tools] for m in krona.metrics] == [
+        ["kaiju2krona"],
+        ["ktImportText"],
+    ]
+    assert krona.krona_plot.remote_path.endswith("/kaiju/s1_krona.html")
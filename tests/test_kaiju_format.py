@@ -0,0 +1,68 @@
+import io
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from wf import kaiju_format
+
+TEXT = (
+    b"U\tread/1\t0\n"
+    b"C\tread/2\t562\n"
+    b"C\tread/3\t1280\n"
+    b"U\tread/10\t0\n"
+    b"C\tother\t562\n"
+)
+
+
+@pytest.fixture
+def compact(tmp_path: Path) -> Path:
+    path = tmp_path.joinpath("sample.kjc")
+    kaiju_format.encode(io.BytesIO(TEXT), path)
+    return path
+
+
+def test_round_trip(compact: Path):
+    assert kaiju_format.is_compact(compact)
+    out = io.BytesIO()
+    kaiju_format.export(compact, out)
+    assert out.getvalue() == TEXT
+
+
+def test_blocks_split_and_concatenate(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(kaiju_format, "BLOCK_RECORDS", 2)
+    parts = []
+    for i in range(2):
+        part = tmp_path.joinpath(f"part{i}.kjc")
+        kaiju_format.encode(io.BytesIO(TEXT), part)
+        parts.append(part)
+    merged = tmp_path.joinpath("merged.kjc")
+    kaiju_format.concat(parts, merged)
+
+    records = list(kaiju_format.read_records(merged))
+    assert records == 2 * list(kaiju_format.parse_text(io.BytesIO(TEXT)))
+
+
+def test_read_records_of_text(tmp_path: Path):
+    text = tmp_path.joinpath("kaiju.out")
+    text.write_bytes(TEXT)
+    assert not kaiju_format.is_compact(text)
+    assert list(kaiju_format.read_records(text))[:2] == [
+        ("U", b"read/1", 0),
+        ("C", b"read/2", 562),
+    ]
+
+
+def test_truncated_file(compact: Path):
+    compact.write_bytes(compact.read_bytes()[: len(kaiju_format.MAGIC) + 3])
+    with pytest.raises(ValueError, match="truncated"):
+        kaiju_format.concat([compact], compact.with_name("out.kjc"))
+
+
+def test_commands_stream_through_pipes(tmp_path: Path):
+    path = tmp_path.joinpath("piped.kjc")
+    subprocess.run(kaiju_format.encode_cmd(path), input=TEXT, check=True)
+    exported = subprocess.run(
+        kaiju_format.export_cmd(path), capture_output=True, check=True
+    )
+    assert exported.stdout == TEXT
@@ -0,0 +1,64 @@
+"""
+wf/local.py mirrors the workflow DAG by hand, so both must run the same tasks
+"""
+
+import ast
+from importlib import import_module
+from pathlib import Path
+
+from flytekit.core.base_task import PythonTask
+from flytekit.core.workflow import WorkflowBase
+
+import wf
+from wf import local
+
+
+def _name(task) -> str:
+    fn = getattr(task, "task_function", task)
+    return f"{fn.__module__}.{fn.__name__}"
+
+
+def _node_tasks(node) -> set:
+    entity = node.flyte_entity
+    if isinstance(entity, WorkflowBase):
+        return workflow_tasks(entity)
+    if hasattr(entity, "_ifelse_block"):
+        block = entity._ifelse_block
+        branches = [block.case] + list(block.other or [])
+        nodes = [case.then_node for case in branches]
+        if block.else_node is not None:
+            nodes.append(block.else_node)
+        return set().union(*(_node_tasks(n) for n in nodes))
+    # Map tasks wrap the task they run
+    return {_name(getattr(entity, "_run_task", entity))}
+
+
+def workflow_tasks(workflow) -> set:
+    return set().union(*(_node_tasks(node) for node in workflow.nodes))
+
+
+def mirrored_tasks() -> set:
+    """Every task wf/local.py refers to, directly or through its module"""
+    tree = ast.parse(Path(local.__file__).read_text())
+    scope = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.level == 1:
+            package = import_module(f"wf.{node.module}" if node.module else "wf")
+            for alias in node.names:
+                scope[alias.asname or alias.name] = getattr(package, alias.name)
+
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            obj = getattr(scope.get(node.value.id), node.attr, None)
+        elif isinstance(node, ast.Name):
+            obj = scope.get(node.id)
+        else:
+            continue
+        if isinstance(obj, PythonTask):
+            found.add(_name(obj))
+    return found
+
+
+def test_local_mirror_runs_the_workflow_tasks():
+    assert mirrored_tasks() == workflow_tasks(wf.metamage_quick)
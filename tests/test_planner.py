@@ -0,0 +1,88 @@
+import gzip
+from pathlib import Path
+
+import pytest
+
+from wf import planner
+from wf.batch import MAP_CONCURRENCY
+from wf.planner import (
+    DEFAULT_MODELS,
+    PlannedSample,
+    PowerLaw,
+    StageEstimate,
+    critical_path,
+    estimate,
+    estimate_reads,
+    kaiju_chunks,
+    map_duration,
+)
+
+
+def sample(name: str, read_pairs: int = 1_000_000, read_bytes: int = 10**9):
+    return PlannedSample(
+        sample_name=name,
+        read_files=[],
+        read_bytes=read_bytes,
+        read_pairs=read_pairs,
+        mean_read_length=150.0,
+        features={"read_bytes": float(read_bytes)},
+    )
+
+
+def test_estimate_reads_exact_for_short_files(tmp_path: Path):
+    path = tmp_path.joinpath("reads.fq.gz")
+    with gzip.open(path, "wt") as f:
+        for i in range(10):
+            f.write(f"@r{i}\n{'A' * 100}\n+\n{'I' * 100}\n")
+    assert estimate_reads(path) == (10, 100.0)
+
+
+def test_power_law_fit():
+    law = PowerLaw.fit([1, 10, 100], [2, 20, 200], PowerLaw(1.0, 2.0))
+    assert law.exponent == pytest.approx(1.0)
+    assert law(50) == pytest.approx(100)
+    # Without spread in the inputs only the prior's scale is fitted
+    law = PowerLaw.fit([10, 10], [30, 30], PowerLaw(1.0, 1.0))
+    assert (law.coef, law.exponent) == (pytest.approx(3.0), 1.0)
+
+
+def test_map_duration_runs_in_waves():
+    assert map_duration([10.0] * 16, 16) == 10.0
+    assert map_duration([10.0] * 17, 16) == 20.0
+    # The longest elements share the first wave
+    assert map_duration([1.0, 5.0, 2.0, 4.0], 2) == 5.0 + 2.0
+
+
+def test_kaiju_chunks():
+    assert kaiju_chunks(100, scatter_min_reads=100, chunk_reads=30) == 1
+    assert kaiju_chunks(101, scatter_min_reads=100, chunk_reads=30) == 4
+
+
+def test_critical_path_counts_waves():
+    models = {"megahit": DEFAULT_MODELS["megahit"]}
+    concurrency = MAP_CONCURRENCY["megahit"]
+    estimates = [
+        StageEstimate(f"s{i}", "megahit", 3600.0, 0.0)
+        for i in range(2 * concurrency + 1)
+    ]
+    assert critical_path(estimates, models) == (["megahit"], 3 * 3600.0)
+
+
+def test_scattered_kaiju_is_estimated_per_chunk():
+    models = {"kaiju": DEFAULT_MODELS["kaiju"]}
+    samples = [sample("deep", read_pairs=250), sample("shallow", read_pairs=50)]
+    estimates = estimate(
+        samples, models, db_bytes=1e9, scatter_min_reads=100, chunk_reads=100
+    )
+
+    deep = [e for e in estimates if e.sample_name == "deep"]
+    (shallow,) = [e for e in estimates if e.sample_name == "shallow"]
+    assert [e.chunk for e in deep] == [0, 1, 2]
+    assert shallow.chunk is None
+    assert deep[0].seconds == pytest.approx(shallow.seconds / 3)
+
+    # Chunks share the stage's concurrency with whole samples
+    _, total = critical_path(estimates, models)
+    assert total == pytest.approx(
+        map_duration([e.seconds for e in estimates], planner.stage_concurrency("kaiju"))
+    )
@@ -0,0 +1,66 @@
+import gzip
+from pathlib import Path
+
+import pytest
+
+from wf import preflight
+from wf.preflight import PreflightError, profile_pair
+
+
+def record(name: str, seq: str = "ACGTN", qual: str = "II#II") -> str:
+    return f"@{name}\n{seq}\n+\n{qual}\n"
+
+
+def write_pair(tmp_path: Path, reads1, reads2, suffix=".fq"):
+    paths = []
+    for mate, reads in enumerate((reads1, reads2), 1):
+        path = tmp_path.joinpath(f"r{mate}{suffix}")
+        text = "".join(reads)
+        if suffix.endswith(".gz"):
+            with gzip.open(path, "wt") as f:
+                f.write(text)
+        else:
+            path.write_text(text)
+        paths.append(path)
+    return paths
+
+
+def test_profile(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(preflight, "BATCH_RECORDS", 2)
+    reads1 = [record(f"r{i}/1 extra") for i in range(5)]
+    reads2 = [record(f"r{i}/2", "GGCC", "IIII") for i in range(5)]
+    profile = profile_pair("s1", *write_pair(tmp_path, reads1, reads2, ".fq.gz"))
+
+    assert profile["read_pairs"] == 5
+    assert profile["bases"] == 45
+    assert profile["gc_fraction"] == round(30 / 45, 4)
+    assert profile["n_fraction"] == round(5 / 45, 6)
+    assert profile["quality_histogram"] == {2: 5, 40: 40}
+    assert [mate["mean_length"] for mate in profile["mates"]] == [5.0, 4.0]
+
+
+@pytest.mark.parametrize(
+    "reads1, reads2, error",
+    [
+        ([record("a"), record("b")], [record("a")], "different numbers"),
+        ([record("a/1")], [record("b/2")], "does not match"),
+        ([record("a", qual="III")], [record("a")], "record 1 is malformed"),
+        ([record("a", seq="ACGTX")], [record("a")], "unexpected characters 'X'"),
+        ([record("a", qual="hhhhh")], [record("a", qual="hhhhh")], "Phred\\+64"),
+        ([record("a")[:-6]], [record("a")], "incomplete record"),
+        ([], [], "empty"),
+    ],
+)
+def test_problems_are_reported(tmp_path: Path, reads1, reads2, error):
+    with pytest.raises(PreflightError, match=error):
+        profile_pair("s1", *write_pair(tmp_path, reads1, reads2))
+
+
+def test_truncated_gzip(tmp_path: Path):
+    read1, read2 = write_pair(
+        tmp_path, [record(f"r{i}") for i in range(1000)], [], ".fq.gz"
+    )
+    read1.write_bytes(read1.read_bytes()[:-20])
+    read2.write_bytes(read1.read_bytes())
+    with pytest.raises(PreflightError, match="truncated or corrupt"):
+        profile_pair("s1", read1, read2)
@@ -0,0 +1,96 @@
+"""
+End-to-end run of the workflow DAG with stand-in tools
+"""
+
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def write_reads(path: Path, mate: int, pairs: int = 500, seed: int = 0):
+    rng = random.Random(seed)
+    with gzip.open(path, "wt") as f:
+        for i in range(pairs):
+            seq = "".join(rng.choice("ACGT") for _ in range(100))
+            qual = "".join(chr(33 + rng.randint(2, 40)) for _ in range(100))
+            f.write(f"@r{i}/{mate}\n{seq}\n+\n{qual}\n")
+
+
+@pytest.fixture
+def sample_sheet(tmp_path: Path) -> Path:
+    rows = ["sample_name,read1,read2"]
+    for n, name in enumerate(["s1", "s2"]):
+        reads = [tmp_path.joinpath(f"{name}_{mate}.fq.gz") for mate in (1, 2)]
+        for mate, path in enumerate(reads, 1):
+            write_reads(path, mate, seed=n)
+        rows.append(f"{name},{reads[0]},{reads[1]}")
+    sheet = tmp_path.joinpath("samples.csv")
+    sheet.write_text("\n".join(rows) + "\n")
+    for ref in ("db.fmi", "nodes.dmp", "names.dmp"):
+        tmp_path.joinpath(ref).touch()
+    return sheet
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        [],
+        [
+            "--share-gene-calls",
+            "--fargene-all-models",
+            "--read-mapper",
+            "minimap2",
+            "--compact-kaiju-output",
+            "--kaiju-scatter-min-reads",
+            "100",
+            "--kaiju-chunk-reads",
+            "200",
+        ],
+        ["--colocate-functional-tools", "--preview"],
+    ],
+    ids=["default", "shared-gene-calls", "colocated-preview"],
+)
+def test_standin_run(sample_sheet: Path, options):
+    refs = sample_sheet.parent
+    workdir = refs.joinpath("work")
+    subprocess.run(
+        [
+            sys.executable,
+            str(ROOT.joinpath("scripts", "run_local.py")),
+            str(sample_sheet),
+            "--kaiju-ref-db",
+            str(refs.joinpath("db.fmi")),
+            "--kaiju-ref-nodes",
+            str(refs.joinpath("nodes.dmp")),
+            "--kaiju-ref-names",
+            str(refs.joinpath("names.dmp")),
+            "--workdir",
+            str(workdir),
+            "--workers",
+            "2",
+            "--standin",
+            *options,
+        ],
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        check=True,
+        timeout=600,
+    )
+
+    status = json.loads(
+        workdir.joinpath("run_report", "batch_status.json").read_text()
+    )
+    suffix = ".preview" if "--preview" in options else ""
+    assert status == {
+        "completed_samples": [f"s1{suffix}", f"s2{suffix}"],
+        "failed_stages": {},
+    }
+    assert workdir.joinpath("run_report", "run_report.json").exists()
+    assert list(workdir.joinpath("build_abundance_matrix").rglob("*_counts.npz"))
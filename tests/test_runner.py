@@ -0,0 +1,87 @@
+import pickle
+import sys
+from pathlib import Path
+
+import pytest
+
+from wf import local
+from wf.telemetry import collect
+from wf.runner import OutOfMemoryError, ToolError, run, run_pipeline
+
+
+def test_tool_error_pickles():
+    for cls in (ToolError, OutOfMemoryError):
+        error = cls("megahit", "exited with status 1", "out of disk")
+        copy = pickle.loads(pickle.dumps(error))
+        assert type(copy) is cls
+        assert (copy.tool, copy.reason, copy.stderr_tail) == (
+            "megahit",
+            "exited with status 1",
+            "out of disk",
+        )
+        assert str(copy) == str(error)
+
+
+def test_run_returns_metrics(tmp_path: Path):
+    out = tmp_path.joinpath("out.txt")
+    metrics = run(["sh", "-c", f"echo hello > {out}"], outputs=[out])
+    assert metrics.tool == "sh"
+    assert metrics.exit_status == 0
+    assert out.read_text() == "hello\n"
+
+
+def test_pipeline_stream_bytes():
+    stages = run_pipeline([["head", "-c", "100000", "/dev/zero"], ["wc", "-c"]])
+    assert [stage.tool for stage in stages] == ["head", "wc"]
+    assert stages[0].stream_bytes_out == 100000
+    assert stages[1].stream_bytes_in >= 100000
+
+
+def test_failing_stage_is_reported():
+    with pytest.raises(ToolError) as error:
+        run_pipeline(
+            [["sh", "-c", "echo broken >&2; exit 3"], ["cat"]],
+        )
+    assert error.value.tool == "sh"
+    assert "broken" in error.value.stderr_tail
+
+
+def test_missing_output(tmp_path: Path):
+    with pytest.raises(ToolError, match="was not created"):
+        run(["true"], outputs=[tmp_path.joinpath("never_written")])
+
+
+def test_timeout():
+    with pytest.raises(ToolError):
+        run(["sleep", "10"], timeout=0.2)
+
+
+def failing_tool(value: int) -> int:
+    if value == 1:
+        run([sys.executable, "-c", "raise SystemExit(2)"])
+    return value
+
+
+def test_local_map_failed_element_is_none(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(local, "MIN_SUCCESS_RATIO", 0.5)
+    with local.LocalExecutor(tmp_path, max_workers=2) as ex:
+        assert ex.map(failing_tool, value=[0, 1, 2]) == [0, None, 2]
+
+
+def leaves_invocation(value: int) -> int:
+    run(["true"])
+    if value:
+        raise ValueError("failed before collect()")
+    return value
+
+
+def collected_tools(value: int) -> list:
+    run(["true"])
+    return [tool.tool for tool in collect("s", "stage").tools]
+
+
+def test_local_task_starts_without_earlier_invocations(tmp_path: Path):
+    with local.LocalExecutor(tmp_path, max_workers=1) as ex:
+        with pytest.raises(ValueError):
+            ex.run(leaves_invocation, value=1)
+        assert ex.run(collected_tools, value=0) == ["true"]
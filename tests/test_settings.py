@@ -0,0 +1,42 @@
+from pathlib import Path
+
+from latch.types import LatchFile
+
+from wf.functional import FunctionalSettings
+from wf.kaiju import KaijuSettings, organize_kaiju_inputs
+from wf.settings import read_settings, write_settings
+from wf.types import ProdigalOutput, Sample, TaxonRank, fARGeneModel
+
+
+def test_round_trip():
+    settings = FunctionalSettings(
+        prodigal_output_format=ProdigalOutput.gbk,
+        fargene_hmm_models=[fARGeneModel.class_a, fARGeneModel.qnr],
+        share_gene_calls=True,
+    )
+    assert read_settings(FunctionalSettings, write_settings(settings)) == settings
+
+
+def test_samples_share_one_settings_file(tmp_path: Path):
+    refs = [tmp_path.joinpath(name) for name in ("db.fmi", "nodes.dmp", "names.dmp")]
+    samples = [
+        Sample(
+            read1=LatchFile(str(tmp_path.joinpath(f"{name}_1.fq.gz"))),
+            read2=LatchFile(str(tmp_path.joinpath(f"{name}_2.fq.gz"))),
+            sample_name=name,
+        )
+        for name in ("s1", "s2", "s3")
+    ]
+    inputs = organize_kaiju_inputs.task_function(
+        samples,
+        [],
+        *(LatchFile(str(ref)) for ref in refs),
+        taxon_rank=TaxonRank.genus,
+        compact_output=True,
+    )
+
+    assert len({kaiju_input.settings.path for kaiju_input in inputs}) == 1
+    settings = read_settings(KaijuSettings, inputs[0].settings)
+    assert settings.kaiju_ref_nodes == str(refs[1])
+    assert settings.taxon_rank == TaxonRank.genus
+    assert settings.compact_output
@@ -0,0 +1,76 @@
+from pathlib import Path
+
+import pytest
+
+from wf.taxonomy import SetTaxonomy, TaxonomyIndex, build_index, weighted_lca
+
+# taxid, parent, rank, name
+NODES = [
+    (1, 1, "no rank", "root"),
+    (2, 1, "superkingdom", "Bacteria"),
+    (1224, 2, "phylum", "Proteobacteria"),
+    (1239, 2, "phylum", "Firmicutes"),
+    (543, 1224, "family", "Enterobacteriaceae"),
+    (561, 543, "genus", "Escherichia"),
+    (562, 561, "species", "Escherichia coli"),
+    (564, 561, "species", "Escherichia fergusonii"),
+    (83333, 562, "strain", "Escherichia coli K-12"),
+    (1386, 1239, "genus", "Bacillus"),
+]
+
+
+@pytest.fixture
+def index(tmp_path: Path) -> TaxonomyIndex:
+    nodes = tmp_path.joinpath("nodes.dmp")
+    names = tmp_path.joinpath("names.dmp")
+    nodes.write_text("".join(f"{t}\t|\t{p}\t|\t{r}\t|\n" for t, p, r, _ in NODES))
+    names.write_text(
+        "".join(f"{t}\t|\t{n}\t|\t\t|\tscientific name\t|\n" for t, _, _, n in NODES)
+        + "562\t|\tE. coli\t|\t\t|\tsynonym\t|\n"
+    )
+    return TaxonomyIndex(build_index(nodes, names, tmp_path.joinpath("tax.idx")))
+
+
+def test_index_lookups(index: TaxonomyIndex):
+    assert 562 in index and 0 not in index and 999 not in index
+    assert index.name(562) == "Escherichia coli"
+    assert index.rank(562) == "species"
+    assert index.rank(83333) == "no rank"
+    assert index.lineage(83333) == (1, 2, 1224, 543, 561, 562, 83333)
+    assert index.lineage(999) == ()
+    assert index.ranked_lineage(83333) == (
+        "Bacteria;Proteobacteria;Enterobacteriaceae;Escherichia;Escherichia coli"
+    )
+
+
+def test_not_an_index(tmp_path: Path):
+    path = tmp_path.joinpath("nodes.dmp")
+    path.write_bytes(b"1\t|\t1\t|\tno rank\t|\n")
+    with pytest.raises(ValueError, match="not a taxonomy index"):
+        TaxonomyIndex(path)
+
+
+def test_lca_follows_the_length_majority(index: TaxonomyIndex):
+    # Two species of one genus split the length, so the genus is assigned
+    result = weighted_lca([(500, 562), (500, 564)], index)
+    assert result == SetTaxonomy(561, 1.0, 0.0, 1.0)
+
+    # The deepest supported taxon wins, contigs above it on its lineage agree
+    result = weighted_lca([(800, 83333), (150, 562), (50, 1386), (100, 0)], index)
+    assert result.taxon_id == 83333
+    assert result.confidence == 0.8
+    assert result.contamination == 0.05
+    assert result.classified_fraction == pytest.approx(1000 / 1100, abs=1e-4)
+
+
+def test_lca_of_unclassified_contigs(index: TaxonomyIndex):
+    assert weighted_lca([(100, 0), (50, 999)], index) == SetTaxonomy(0, 0.0, 0.0, 0.0)
+    assert weighted_lca([], index).taxon_id == 0
+
+
+def test_lca_support_threshold(index: TaxonomyIndex):
+    contigs = [(500, 562), (500, 1386)]
+    # Only their common superkingdom has a majority
+    assert weighted_lca(contigs, index).taxon_id == 2
+    assert weighted_lca(contigs, index, min_support=0.4).taxon_id in (562, 1386)
+    assert weighted_lca(contigs, index, min_support=1.0).taxon_id == 0
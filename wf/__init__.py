@@ -1,17 +1,44 @@
+import json
 from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
 from typing import List, Union
 
 from dataclasses_json import dataclass_json
-from latch import small_task, workflow
+from flytekit import conditional
+from latch import message, small_task, workflow
 from latch.resources.launch_plan import LaunchPlan
 from latch.types import LatchDir, LatchFile
 
-from .assembly import AssemblyOut, assembly_wf
-from .binning import binning_wf
+from .abundance import AbundanceMatrix, build_abundance_matrix
+from .assembly import CONTIG_LENGTH_TIERS, AssemblyOut, assembly_wf
+from .batch import by_sample
+from .bin_taxonomy import BinTaxonomyOut, bin_taxonomy_wf
+from .binning import BinningOut, binning_wf
 from .docs import metamage_DOCS
 from .functional import FunctionalOutput, functional_wf
-from .kaiju import kaiju_wf
-from .types import ProdigalOutput, Sample, TaxonRank, fARGeneModel
+from .functional_hits import HITS_ROOT, FunctionalHitsOut, functional_hits_wf
+from .images import GLUE
+from .incremental import (
+    CohortState,
+    cohort_kaiju_tables,
+    previous_dirs,
+    previous_files,
+    select_pending_samples,
+    write_manifests,
+)
+from .kaiju import CHUNK_READS, SCATTER_MIN_READS, KaijuTableOut, kaiju_wf
+from .preflight import ReadProfile, preflight_wf
+from .preview import PREVIEW_READ_PAIRS, full_samples, preview_wf
+from .telemetry import write_report
+from .types import (
+    AssemblyStatsMode,
+    ProdigalOutput,
+    ReadMapper,
+    Sample,
+    TaxonRank,
+    fARGeneModel,
+)
 
 
 @dataclass_json
@@ -19,33 +46,141 @@ from .types import ProdigalOutput, Sample, TaxonRank, fARGeneModel
 class WfResults:
     assembly_results: List[LatchDir]
     binning_results: List[LatchDir]
+    bin_taxonomy: List[LatchFile]
     kaiju2table_outs: List[LatchFile]
+    abundance_matrix: LatchDir
     prodigal_results: List[LatchDir]
     macrel_results: List[LatchDir]
     fargene_results: List[LatchDir]
     gecco_results: List[LatchDir]
+    # Per-tool hit tables of the whole cohort, partitioned by sample
+    functional_hits: LatchDir
+    read_profiles: List[LatchFile]
+    run_report: LatchDir
+    manifests: List[LatchFile]
+    # Samples left out of this run's results after a stage failed for them
+    failed_samples: List[str]
 
 
-@small_task
+@small_task(container_image=GLUE)
 def organize_final_outputs(
+    samples: List[Sample],
+    read_profiles: List[ReadProfile],
     assembly_results: List[AssemblyOut],
-    binning_results: List[LatchDir],
-    kaiju2table_outs: List[LatchFile],
+    binning_results: List[BinningOut],
+    bin_taxonomy: List[BinTaxonomyOut],
+    kaiju2table_outs: List[KaijuTableOut],
+    abundance_matrix: AbundanceMatrix,
     functional_results: List[FunctionalOutput],
+    functional_hits: List[FunctionalHitsOut],
+    cohort: CohortState,
 ) -> WfResults:
 
     metaquast_results = [
         assembly_result.evaluation for assembly_result in assembly_results
     ]
 
+    task_metrics = [
+        metrics
+        for results in (
+            read_profiles,
+            assembly_results,
+            binning_results,
+            bin_taxonomy,
+            kaiju2table_outs,
+            [abundance_matrix],
+            functional_results,
+            functional_hits,
+        )
+        for result in results
+        for metrics in result.metrics
+    ]
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    report_dir = write_report(task_metrics, Path("run_report").resolve())
+
+    # Samples whose elements failed in a stage were dropped from the stages
+    # after it, rather than failing the whole run
+    stages = {
+        "preflight": by_sample(read_profiles),
+        "assembly": by_sample(assembly_results),
+        "binning": by_sample(binning_results),
+        "bin_taxonomy": by_sample(bin_taxonomy),
+        "kaiju": by_sample(kaiju2table_outs),
+        "functional": by_sample(functional_results),
+        "functional_hits": by_sample(functional_hits),
+    }
+    failed_stages = {
+        sample.sample_name: [
+            stage for stage, outs in stages.items() if sample.sample_name not in outs
+        ]
+        for sample in samples
+    }
+    failed_stages = {name: failed for name, failed in failed_stages.items() if failed}
+    completed = [s.sample_name for s in samples if s.sample_name not in failed_stages]
+    report_dir.joinpath("batch_status.json").write_text(
+        json.dumps(
+            {"completed_samples": completed, "failed_stages": failed_stages}, indent=2
+        )
+    )
+    if failed_stages:
+        message(
+            "warning",
+            {
+                "title": f"{len(failed_stages)} of {len(samples)} samples failed",
+                "body": ", ".join(
+                    f"{name} ({', '.join(failed)})"
+                    for name, failed in failed_stages.items()
+                ),
+            },
+        )
+
+    # Where this run's completed samples put their outputs, for their
+    # manifests. Failed samples get none, so the next incremental run
+    # picks them up again.
+    sample_outputs = {
+        name: {
+            "assembly_results": stages["assembly"][name].evaluation.remote_path,
+            "binning_results": stages["binning"][name].bins.remote_path,
+            "bin_taxonomy": stages["bin_taxonomy"][name].table.remote_path,
+            "kaiju2table_outs": stages["kaiju"][name].kaiju_table.remote_path,
+            "kaiju_taxon_counts": stages["kaiju"][name].taxon_counts.remote_path,
+            "prodigal_results": stages["functional"][name].prodigal_result.remote_path,
+            "macrel_results": stages["functional"][name].macrel_result.remote_path,
+            "fargene_results": stages["functional"][name].fargene_result.remote_path,
+            "gecco_results": stages["functional"][name].gecco_result.remote_path,
+            "read_profiles": stages["preflight"][name].profile.remote_path,
+        }
+        for name in completed
+    }
+    manifests = write_manifests(cohort, sample_outputs, Path("manifests").resolve())
+
+    # Samples skipped by an incremental run are listed with their earlier
+    # outputs, so the results always cover the whole cohort
     return WfResults(
-        assembly_results=metaquast_results,
-        binning_results=binning_results,
-        kaiju2table_outs=kaiju2table_outs,
-        prodigal_results=[func.prodigal_result for func in functional_results],
-        macrel_results=[func.macrel_result for func in functional_results],
-        fargene_results=[func.fargene_result for func in functional_results],
-        gecco_results=[func.gecco_result for func in functional_results],
+        assembly_results=metaquast_results + previous_dirs(cohort, "assembly_results"),
+        binning_results=[binning.bins for binning in binning_results]
+        + previous_dirs(cohort, "binning_results"),
+        bin_taxonomy=[bins.table for bins in bin_taxonomy]
+        + previous_files(cohort, "bin_taxonomy"),
+        kaiju2table_outs=[kaiju.kaiju_table for kaiju in kaiju2table_outs]
+        + previous_files(cohort, "kaiju2table_outs"),
+        abundance_matrix=abundance_matrix.matrix,
+        prodigal_results=[func.prodigal_result for func in functional_results]
+        + previous_dirs(cohort, "prodigal_results"),
+        macrel_results=[func.macrel_result for func in functional_results]
+        + previous_dirs(cohort, "macrel_results"),
+        fargene_results=[func.fargene_result for func in functional_results]
+        + previous_dirs(cohort, "fargene_results"),
+        gecco_results=[func.gecco_result for func in functional_results]
+        + previous_dirs(cohort, "gecco_results"),
+        functional_hits=LatchDir(HITS_ROOT),
+        read_profiles=[profile.profile for profile in read_profiles]
+        + previous_files(cohort, "read_profiles"),
+        run_report=LatchDir(
+            str(report_dir), f"latch:///metamage/run_reports/{run_id}"
+        ),
+        manifests=manifests,
+        failed_samples=list(failed_stages),
     )
 
 
@@ -56,13 +191,25 @@ def metamage_quick(
     kaiju_ref_nodes: LatchFile,
     kaiju_ref_names: LatchFile,
     taxon_rank: TaxonRank = TaxonRank.species,
+    kaiju_scatter_min_reads: int = SCATTER_MIN_READS,
+    kaiju_chunk_reads: int = CHUNK_READS,
+    compact_kaiju_output: bool = False,
     min_count: int = 2,
     k_min: int = 21,
     k_max: int = 141,
     k_step: int = 12,
     min_contig_len: int = 200,
+    assembly_stats_mode: AssemblyStatsMode = AssemblyStatsMode.fast,
+    contig_length_tiers: List[int] = CONTIG_LENGTH_TIERS,
+    read_mapper: ReadMapper = ReadMapper.bowtie2,
     prodigal_output_format: ProdigalOutput = ProdigalOutput.gbk,
-    fargene_hmm_model: fARGeneModel = fARGeneModel.class_a,
+    fargene_hmm_models: List[fARGeneModel] = [fARGeneModel.class_a],
+    fargene_all_models: bool = False,
+    share_gene_calls: bool = False,
+    colocate_functional_tools: bool = False,
+    preview: bool = False,
+    preview_read_pairs: int = PREVIEW_READ_PAIRS,
+    incremental: bool = False,
 ) -> WfResults:
     """Metagenomic assembly, binning and taxonomic classification
 
@@ -74,10 +221,19 @@ def metamage_quick(
 
     It's composed of:
 
+    ## Pre-flight checks
+
+    - Each sample's read pair is streamed once before anything else runs,
+      to catch unpaired or truncated reads and Phred+64 qualities early,
+      and to profile read counts, lengths and qualities
+
     ## Assembly
 
     - [MEGAHIT](https://github.com/voutcn/megahit) for assembly [^1]
-    - [MetaQuast](https://github.com/ablab/quast) for assembly evaluation
+    - Assembly statistics (N50/L50, length and GC histograms, contig
+      counts above length thresholds) computed in one pass over the
+      contigs, or optionally a full
+      [MetaQuast](https://github.com/ablab/quast) evaluation
 
     ## Binning
 
@@ -85,11 +241,17 @@ def metamage_quick(
       building depth files for binning.
     - [MetaBAT2](https://bitbucket.org/berkeleylab/metabat/src/master/) for
       binning [^2]
+    - Kaiju on the binned contigs, all samples in one run, and a
+      length-weighted majority of the contig taxa for each bin's taxonomy,
+      confidence and contamination
 
     ## Taxonomic classification of reads
 
     - [Kaiju](https://github.com/bioinformatics-centre/kaiju) for
-      taxonomic classification [^3]
+      taxonomic classification [^3]. Samples above a read-pair threshold
+      are split into chunks that are classified on several nodes and
+      merged back in order. Read assignments can optionally be stored in a
+      compact columnar format (`.kjc`, see `wf/kaiju_format.py`).
     - [KronaTools](https://github.com/marbl/Krona/wiki/KronaTools) for
       visualizing taxonomic classification results
 
@@ -98,11 +260,27 @@ def metamage_quick(
     - |metamage
       - |{sample_name}
         - |kaiju
-        - |MEGAHIT
-        - |MetaQuast - Assembly evaluation report
+        - |preflight - Read profile: pair count, read length and quality distributions
+        - |MEGAHIT - Contigs, a block-compressed (BGZF) copy with FASTA and block
+            indexes, and subsets by minimum length
+        - |{sample_name}_AssemblyStats - Assembly statistics (JSON and TSV)
+        - |MetaQuast - Assembly evaluation report (if requested)
         - |{sample_name}_assembly_idx - BowTie Index from assembly data
         - |{sample_name}_assembly_sorted.bam - Reads aligned to assembly contigs
         - |METABAT
+        - |bin_taxonomy - Per-bin taxonomy with confidence and contamination
+        - |manifest.json - Inputs, parameters and outputs of the sample's last full run
+      - |functional_hits
+        - |{tool}/{sample_name}.fht - Macrel, fARGene, GECCO hits and Prodigal gene
+            counts as typed columnar tables, one partition per sample (see
+            `wf/hit_table.py`)
+      - |abundance_matrix
+        - |{timestamp} - Samples x taxa read counts at every rank (CSR .npz per rank)
+            with sample and taxon index TSVs
+        - |preview/{timestamp} - The same for preview runs
+      - |run_reports
+        - |{timestamp} - Per-sample, per-stage performance report (JSON and HTML) and
+            batch status (completed samples, failed stages per sample)
 
     # Where to get the data?
 
@@ -161,38 +339,109 @@ def metamage_quick(
     https://doi.org/10.1093/gigascience/giab008
     """
 
-    assembly_dirs = assembly_wf(
+    # An incremental run skips the samples whose outputs are up to date
+    pending_samples, cohort = select_pending_samples(
         samples=samples,
+        incremental=incremental,
+        preview=preview,
+        kaiju_ref_db=kaiju_ref_db,
+        taxon_rank=taxon_rank,
+        compact_kaiju_output=compact_kaiju_output,
+        min_count=min_count,
+        k_min=k_min,
+        k_max=k_max,
+        k_step=k_step,
+        min_contig_len=min_contig_len,
+        assembly_stats_mode=assembly_stats_mode,
+        contig_length_tiers=contig_length_tiers,
+        read_mapper=read_mapper,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_models=fargene_hmm_models,
+        fargene_all_models=fargene_all_models,
+        share_gene_calls=share_gene_calls,
+    )
+
+    # A preview runs everything on a subsample of each sample's reads
+    run_samples = (
+        conditional("preview")
+        .if_(preview.is_true())
+        .then(preview_wf(samples=pending_samples, read_pairs=preview_read_pairs))
+        .else_()
+        .then(full_samples(samples=pending_samples))
+    )
+
+    # Malformed or unpaired reads fail their sample here, in seconds to
+    # minutes rather than hours into assembly
+    checked_samples, read_profiles = preflight_wf(samples=run_samples)
+
+    assembly_dirs = assembly_wf(
+        samples=checked_samples,
         min_count=min_count,
         k_min=k_min,
         k_max=k_max,
         k_step=k_step,
         min_contig_len=min_contig_len,
+        stats_mode=assembly_stats_mode,
+        contig_length_tiers=contig_length_tiers,
     )
 
     # Binning
-    binning_results = binning_wf(samples=samples, megahit_out=assembly_dirs)
+    binning_results = binning_wf(
+        samples=checked_samples, megahit_out=assembly_dirs, read_mapper=read_mapper
+    )
+
+    # Bins are labelled from Kaiju classifications of their contigs
+    bin_taxonomy = bin_taxonomy_wf(
+        binning_results=binning_results,
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+    )
 
     kaiju2table_outs = kaiju_wf(
-        samples=samples,
+        samples=checked_samples,
+        read_profiles=read_profiles,
         kaiju_ref_db=kaiju_ref_db,
         kaiju_ref_nodes=kaiju_ref_nodes,
         kaiju_ref_names=kaiju_ref_names,
         taxon_rank=taxon_rank,
+        scatter_min_reads=kaiju_scatter_min_reads,
+        chunk_reads=kaiju_chunk_reads,
+        compact_output=compact_kaiju_output,
+    )
+
+    # The matrix covers the whole cohort, skipped samples included
+    cohort_tables = cohort_kaiju_tables(kaiju_tables=kaiju2table_outs, cohort=cohort)
+    abundance_matrix = build_abundance_matrix(
+        kaiju_tables=cohort_tables,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+        preview=preview,
     )
 
     # Functional
     functional_results = functional_wf(
         assembly_data=assembly_dirs,
         prodigal_output_format=prodigal_output_format,
-        fargene_hmm_model=fargene_hmm_model,
+        fargene_hmm_models=fargene_hmm_models,
+        fargene_all_models=fargene_all_models,
+        share_gene_calls=share_gene_calls,
+        colocate_tools=colocate_functional_tools,
     )
 
+    functional_hits = functional_hits_wf(functional_results=functional_results)
+
     organized_outputs = organize_final_outputs(
+        samples=run_samples,
+        read_profiles=read_profiles,
         assembly_results=assembly_dirs,
         binning_results=binning_results,
+        bin_taxonomy=bin_taxonomy,
         kaiju2table_outs=kaiju2table_outs,
+        abundance_matrix=abundance_matrix,
         functional_results=functional_results,
+        functional_hits=functional_hits,
+        cohort=cohort,
     )
 
     return organized_outputs
@@ -230,6 +479,6 @@ LaunchPlan(
         ),
         "taxon_rank": TaxonRank.species,
         "prodigal_output_format": ProdigalOutput.gff,
-        "fargene_hmm_model": fARGeneModel.class_b_1_2,
+        "fargene_hmm_models": [fARGeneModel.class_b_1_2],
     },
 )
@@ -0,0 +1,211 @@
+"""
+Cross-sample taxon abundance matrix
+"""
+
+import csv
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from dataclasses_json import dataclass_json
+from latch import small_task
+from latch.types import LatchDir, LatchFile
+
+from . import taxonomy
+from .images import GLUE
+from .kaiju import KaijuTableOut
+from .telemetry import TaskMetrics, collect
+from .types import TaxonRank
+
+# numpy dtype descriptors of the array typecodes used below
+_NPY_DTYPES = {"q": "<i8"}
+
+MATRIX_ROOT = "latch:///metamage/abundance_matrix"
+
+
+@dataclass_json
+@dataclass
+class AbundanceMatrix:
+    # One matrix per rank of taxonomy.RANKS
+    matrix: LatchDir
+    metrics: List[TaskMetrics]
+
+
+def _npy(values: array) -> bytes:
+    """``values`` serialized as a version 1.0 .npy file"""
+    header = repr(
+        {
+            "descr": _NPY_DTYPES[values.typecode],
+            "fortran_order": False,
+            "shape": (len(values),),
+        }
+    ).encode()
+    # Magic, version and header length take 10 bytes, the data starts at a
+    # multiple of 64 and the header ends with a newline.
+    header += b" " * (-(10 + len(header) + 1) % 64) + b"\n"
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return (
+        b"\x93NUMPY\x01\x00"
+        + struct.pack("<H", len(header))
+        + header
+        + values.tobytes()
+    )
+
+
+def taxon_counts(counts_table: Path) -> Dict[int, int]:
+    """Reads per taxon id of a sample's ``_kaiju_taxa.tsv``"""
+    with open(counts_table, newline="") as f:
+        return {
+            int(row["taxon_id"]): int(row["reads"])
+            for row in csv.DictReader(f, delimiter="\t")
+        }
+
+
+def ranked_rows(
+    counts: Dict[int, int], index: taxonomy.TaxonomyIndex
+) -> Dict[str, List[Tuple[str, str, int]]]:
+    """(taxon id, taxon name, reads) rows at every rank, from reads per taxon
+
+    Reads count towards their taxon's ancestor at each rank, as kaiju2table
+    would count them for that rank. Those classified above a rank, or to a
+    taxon missing from the index, cannot be assigned to it. Taxa are named
+    by their lineage, like kaiju2table's ``-p``.
+    """
+    rows: Dict[str, List[Tuple[str, str, int]]] = {rank: [] for rank in taxonomy.RANKS}
+    for taxid, reads in counts.items():
+        if taxid == 0:
+            for rank_rows in rows.values():
+                rank_rows.append(("NA", "unclassified", reads))
+            continue
+
+        lineage = index.lineage(taxid) if taxid in index else ()
+        at_rank = {index.rank(node): node for node in lineage}
+        for rank, rank_rows in rows.items():
+            node = at_rank.get(rank)
+            if node is None:
+                rank_rows.append(("NA", f"cannot be assigned to a {rank}", reads))
+            else:
+                rank_rows.append((str(node), index.ranked_lineage(node), reads))
+    return rows
+
+
+class MatrixBuilder:
+    """Builds a samples x taxa read count matrix in CSR form, row by row
+
+    Only the non-zero counts are kept, so memory grows with the number of
+    (sample, taxon) pairs observed rather than samples times taxa.
+    """
+
+    def __init__(self):
+        self.samples: List[str] = []
+        self.taxa: Dict[Tuple[str, str], int] = {}
+        self.indptr = array("q", [0])
+        self.indices = array("q")
+        self.data = array("q")
+
+    def add_sample(self, sample_name: str, rows: Iterable[Tuple[str, str, int]]):
+        counts: Dict[int, int] = {}
+        for taxon_id, taxon_name, reads in rows:
+            column = self.taxa.setdefault((taxon_id, taxon_name), len(self.taxa))
+            counts[column] = counts.get(column, 0) + reads
+
+        for column in sorted(counts):
+            if counts[column]:
+                self.indices.append(column)
+                self.data.append(counts[column])
+        self.indptr.append(len(self.indices))
+        self.samples.append(sample_name)
+
+    def write(self, out_dir: Path, taxon_rank: TaxonRank) -> Path:
+        """Write ``{rank}_counts.npz`` plus the row and column index files
+
+        The archive holds ``data``, ``indices``, ``indptr`` and ``shape``,
+        as ``scipy.sparse.csr_matrix((data, indices, indptr), shape)``
+        expects them.
+        """
+        # Only this task writes archives, every task imports the module
+        import zipfile
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        prefix = taxon_rank.value
+        shape = array("q", [len(self.samples), len(self.taxa)])
+
+        with zipfile.ZipFile(
+            out_dir.joinpath(f"{prefix}_counts.npz"), "w", zipfile.ZIP_DEFLATED
+        ) as npz:
+            for name, values in (
+                ("data", self.data),
+                ("indices", self.indices),
+                ("indptr", self.indptr),
+                ("shape", shape),
+            ):
+                npz.writestr(f"{name}.npy", _npy(values))
+
+        with open(out_dir.joinpath(f"{prefix}_samples.tsv"), "w") as f:
+            f.write("row\tsample_name\n")
+            for row, sample_name in enumerate(self.samples):
+                f.write(f"{row}\t{sample_name}\n")
+
+        with open(out_dir.joinpath(f"{prefix}_taxa.tsv"), "w") as f:
+            f.write("column\ttaxon_id\ttaxon_name\n")
+            for (taxon_id, taxon_name), column in self.taxa.items():
+                f.write(f"{column}\t{taxon_id}\t{taxon_name}\n")
+
+        return out_dir
+
+
+@small_task(container_image=GLUE)
+def build_abundance_matrix(
+    kaiju_tables: List[KaijuTableOut],
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    preview: bool = False,
+) -> AbundanceMatrix:
+    """Merge per-sample read counts into one sparse matrix per rank
+
+    Every sample's reads per taxon are rolled up the reference taxonomy to
+    each rank, whichever rank its kaiju2table output was made at. A
+    preview's matrices go below ``preview/``, away from the full runs'.
+    """
+
+    index = taxonomy.TaxonomyIndex(
+        taxonomy.build_index(
+            Path(kaiju_ref_nodes.local_path),
+            Path(kaiju_ref_names.local_path),
+            Path("taxonomy.idx").resolve(),
+        )
+    )
+
+    builders = {rank: MatrixBuilder() for rank in taxonomy.RANKS}
+    counts_bytes = 0
+    for table in kaiju_tables:
+        # Samples are streamed one at a time, only their counts are kept
+        local_counts = Path(table.taxon_counts.local_path)
+        counts_bytes += local_counts.stat().st_size
+        rows = ranked_rows(taxon_counts(local_counts), index)
+        for rank, builder in builders.items():
+            builder.add_sample(table.sample_name, rows[rank])
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    out_dir = Path("abundance_matrix").resolve()
+    for rank, builder in builders.items():
+        builder.write(out_dir, TaxonRank(rank))
+    root = f"{MATRIX_ROOT}/preview" if preview else MATRIX_ROOT
+
+    return AbundanceMatrix(
+        matrix=LatchDir(str(out_dir), f"{root}/{run_id}"),
+        metrics=[
+            collect(
+                "all_samples",
+                "abundance_matrix",
+                samples=len(kaiju_tables),
+                counts_bytes=counts_bytes,
+            )
+        ],
+    )
@@ -2,27 +2,58 @@
 Read assembly and evaluation for metagenomics data
 """
 
-import subprocess
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 from dataclasses_json import dataclass_json
-from latch import large_task, map_task, message, small_task, workflow
+from latch import large_task, medium_task, message, small_task, workflow
 from latch.types import LatchDir, LatchFile
 
-from .types import Sample
+from . import assembly_stats, contig_index
+from .batch import (
+    batch_map,
+    by_sample,
+    high_memory_task,
+    out_of_memory_inputs,
+    present,
+    records_out_of_memory,
+)
+from .images import ASSEMBLY, GLUE
+from .runner import run
+from .settings import read_settings, write_settings
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import AssemblyStatsMode, Sample, output_prefix
+
+# Contig subsets written after assembly, by minimum contig length
+CONTIG_LENGTH_TIERS = [1000, 2500]
 
 
 @dataclass_json
 @dataclass
-class MegaHitInput:
-    read_data: Sample
+class AssemblySettings:
     min_count: int
     k_min: int
     k_max: int
     k_step: int
     min_contig_len: int
+    length_tiers: List[int]
+    stats_mode: AssemblyStatsMode
+
+
+@dataclass_json
+@dataclass
+class MegaHitInput:
+    read_data: Sample
+    # AssemblySettings, one file for every sample of the run
+    settings: LatchFile
+
+
+@dataclass_json
+@dataclass
+class ContigTier:
+    min_length: int
+    contigs: LatchFile
 
 
 @dataclass_json
@@ -30,6 +61,36 @@ class MegaHitInput:
 class MegaHitOut:
     sample_name: str
     assembly_data: LatchFile
+    # Block-compressed (BGZF) copy of assembly_data with its indexes, for
+    # reading single contigs with samtools faidx
+    contig_store: LatchFile
+    contig_index: LatchFile
+    contig_block_index: LatchFile
+    contig_tiers: List[ContigTier]
+    metrics: List[TaskMetrics]
+
+
+def contigs_for(assembly: MegaHitOut, min_length: int) -> LatchFile:
+    """The smallest contig subset that holds every contig of ``min_length``"""
+    usable = [tier for tier in assembly.contig_tiers if tier.min_length <= min_length]
+    if not usable:
+        return assembly.assembly_data
+    return max(usable, key=lambda tier: tier.min_length).contigs
+
+
+@dataclass_json
+@dataclass
+class EvaluationInput:
+    megahit_out: MegaHitOut
+    settings: LatchFile
+
+
+@dataclass_json
+@dataclass
+class EvaluationOut:
+    sample_name: str
+    evaluation: LatchDir
+    metrics: List[TaskMetrics]
 
 
 @dataclass_json
@@ -38,80 +99,150 @@ class AssemblyOut(MegaHitOut):
     evaluation: LatchDir
 
 
-@small_task
-def organize_megahit_inputs(
-    samples: List[Sample],
+@small_task(container_image=GLUE)
+def organize_assembly_settings(
     min_count: int,
     k_min: int,
     k_max: int,
     k_step: int,
     min_contig_len: int,
-) -> List[MegaHitInput]:
-
-    inputs = []
-    for sample in samples:
-        cur_input = MegaHitInput(
-            read_data=sample,
+    length_tiers: List[int],
+    stats_mode: AssemblyStatsMode,
+) -> LatchFile:
+    return write_settings(
+        AssemblySettings(
             min_count=min_count,
             k_min=k_min,
             k_max=k_max,
             k_step=k_step,
             min_contig_len=min_contig_len,
+            length_tiers=length_tiers,
+            stats_mode=stats_mode,
         )
+    )
+
+
+@small_task(container_image=GLUE)
+def organize_megahit_inputs(
+    samples: List[Sample], settings: LatchFile
+) -> List[MegaHitInput]:
+
+    inputs = []
+    for sample in samples:
+        cur_input = MegaHitInput(read_data=sample, settings=settings)
 
         inputs.append(cur_input)
 
     return inputs
 
 
-@large_task
+def _megahit_element(megahit_input: MegaHitInput) -> str:
+    return megahit_input.read_data.sample_name
+
+
+@large_task(container_image=ASSEMBLY)
+@records_out_of_memory(_megahit_element)
 def megahit(megahit_input: MegaHitInput) -> MegaHitOut:
 
     sample_name = megahit_input.read_data.sample_name
+    settings = read_settings(AssemblySettings, megahit_input.settings)
     output_dir_name = f"{sample_name}_MEGAHIT"
 
     _megahit_cmd = [
         "/root/megahit",
         "--min-count",
-        str(megahit_input.min_count),
+        str(settings.min_count),
         "--k-min",
-        str(megahit_input.k_min),
+        str(settings.k_min),
         "--k-max",
-        str(megahit_input.k_max),
+        str(settings.k_max),
         "--k-step",
-        str(megahit_input.k_step),
+        str(settings.k_step),
         "--out-dir",
         output_dir_name,
         "--out-prefix",
         sample_name,
         "--min-contig-len",
-        str(megahit_input.min_contig_len),
+        str(settings.min_contig_len),
         "-1",
         megahit_input.read_data.read1.local_path,
         "-2",
         megahit_input.read_data.read2.local_path,
     ]
 
-    subprocess.run(_megahit_cmd)
-
     megahit_output = Path(output_dir_name, f"{sample_name}.contigs.fa").resolve()
 
+    run(_megahit_cmd, outputs=[megahit_output])
+
+    # Consumers that skip short contigs get a pre-filtered copy instead of
+    # each reading the whole assembly
+    contig_files = contig_index.index_and_tiers(
+        megahit_output, settings.length_tiers, megahit_output.parent
+    )
+    remote_dir = f"{output_prefix(sample_name)}/MEGAHIT"
+
+    def remote(path: Path) -> LatchFile:
+        return LatchFile(str(path), f"{remote_dir}/{path.name}")
+
     return MegaHitOut(
         sample_name=sample_name,
-        assembly_data=LatchFile(
-            str(megahit_output),
-            f"latch:///metamage/{sample_name}/MEGAHIT/{sample_name}.contigs.fa",
-        ),
+        assembly_data=remote(megahit_output),
+        contig_store=remote(contig_files.store),
+        contig_index=remote(contig_files.index),
+        contig_block_index=remote(contig_files.block_index),
+        contig_tiers=[
+            ContigTier(
+                min_length=tier,
+                contigs=remote(path),
+            )
+            for tier, path in contig_files.tiers.items()
+        ],
+        metrics=[
+            collect(
+                sample_name,
+                "megahit",
+                read_bytes=file_sizes(
+                    megahit_input.read_data.read1.local_path,
+                    megahit_input.read_data.read2.local_path,
+                ),
+            )
+        ],
     )
 
 
-@small_task
-def metaquast(megahit_out: MegaHitOut) -> LatchDir:
+@high_memory_task(container_image=ASSEMBLY)
+def megahit_retry(megahit_input: MegaHitInput) -> MegaHitOut:
+    """megahit on a high-memory node, for samples that ran out of memory"""
+    return megahit.task_function(megahit_input)
+
+
+@small_task(container_image=GLUE)
+def failed_megahit_inputs(
+    inputs: List[MegaHitInput], results: List[Optional[MegaHitOut]]
+) -> List[MegaHitInput]:
+    return out_of_memory_inputs(megahit, inputs, results, _megahit_element)
+
+
+@small_task(container_image=GLUE)
+def merge_megahit_outs(
+    results: List[Optional[MegaHitOut]],
+    retried_results: List[Optional[MegaHitOut]],
+) -> List[MegaHitOut]:
+    return present(results + retried_results)
 
-    print(megahit_out.assembly_data.local_path)
-    sample_name = megahit_out.sample_name
-    assembly_fasta = megahit_out.assembly_data.local_path
 
+@small_task(container_image=GLUE)
+def organize_evaluation_inputs(
+    megahit_outs: List[MegaHitOut], settings: LatchFile
+) -> List[EvaluationInput]:
+
+    return [
+        EvaluationInput(megahit_out=megahit_out, settings=settings)
+        for megahit_out in megahit_outs
+    ]
+
+
+def _metaquast(sample_name: str, assembly_fasta: str) -> Path:
     output_dir_name = f"{sample_name}_MetaQuast"
     output_dir = Path(output_dir_name).resolve()
 
@@ -128,24 +259,87 @@ def metaquast(megahit_out: MegaHitOut) -> LatchDir:
         str(assembly_fasta),
     ]
 
-    subprocess.run(_metaquast_cmd)
+    run(_metaquast_cmd, outputs=[output_dir.joinpath("report.tsv")])
+
+    return output_dir
+
+
+def _evaluation_element(evaluation_input: EvaluationInput) -> str:
+    return evaluation_input.megahit_out.sample_name
+
+
+@small_task(container_image=ASSEMBLY)
+@records_out_of_memory(_evaluation_element)
+def evaluate_assembly(evaluation_input: EvaluationInput) -> EvaluationOut:
+    """Assembly statistics, or a full MetaQuast evaluation if requested"""
+
+    megahit_out = evaluation_input.megahit_out
+    sample_name = megahit_out.sample_name
+    assembly_fasta = megahit_out.assembly_data.local_path
 
-    return LatchDir(str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}")
+    settings = read_settings(AssemblySettings, evaluation_input.settings)
+    if settings.stats_mode == AssemblyStatsMode.metaquast:
+        stage = "metaquast"
+        output_dir = _metaquast(sample_name, assembly_fasta)
+    else:
+        stage = "assembly_stats"
+        output_dir = assembly_stats.write_report(
+            assembly_stats.assembly_stats(assembly_fasta),
+            sample_name,
+            Path(f"{sample_name}_AssemblyStats").resolve(),
+        )
 
+    return EvaluationOut(
+        sample_name=sample_name,
+        evaluation=LatchDir(
+            str(output_dir), f"{output_prefix(sample_name)}/{output_dir.name}"
+        ),
+        metrics=[
+            collect(sample_name, stage, assembly_bytes=file_sizes(assembly_fasta))
+        ],
+    )
+
+
+@medium_task(container_image=ASSEMBLY)
+def evaluate_assembly_retry(evaluation_input: EvaluationInput) -> EvaluationOut:
+    """evaluate_assembly on a bigger node, for samples that ran out of memory"""
+    return evaluate_assembly.task_function(evaluation_input)
+
+
+@small_task(container_image=GLUE)
+def failed_evaluation_inputs(
+    inputs: List[EvaluationInput], results: List[Optional[EvaluationOut]]
+) -> List[EvaluationInput]:
+    return out_of_memory_inputs(
+        evaluate_assembly, inputs, results, _evaluation_element
+    )
 
-@small_task
+
+@small_task(container_image=GLUE)
 def organize_assembly_outs(
-    megahit_outs: List[MegaHitOut], metaquast_results: List[LatchDir]
+    megahit_outs: List[MegaHitOut],
+    metaquast_results: List[Optional[EvaluationOut]],
+    retried_results: List[Optional[EvaluationOut]],
 ) -> List[AssemblyOut]:
 
     outs = []
 
-    for assembly, evaluation in zip(megahit_outs, metaquast_results):
+    evaluations = by_sample(metaquast_results + retried_results)
+    for assembly in megahit_outs:
+        evaluation = evaluations.get(assembly.sample_name)
+        if evaluation is None:
+            # Failed on both attempts, the sample drops out here
+            continue
 
         cur_out = AssemblyOut(
             sample_name=assembly.sample_name,
             assembly_data=assembly.assembly_data,
-            evaluation=evaluation,
+            contig_store=assembly.contig_store,
+            contig_index=assembly.contig_index,
+            contig_block_index=assembly.contig_block_index,
+            contig_tiers=assembly.contig_tiers,
+            evaluation=evaluation.evaluation,
+            metrics=assembly.metrics + evaluation.metrics,
         )
         outs.append(cur_out)
 
@@ -160,22 +354,53 @@ def assembly_wf(
     k_max: int,
     k_step: int,
     min_contig_len: int,
+    stats_mode: AssemblyStatsMode = AssemblyStatsMode.fast,
+    contig_length_tiers: List[int] = CONTIG_LENGTH_TIERS,
 ) -> List[AssemblyOut]:
 
-    megahit_inputs = organize_megahit_inputs(
-        samples=samples,
+    settings = organize_assembly_settings(
         min_count=min_count,
         k_min=k_min,
         k_max=k_max,
         k_step=k_step,
         min_contig_len=min_contig_len,
+        length_tiers=contig_length_tiers,
+        stats_mode=stats_mode,
     )
 
+    megahit_inputs = organize_megahit_inputs(samples=samples, settings=settings)
+
     # Assembly
-    assembly_data = map_task(megahit)(megahit_input=megahit_inputs)
+    first_assembly_data = batch_map(megahit)(megahit_input=megahit_inputs)
+
+    # Samples that ran out of memory get one more try on a bigger node
+    assembly_data = merge_megahit_outs(
+        results=first_assembly_data,
+        retried_results=batch_map(megahit_retry)(
+            megahit_input=failed_megahit_inputs(
+                inputs=megahit_inputs, results=first_assembly_data
+            )
+        ),
+    )
+
+    evaluation_inputs = organize_evaluation_inputs(
+        megahit_outs=assembly_data, settings=settings
+    )
+
+    metaquast_results = batch_map(evaluate_assembly)(
+        evaluation_input=evaluation_inputs
+    )
 
-    metaquast_results = map_task(metaquast)(megahit_out=assembly_data)
+    # Samples that ran out of memory get one more try on a bigger node
+    failed_evaluations = failed_evaluation_inputs(
+        inputs=evaluation_inputs, results=metaquast_results
+    )
+    retried_results = batch_map(evaluate_assembly_retry)(
+        evaluation_input=failed_evaluations
+    )
 
     return organize_assembly_outs(
-        megahit_outs=assembly_data, metaquast_results=metaquast_results
+        megahit_outs=assembly_data,
+        metaquast_results=metaquast_results,
+        retried_results=retried_results,
     )
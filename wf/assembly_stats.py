@@ -0,0 +1,110 @@
+"""
+Assembly statistics in one streaming pass over a contigs FASTA
+"""
+
+import json
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Union
+
+# Same thresholds as the "# contigs (>= x bp)" rows of a QUAST report
+LENGTH_THRESHOLDS = [0, 1000, 5000, 10000, 25000, 50000]
+# Lower bounds of the contig length histogram bins
+LENGTH_BINS = [0, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000]
+GC_BIN_WIDTH = 5
+NX = [50, 75, 90]
+
+
+def _contig_lengths_and_gc(fasta: BinaryIO):
+    """(length, G+C count) of every record, sequence lines may be wrapped"""
+    length = gc = 0
+    in_record = False
+    for line in fasta:
+        if line.startswith(b">"):
+            if in_record:
+                yield length, gc
+            length = gc = 0
+            in_record = True
+            continue
+        line = line.rstrip()
+        length += len(line)
+        gc += (
+            line.count(b"G") + line.count(b"C") + line.count(b"g") + line.count(b"c")
+        )
+    if in_record:
+        yield length, gc
+
+
+def assembly_stats(fasta_path: Union[str, Path]) -> Dict:
+    lengths = array("Q")
+    length_hist = [0] * len(LENGTH_BINS)
+    gc_hist = [0] * (100 // GC_BIN_WIDTH + 1)
+    total_gc = 0
+
+    with open(fasta_path, "rb") as fasta:
+        for length, gc in _contig_lengths_and_gc(fasta):
+            lengths.append(length)
+            total_gc += gc
+            length_hist[bisect_right(LENGTH_BINS, length) - 1] += 1
+            if length:
+                gc_hist[int(100 * gc / length) // GC_BIN_WIDTH] += 1
+
+    ordered = sorted(lengths, reverse=True)
+    total_length = sum(ordered)
+
+    stats: Dict = {
+        "contigs": len(ordered),
+        "total_length": total_length,
+        "largest_contig": ordered[0] if ordered else 0,
+        "gc_percent": round(100 * total_gc / total_length, 2) if total_length else 0.0,
+    }
+
+    # One walk down the sorted lengths finds every Nx/Lx
+    targets = [(x, total_length * x / 100) for x in NX]
+    running = 0
+    for count, length in enumerate(ordered, start=1):
+        running += length
+        while targets and running >= targets[0][1]:
+            x, _ = targets.pop(0)
+            stats[f"N{x}"] = length
+            stats[f"L{x}"] = count
+    for x, _ in targets:
+        stats[f"N{x}"] = stats[f"L{x}"] = 0
+
+    for threshold in LENGTH_THRESHOLDS:
+        above = [length for length in ordered if length >= threshold]
+        stats[f"contigs_ge_{threshold}"] = len(above)
+        stats[f"total_length_ge_{threshold}"] = sum(above)
+
+    stats["length_histogram"] = {
+        f">={low}": n for low, n in zip(LENGTH_BINS, length_hist)
+    }
+    stats["gc_histogram"] = {
+        f"{low}-{low + GC_BIN_WIDTH}": n
+        for low, n in zip(range(0, 101, GC_BIN_WIDTH), gc_hist)
+    }
+    return stats
+
+
+def _tsv_rows(stats: Dict) -> List[List[str]]:
+    rows = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            rows.extend([f"{key} {k}", str(v)] for k, v in value.items())
+        else:
+            rows.append([key, str(value)])
+    return rows
+
+
+def write_report(stats: Dict, sample_name: str, out_dir: Path) -> Path:
+    """Write report.json and a QUAST-style transposed report.tsv"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_dir.joinpath("report.json").write_text(
+        json.dumps({"assembly": sample_name, **stats}, indent=2)
+    )
+    with open(out_dir.joinpath("report.tsv"), "w") as f:
+        f.write(f"Assembly\t{sample_name}\n")
+        for key, value in _tsv_rows(stats):
+            f.write(f"{key}\t{value}\n")
+    return out_dir
@@ -0,0 +1,151 @@
+"""
+Batch controls for map tasks: concurrency caps, partial success and
+retries of the elements that ran out of memory
+
+Latch registers workflows ahead of time, so these limits are part of the
+workflow definition rather than run parameters.
+"""
+
+import functools
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar
+
+from flytekit.core.context_manager import FlyteContextManager
+from latch import map_task
+from latch.resources.tasks import custom_task
+
+from .runner import OutOfMemoryError
+
+T = TypeVar("T")
+
+# Most elements of a stage that run at once, so a large batch does not
+# claim every node of the cluster. Stages on large nodes get lower caps.
+MAP_CONCURRENCY: Dict[str, int] = {
+    "megahit": 16,
+    "map_reads": 16,
+    "metabat2": 16,
+    "taxonomy_classification_task": 16,
+    "split_kaiju_reads": 32,
+    "prodigal": 32,
+    "annotate_colocated": 32,
+    "subsample_reads": 32,
+    # Retries of the stages above, on the scarcer high-memory nodes
+    "megahit_retry": 4,
+    "map_reads_retry": 4,
+    "metabat2_retry": 4,
+    "taxonomy_classification_task_retry": 4,
+    "prodigal_retry": 8,
+}
+DEFAULT_CONCURRENCY = 64
+
+# A stage fails the run only if fewer than this share of its elements
+# succeed. The failed samples' outputs are None, they are left out of
+# later stages and reported in the run's batch status.
+MIN_SUCCESS_RATIO = 0.9
+
+# Stages that already run on a large node are retried on this one, with
+# about 2.5 times its memory, when they run out of memory
+high_memory_task = custom_task(cpu=62, memory=480)
+
+# A failed element reaches the workflow as None, without its cause, so tasks
+# leave a marker here when a tool runs out of memory, and only the elements
+# with one are retried on a bigger node. The local executor points the
+# variable at a directory of its own.
+OOM_MARKERS = "latch:///metamage/.out_of_memory"
+OOM_MARKERS_ENV = "METAMAGE_OOM_MARKERS"
+
+
+def task_name(task) -> str:
+    return getattr(task, "task_function", task).__name__
+
+
+def batch_map(task):
+    """``map_task(task)`` with the stage's concurrency cap and success ratio"""
+    return map_task(
+        task,
+        concurrency=MAP_CONCURRENCY.get(task_name(task), DEFAULT_CONCURRENCY),
+        min_success_ratio=MIN_SUCCESS_RATIO,
+    )
+
+
+def failed_inputs(inputs: List[T], results: List[Optional[object]]) -> List[T]:
+    """The inputs whose elements failed, given a map task's inputs and outputs"""
+    return [input for input, result in zip(inputs, results) if result is None]
+
+
+def _oom_marker(stage: str, element: str) -> str:
+    context = FlyteContextManager.current_context()
+    # Per execution, so a sample that ran out of memory in an earlier run
+    # is not retried for an unrelated failure in this one
+    execution = context.user_space_params.execution_id.name
+    root = os.environ.get(OOM_MARKERS_ENV, OOM_MARKERS)
+    return f"{root}/{execution}/{stage}/{element}"
+
+
+def sample_element(task_input) -> str:
+    return task_input.sample_name
+
+
+def records_out_of_memory(element: Callable[[T], str] = sample_element):
+    """Leave a marker for ``out_of_memory_inputs`` when the task runs out of memory
+
+    ``element`` names the element from the task's input, the same way for
+    the task and the filter.
+    """
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            except OutOfMemoryError:
+                (task_input,) = (*args, *kwargs.values())
+                marker = Path(tempfile.mkdtemp()).joinpath("out_of_memory")
+                marker.touch()
+                try:
+                    FlyteContextManager.current_context().file_access.put_data(
+                        str(marker), _oom_marker(fn.__name__, element(task_input))
+                    )
+                except Exception:
+                    # The element is then not retried, the error below still
+                    # tells why it failed
+                    pass
+                raise
+
+        return wrapper
+
+    return decorate
+
+
+def _marker_exists(marker: str) -> bool:
+    try:
+        return FlyteContextManager.current_context().file_access.exists(marker)
+    except Exception:
+        # Backends report unsupported or unreachable paths differently
+        return False
+
+
+def out_of_memory_inputs(
+    task,
+    inputs: List[T],
+    results: List[Optional[object]],
+    element: Callable[[T], str] = sample_element,
+) -> List[T]:
+    """The inputs whose elements failed by running out of memory in ``task``"""
+    return [
+        input
+        for input in failed_inputs(inputs, results)
+        if _marker_exists(_oom_marker(task_name(task), element(input)))
+    ]
+
+
+def present(results: Iterable[Optional[T]]) -> List[T]:
+    """The outputs of the elements that succeeded"""
+    return [result for result in results if result is not None]
+
+
+def by_sample(results: Iterable[Optional[T]]) -> Dict[str, T]:
+    """Successful outputs keyed by their sample_name"""
+    return {result.sample_name: result for result in present(results)}
@@ -0,0 +1,98 @@
+"""
+Block-compressed files (BGZF) and their block index
+
+BGZF is a series of gzip members that each hold at most 64 KiB of data,
+so the file stays readable by any gzip tool while a block index maps
+uncompressed offsets to the compressed block they fall in. Blocks are
+independent, so they are compressed in parallel. The block index is
+written in the ``.gzi`` layout of ``bgzip -i``, so ``samtools faidx``
+reads single records from a compressed FASTA through it.
+"""
+
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Optional, Tuple
+
+# Uncompressed bytes per block, as bgzip uses, so even incompressible
+# data fits the 64 KiB block size limit
+BLOCK_DATA_BYTES = 0xFF00
+
+# Several times faster than bgzip's default of 6 on contigs, for files
+# only a few percent larger
+COMPRESS_LEVEL = 4
+
+# Blocks compressed at a time, zlib releases the GIL so they go in parallel
+BATCH_BLOCKS = 64
+
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_FOOTER = struct.Struct("<II")
+_EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# (compressed offset, uncompressed offset) of a block
+BlockOffset = Tuple[int, int]
+
+
+def _block(data: bytes) -> bytes:
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER.size + len(deflated) + _FOOTER.size
+    header = _HEADER.pack(
+        0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, block_size - 1
+    )
+    return header + deflated + _FOOTER.pack(zlib.crc32(data), len(data))
+
+
+class BgzfWriter:
+    """Writes a BGZF file and collects its block offsets for the index"""
+
+    def __init__(self, out: BinaryIO, threads: Optional[int] = None):
+        self.out = out
+        self.pool = ThreadPoolExecutor(max_workers=threads or os.cpu_count())
+        self.buffer = bytearray()
+        self.pending: List[bytes] = []
+        self.compressed = 0
+        self.uncompressed = 0
+        self.blocks: List[BlockOffset] = []
+
+    def write(self, data: bytes):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_DATA_BYTES:
+            self.pending.append(bytes(self.buffer[:BLOCK_DATA_BYTES]))
+            del self.buffer[:BLOCK_DATA_BYTES]
+            if len(self.pending) >= BATCH_BLOCKS:
+                self._flush_pending()
+
+    def writelines(self, lines: Iterable[bytes]):
+        for line in lines:
+            self.write(line)
+
+    def _flush_pending(self):
+        for data, block in zip(self.pending, self.pool.map(_block, self.pending)):
+            self.blocks.append((self.compressed, self.uncompressed))
+            self.out.write(block)
+            self.compressed += len(block)
+            self.uncompressed += len(data)
+        self.pending = []
+
+    def close(self) -> List[BlockOffset]:
+        """Flush the last block and the end marker, returning the block offsets"""
+        if self.buffer:
+            self.pending.append(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._flush_pending()
+        self.out.write(_EOF_BLOCK)
+        self.pool.shutdown()
+        return self.blocks
+
+
+def write_gzi(blocks: List[BlockOffset], path: Path) -> Path:
+    # bgzip leaves out the first block, which always starts at (0, 0)
+    entries = [block for block in blocks if block != (0, 0)]
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(entries)))
+        for compressed, uncompressed in entries:
+            f.write(struct.pack("<QQ", compressed, uncompressed))
+    return path
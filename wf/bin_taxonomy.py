@@ -0,0 +1,259 @@
+"""
+Taxonomy of MetaBAT2 bins from Kaiju classifications of their contigs
+"""
+
+import csv
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+from latch import large_task, small_task, workflow
+from latch.types import LatchFile
+
+from . import taxonomy
+from .batch import batch_map, present
+from .binning import BinningOut
+from .images import CLASSIFICATION, GLUE
+from .runner import run
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import output_prefix
+
+TABLE_COLUMNS = [
+    "bin",
+    "contigs",
+    "length",
+    "taxon_id",
+    "taxon_name",
+    "rank",
+    "lineage",
+    "confidence",
+    "contamination",
+    "classified_fraction",
+]
+
+
+@dataclass_json
+@dataclass
+class BinContigs:
+    sample_name: str
+    # contig, bin, length and Kaiju taxon id of every binned contig
+    contigs: LatchFile
+    metrics: List[TaskMetrics]
+
+
+@dataclass_json
+@dataclass
+class BinTaxonomyInput:
+    bin_contigs: BinContigs
+    taxonomy_index: LatchFile
+
+
+@dataclass_json
+@dataclass
+class BinTaxonomyOut:
+    sample_name: str
+    table: LatchFile
+    metrics: List[TaskMetrics]
+
+
+@small_task(container_image=GLUE)
+def build_taxonomy_index(
+    kaiju_ref_nodes: LatchFile, kaiju_ref_names: LatchFile
+) -> LatchFile:
+    """Index the reference taxonomy once for every sample's bins"""
+
+    index_path = taxonomy.build_index(
+        Path(kaiju_ref_nodes.local_path),
+        Path(kaiju_ref_names.local_path),
+        Path("taxonomy.idx").resolve(),
+    )
+    return LatchFile(str(index_path))
+
+
+def _bin_members(bins_dir: Path, sample_name: str) -> Dict[str, Tuple[str, str]]:
+    """Sequence and bin of every binned contig, from MetaBAT2's bin FASTAs"""
+    members = {}
+    for bin_fasta in sorted(bins_dir.glob(f"{sample_name}.*.fa")):
+        bin_id = bin_fasta.name[len(sample_name) + 1 : -len(".fa")]
+        name, seq = None, []
+        with open(bin_fasta) as f:
+            for line in f:
+                if line.startswith(">"):
+                    if name is not None:
+                        members[name] = (bin_id, "".join(seq))
+                    name, seq = line[1:].split()[0], []
+                else:
+                    seq.append(line.strip())
+        if name is not None:
+            members[name] = (bin_id, "".join(seq))
+    return members
+
+
+@large_task(container_image=CLASSIFICATION)
+def classify_bin_contigs(
+    binning_results: List[BinningOut],
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+) -> List[BinContigs]:
+    """Classify the binned contigs of every sample in one Kaiju run
+
+    Kaiju spends most of its time loading the database, so the samples
+    share one run instead of loading it once per sample.
+    """
+
+    combined = Path("binned_contigs.fa").resolve()
+    samples: List[Tuple[str, Dict[str, Tuple[str, str]]]] = []
+    with open(combined, "w") as f:
+        for i, binning in enumerate(binning_results):
+            members = _bin_members(Path(binning.bins.local_path), binning.sample_name)
+            samples.append((binning.sample_name, members))
+            for name, (_, seq) in members.items():
+                # Contig names repeat across samples
+                f.write(f">{i}|{name}\n{seq}\n")
+
+    classified = Path("binned_contigs.kaiju").resolve()
+    if combined.stat().st_size:
+        run(
+            [
+                "kaiju",
+                "-t",
+                kaiju_ref_nodes.local_path,
+                "-f",
+                kaiju_ref_db.local_path,
+                "-i",
+                str(combined),
+                "-o",
+                str(classified),
+                "-z",
+                "96",
+            ],
+            outputs=[classified],
+        )
+    else:
+        classified.touch()
+
+    taxa: Dict[str, int] = {}
+    with open(classified) as f:
+        for line in f:
+            status, name, taxid = line.rstrip("\n").split("\t")[:3]
+            taxa[name] = int(taxid) if status == "C" else 0
+
+    metrics = collect(
+        "all_samples",
+        "kaiju_contigs",
+        samples=len(samples),
+        contig_bytes=file_sizes(combined),
+    )
+
+    outs = []
+    for i, (sample_name, members) in enumerate(samples):
+        table = Path(f"{sample_name}_bin_contigs.tsv").resolve()
+        with open(table, "w") as f:
+            for name, (bin_id, seq) in members.items():
+                taxid = taxa.get(f"{i}|{name}", 0)
+                f.write(f"{name}\t{bin_id}\t{len(seq)}\t{taxid}\n")
+        outs.append(
+            BinContigs(
+                sample_name=sample_name,
+                contigs=LatchFile(str(table)),
+                # The shared run is reported once, with the first sample
+                metrics=[metrics] if i == 0 else [],
+            )
+        )
+
+    return outs
+
+
+@small_task(container_image=GLUE)
+def organize_bin_taxonomy_inputs(
+    bin_contigs: List[BinContigs], taxonomy_index: LatchFile
+) -> List[BinTaxonomyInput]:
+
+    return [
+        BinTaxonomyInput(bin_contigs=contigs, taxonomy_index=taxonomy_index)
+        for contigs in bin_contigs
+    ]
+
+
+def _bin_order(bin_id: str) -> Tuple[int, str]:
+    return (int(bin_id), "") if bin_id.isdigit() else (1 << 30, bin_id)
+
+
+@small_task(container_image=GLUE)
+def annotate_bins(bin_taxonomy_input: BinTaxonomyInput) -> BinTaxonomyOut:
+    """Length-weighted majority taxonomy of each bin of a sample"""
+
+    bin_contigs = bin_taxonomy_input.bin_contigs
+    sample_name = bin_contigs.sample_name
+    index = taxonomy.TaxonomyIndex(Path(bin_taxonomy_input.taxonomy_index.local_path))
+
+    bins: Dict[str, List[Tuple[int, int]]] = {}
+    with open(bin_contigs.contigs.local_path) as f:
+        for _, bin_id, length, taxid in csv.reader(f, delimiter="\t"):
+            bins.setdefault(bin_id, []).append((int(length), int(taxid)))
+
+    output_name = f"{sample_name}_bin_taxonomy.tsv"
+    table = Path(output_name).resolve()
+    with open(table, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(TABLE_COLUMNS)
+        for bin_id, contigs in sorted(bins.items(), key=lambda kv: _bin_order(kv[0])):
+            result = taxonomy.weighted_lca(contigs, index)
+            known = result.taxon_id in index
+            writer.writerow(
+                [
+                    bin_id,
+                    len(contigs),
+                    sum(length for length, _ in contigs),
+                    result.taxon_id,
+                    index.name(result.taxon_id) if known else "unclassified",
+                    index.rank(result.taxon_id) if known else "",
+                    index.ranked_lineage(result.taxon_id) if known else "",
+                    result.confidence,
+                    result.contamination,
+                    result.classified_fraction,
+                ]
+            )
+
+    return BinTaxonomyOut(
+        sample_name=sample_name,
+        table=LatchFile(
+            str(table), f"{output_prefix(sample_name)}/bin_taxonomy/{output_name}"
+        ),
+        metrics=bin_contigs.metrics
+        + [collect(sample_name, "bin_taxonomy", bins=len(bins))],
+    )
+
+
+@small_task(container_image=GLUE)
+def organize_bin_taxonomy_outs(
+    results: List[Optional[BinTaxonomyOut]],
+) -> List[BinTaxonomyOut]:
+    return present(results)
+
+
+@workflow
+def bin_taxonomy_wf(
+    binning_results: List[BinningOut],
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+) -> List[BinTaxonomyOut]:
+
+    taxonomy_index = build_taxonomy_index(
+        kaiju_ref_nodes=kaiju_ref_nodes, kaiju_ref_names=kaiju_ref_names
+    )
+
+    bin_contigs = classify_bin_contigs(
+        binning_results=binning_results,
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+    )
+
+    inputs = organize_bin_taxonomy_inputs(
+        bin_contigs=bin_contigs, taxonomy_index=taxonomy_index
+    )
+    results = batch_map(annotate_bins)(bin_taxonomy_input=inputs)
+
+    return organize_bin_taxonomy_outs(results=results)
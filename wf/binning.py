@@ -1,15 +1,32 @@
-import subprocess
+import shutil
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
-from random import sample
-from typing import List
+from typing import List, Optional
 
 from dataclasses_json import dataclass_json
-from latch import large_task, map_task, message, small_task, workflow
+from latch import large_task, message, small_task, workflow
 from latch.types import LatchDir, LatchFile
 
-from .assembly import AssemblyOut
-from .types import Sample
+from .assembly import AssemblyOut, contigs_for
+from .batch import (
+    batch_map,
+    by_sample,
+    high_memory_task,
+    out_of_memory_inputs,
+    present,
+    records_out_of_memory,
+)
+from .coschedule import available_memory_kb
+from .images import BINNING, GLUE
+from .mapping import MAPPERS, scratch_dir, sort_cmd, sort_memory
+from .runner import run, run_pipeline
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import ReadMapper, Sample, output_prefix
+
+# MetaBAT2 skips contigs shorter than this (its --minContig default), so
+# neither it nor the read mapping for its depth file needs them
+BINNING_MIN_CONTIG = 2500
 
 
 @dataclass_json
@@ -17,6 +34,7 @@ from .types import Sample
 class BwAlignInput:
     assembly_data: LatchFile
     read_data: Sample
+    read_mapper: ReadMapper = ReadMapper.bowtie2
 
 
 @dataclass_json
@@ -24,6 +42,15 @@ class BwAlignInput:
 class JgiInput:
     assembly_bam: LatchFile
     sample_name: str
+    metrics: List[TaskMetrics]
+
+
+@dataclass_json
+@dataclass
+class DepthOut:
+    sample_name: str
+    depth_file: LatchFile
+    metrics: List[TaskMetrics]
 
 
 @dataclass_json
@@ -32,17 +59,36 @@ class MetaBatInput:
     sample_name: str
     assembly_data: LatchFile
     depth_file: LatchFile
+    metrics: List[TaskMetrics]
 
 
-@small_task
+@dataclass_json
+@dataclass
+class BinningOut:
+    sample_name: str
+    bins: LatchDir
+    metrics: List[TaskMetrics]
+
+
+@small_task(container_image=GLUE)
 def organize_bw_inputs(
-    assembly_outs: List[AssemblyOut], samples: List[Sample]
+    assembly_outs: List[AssemblyOut],
+    samples: List[Sample],
+    read_mapper: ReadMapper = ReadMapper.bowtie2,
 ) -> List[BwAlignInput]:
 
+    assemblies = by_sample(assembly_outs)
+
     inputs = []
-    for sample, assembly_out in zip(samples, assembly_outs):
+    for sample in samples:
+        assembly_out = assemblies.get(sample.sample_name)
+        if assembly_out is None:
+            # The sample failed to assemble
+            continue
         cur_input = BwAlignInput(
-            assembly_data=assembly_out.assembly_data, read_data=sample
+            assembly_data=contigs_for(assembly_out, BINNING_MIN_CONTIG),
+            read_data=sample,
+            read_mapper=read_mapper,
         )
 
         inputs.append(cur_input)
@@ -50,96 +96,110 @@ def organize_bw_inputs(
     return inputs
 
 
-@large_task
-def run_bowtie(bwalign_input: BwAlignInput) -> LatchFile:
+def _mapping_element(bwalign_input: BwAlignInput) -> str:
+    return bwalign_input.read_data.sample_name
+
+
+@large_task(container_image=BINNING)
+@records_out_of_memory(_mapping_element)
+def map_reads(bwalign_input: BwAlignInput) -> JgiInput:
 
     sample_name = bwalign_input.read_data.sample_name
+    mapper = MAPPERS[bwalign_input.read_mapper]
 
     assembly_fasta = Path(bwalign_input.assembly_data.local_path)
 
     output_dir_name = f"{sample_name}_assembly_idx"
     output_dir = Path(output_dir_name).resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
+    index_prefix = output_dir.joinpath(sample_name)
 
-    _bt_idx_cmd = [
-        "bowtie2/bowtie2-build",
-        str(assembly_fasta),
-        f"{str(output_dir)}/{sample_name}",
-        "--threads",
-        "31",
-    ]
-
-    subprocess.run(_bt_idx_cmd)
+    for _index_cmd in mapper.index(assembly_fasta, index_prefix, 31):
+        run(_index_cmd, outputs=[output_dir])
 
     output_file_name = f"{sample_name}_assembly_sorted.bam"
 
     output_file = Path(output_file_name).resolve()
 
-    _bt_cmd = [
-        "bowtie2/bowtie2",
-        "-x",
-        f"{str(output_dir)}/{sample_name}",
-        "-1",
+    _map_cmd = mapper.align(
+        assembly_fasta,
+        index_prefix,
         bwalign_input.read_data.read1.local_path,
-        "-2",
         bwalign_input.read_data.read2.local_path,
-        "--threads",
-        "31",
-    ]
-
-    bt_align_out = subprocess.Popen(
-        _bt_cmd,
-        stdout=subprocess.PIPE,
+        31,
     )
 
-    _sam_convert_cmd = [
-        "samtools",
-        "view",
-        "-@",
-        "31",
-        "-bS",
-    ]
-
-    sam_convert_out = subprocess.Popen(
-        _sam_convert_cmd, stdin=bt_align_out.stdout, stdout=subprocess.PIPE
+    read_bytes = file_sizes(
+        bwalign_input.read_data.read1.local_path,
+        bwalign_input.read_data.read2.local_path,
     )
-
-    _sam_sort_cmd = [
-        "samtools",
-        "sort",
-        "-@",
-        "31",
-        "-o",
-        output_file_name,
-    ]
-
-    subprocess.run(
-        _sam_sort_cmd,
-        stdin=sam_convert_out.stdout,
+    sort_threads, sort_memory_per_thread = sort_memory(31, available_memory_kb())
+    # Spill files take about as much room as the compressed reads
+    spill_dir = Path(
+        tempfile.mkdtemp(prefix=f"{sample_name}_sort_", dir=scratch_dir(read_bytes))
+    )
+    try:
+        stages = run_pipeline(
+            [
+                _map_cmd,
+                sort_cmd(output_file, sort_threads, sort_memory_per_thread, spill_dir),
+            ],
+            outputs=[output_file],
+        )
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    message(
+        "info",
+        {
+            "title": f"Read mapping for {sample_name}",
+            "body": "\n".join(
+                f"{stage.tool}: {stage.wall_time:.0f} s,"
+                f" {stage.throughput_mb_s} MB/s in"
+                for stage in stages
+            ),
+        },
     )
 
-    return LatchFile(
-        str(output_file), f"latch:///metamage/{sample_name}/{output_file_name}"
+    return JgiInput(
+        sample_name=sample_name,
+        assembly_bam=LatchFile(
+            str(output_file), f"{output_prefix(sample_name)}/{output_file_name}"
+        ),
+        metrics=[
+            collect(
+                sample_name,
+                "read_mapping",
+                read_bytes=read_bytes,
+                assembly_bytes=file_sizes(assembly_fasta),
+            )
+        ],
     )
 
 
-@small_task
-def organize_jgi_inputs(
-    samples: List[Sample], assembly_bams: List[LatchFile]
-) -> List[JgiInput]:
+@high_memory_task(container_image=BINNING)
+def map_reads_retry(bwalign_input: BwAlignInput) -> JgiInput:
+    """map_reads on a high-memory node, for samples that ran out of memory"""
+    return map_reads.task_function(bwalign_input)
 
-    jgi_ins = []
 
-    for sample, assembly_bam in zip(samples, assembly_bams):
+@small_task(container_image=GLUE)
+def failed_mapping_inputs(
+    inputs: List[BwAlignInput], results: List[Optional[JgiInput]]
+) -> List[BwAlignInput]:
+    return out_of_memory_inputs(map_reads, inputs, results, _mapping_element)
 
-        cur_jgi_in = JgiInput(sample_name=sample.sample_name, assembly_bam=assembly_bam)
-        jgi_ins.append(cur_jgi_in)
 
-    return jgi_ins
+@small_task(container_image=GLUE)
+def organize_depth_inputs(
+    jgi_inputs: List[Optional[JgiInput]], retried_jgi_inputs: List[Optional[JgiInput]]
+) -> List[JgiInput]:
+    return present(jgi_inputs + retried_jgi_inputs)
 
 
-@small_task
-def summarize_contig_depths(jgi_input: JgiInput) -> LatchFile:
+@small_task(container_image=BINNING)
+@records_out_of_memory()
+def summarize_contig_depths(jgi_input: JgiInput) -> DepthOut:
 
     sample_name = jgi_input.sample_name
     output_file_name = f"{sample_name}_depths.txt"
@@ -152,33 +212,65 @@ def summarize_contig_depths(jgi_input: JgiInput) -> LatchFile:
         jgi_input.assembly_bam.local_path,
     ]
 
-    subprocess.run(_jgi_cmd)
-
-    return LatchFile(
-        str(output_file), f"latch:///metamage/{sample_name}/{output_file_name}"
+    run(_jgi_cmd, outputs=[output_file])
+
+    return DepthOut(
+        sample_name=sample_name,
+        depth_file=LatchFile(
+            str(output_file), f"{output_prefix(sample_name)}/{output_file_name}"
+        ),
+        metrics=jgi_input.metrics
+        + [
+            collect(
+                sample_name,
+                "contig_depths",
+                bam_bytes=file_sizes(jgi_input.assembly_bam.local_path),
+            )
+        ],
     )
 
 
-@small_task
+@large_task(container_image=BINNING)
+def summarize_contig_depths_retry(jgi_input: JgiInput) -> DepthOut:
+    """summarize_contig_depths on a bigger node, for samples that ran out of memory"""
+    return summarize_contig_depths.task_function(jgi_input)
+
+
+@small_task(container_image=GLUE)
+def failed_depth_inputs(
+    inputs: List[JgiInput], results: List[Optional[DepthOut]]
+) -> List[JgiInput]:
+    return out_of_memory_inputs(summarize_contig_depths, inputs, results)
+
+
+@small_task(container_image=GLUE)
 def organize_metabat_inputs(
     assembly_data: List[AssemblyOut],
-    depth_files: List[LatchFile],
+    depth_files: List[Optional[DepthOut]],
+    retried_depth_files: List[Optional[DepthOut]],
 ) -> List[MetaBatInput]:
 
+    depths = by_sample(depth_files + retried_depth_files)
+
     inputs = []
-    for assembly, depth_file in zip(assembly_data, depth_files):
+    for assembly in assembly_data:
+        depth = depths.get(assembly.sample_name)
+        if depth is None:
+            continue
         cur_input = MetaBatInput(
             sample_name=assembly.sample_name,
-            assembly_data=assembly.assembly_data,
-            depth_file=depth_file,
+            assembly_data=contigs_for(assembly, BINNING_MIN_CONTIG),
+            depth_file=depth.depth_file,
+            metrics=depth.metrics,
         )
         inputs.append(cur_input)
 
     return inputs
 
 
-@large_task
-def metabat2(metabat_input: MetaBatInput) -> LatchDir:
+@large_task(container_image=BINNING)
+@records_out_of_memory()
+def metabat2(metabat_input: MetaBatInput) -> BinningOut:
 
     sample_name = metabat_input.sample_name
     assembly_fasta = Path(metabat_input.assembly_data.local_path)
@@ -189,6 +281,8 @@ def metabat2(metabat_input: MetaBatInput) -> LatchDir:
     _metabat_cmd = [
         "metabat2",
         "--saveCls",
+        "--minContig",
+        str(BINNING_MIN_CONTIG),
         "-i",
         str(assembly_fasta),
         "-a",
@@ -197,28 +291,81 @@ def metabat2(metabat_input: MetaBatInput) -> LatchDir:
         output_dir_name,
     ]
 
-    subprocess.run(_metabat_cmd)
+    run(_metabat_cmd, outputs=[Path(output_dir_name).resolve()])
 
-    return LatchDir(str(output_dir), f"latch:///metamage/{sample_name}/METABAT/")
+    return BinningOut(
+        sample_name=sample_name,
+        bins=LatchDir(str(output_dir), f"{output_prefix(sample_name)}/METABAT/"),
+        metrics=metabat_input.metrics
+        + [collect(sample_name, "metabat2", assembly_bytes=file_sizes(assembly_fasta))],
+    )
 
 
-@workflow
-def binning_wf(samples: List[Sample], megahit_out: List[AssemblyOut]) -> List[LatchDir]:
+@high_memory_task(container_image=BINNING)
+def metabat2_retry(metabat_input: MetaBatInput) -> BinningOut:
+    """metabat2 on a high-memory node, for samples that ran out of memory"""
+    return metabat2.task_function(metabat_input)
+
 
-    bwalign_inputs = organize_bw_inputs(assembly_outs=megahit_out, samples=samples)
+@small_task(container_image=GLUE)
+def failed_metabat_inputs(
+    inputs: List[MetaBatInput], results: List[Optional[BinningOut]]
+) -> List[MetaBatInput]:
+    return out_of_memory_inputs(metabat2, inputs, results)
+
+
+@small_task(container_image=GLUE)
+def organize_binning_outs(
+    binning_results: List[Optional[BinningOut]],
+    retried_binning_results: List[Optional[BinningOut]],
+) -> List[BinningOut]:
+    return present(binning_results + retried_binning_results)
+
+
+@workflow
+def binning_wf(
+    samples: List[Sample],
+    megahit_out: List[AssemblyOut],
+    read_mapper: ReadMapper = ReadMapper.bowtie2,
+) -> List[BinningOut]:
+
+    bwalign_inputs = organize_bw_inputs(
+        assembly_outs=megahit_out, samples=samples, read_mapper=read_mapper
+    )
 
     # Binning preparation
-    aligned_to_assembly = map_task(run_bowtie)(bwalign_input=bwalign_inputs)
+    jgi_inputs = batch_map(map_reads)(bwalign_input=bwalign_inputs)
 
-    jgi_inputs = organize_jgi_inputs(samples=samples, assembly_bams=aligned_to_assembly)
+    # Samples that ran out of memory get one more try on a bigger node
+    retried_jgi_inputs = batch_map(map_reads_retry)(
+        bwalign_input=failed_mapping_inputs(inputs=bwalign_inputs, results=jgi_inputs)
+    )
+
+    depth_inputs = organize_depth_inputs(
+        jgi_inputs=jgi_inputs, retried_jgi_inputs=retried_jgi_inputs
+    )
+    depth_files = batch_map(summarize_contig_depths)(jgi_input=depth_inputs)
 
-    depth_files = map_task(summarize_contig_depths)(jgi_input=jgi_inputs)
+    failed_depths = failed_depth_inputs(inputs=depth_inputs, results=depth_files)
+    retried_depth_files = batch_map(summarize_contig_depths_retry)(
+        jgi_input=failed_depths
+    )
 
     metabat_inputs = organize_metabat_inputs(
-        assembly_data=megahit_out, depth_files=depth_files
+        assembly_data=megahit_out,
+        depth_files=depth_files,
+        retried_depth_files=retried_depth_files,
     )
 
     # Binning
-    binning_results = map_task(metabat2)(metabat_input=metabat_inputs)
+    binning_results = batch_map(metabat2)(metabat_input=metabat_inputs)
+    retried_binning_results = batch_map(metabat2_retry)(
+        metabat_input=failed_metabat_inputs(
+            inputs=metabat_inputs, results=binning_results
+        )
+    )
 
-    return binning_results
+    return organize_binning_outs(
+        binning_results=binning_results,
+        retried_binning_results=retried_binning_results,
+    )
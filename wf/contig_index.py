@@ -0,0 +1,100 @@
+"""
+Block-compressed copy, FASTA index and length-filtered subsets of an
+assembly, in one pass
+"""
+
+from contextlib import ExitStack
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Tuple
+
+from . import bgzf
+
+Record = Tuple[bytes, int, List[bytes]]
+
+
+class ContigFiles(NamedTuple):
+    # BGZF copy of the assembly, its samtools faidx index and block index
+    store: Path
+    index: Path
+    block_index: Path
+    # Subsets by minimum contig length
+    tiers: Dict[int, Path]
+
+
+def _records(fasta: BinaryIO) -> Iterator[Tuple[int, Record]]:
+    """(header offset, (name, sequence length, raw lines)) of every record"""
+    offset = 0
+    start = 0
+    name = None
+    lines: List[bytes] = []
+    length = 0
+
+    for line in fasta:
+        if line.startswith(b">"):
+            if name is not None:
+                yield start, (name, length, lines)
+            start = offset
+            name = line[1:].split()[0]
+            lines = [line]
+            length = 0
+        elif name is not None:
+            lines.append(line)
+            length += len(line.rstrip(b"\r\n"))
+        offset += len(line)
+
+    if name is not None:
+        yield start, (name, length, lines)
+
+
+def index_and_tiers(fasta_path: Path, tiers: List[int], out_dir: Path) -> ContigFiles:
+    """Write ``<fasta>.gz`` with its indexes and a ``<stem>.min<N>.fa`` per tier
+
+    The compressed copy is BGZF, with a ``.gzi`` block index and a ``.fai``
+    with the five ``samtools faidx`` columns, so ``samtools faidx`` reads
+    single contigs from it. Records are copied byte
+    for byte, so subsets keep the original headers and line wrapping.
+    Tiers that no contig reaches are left out, so callers fall back to a
+    lower one.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    store_path = out_dir.joinpath(f"{fasta_path.name}.gz")
+    index_path = out_dir.joinpath(f"{store_path.name}.fai")
+    block_index_path = out_dir.joinpath(f"{store_path.name}.gzi")
+    stem = fasta_path.name
+    if stem.endswith(".fa"):
+        stem = stem[: -len(".fa")]
+    tier_paths = {
+        tier: out_dir.joinpath(f"{stem}.min{tier}.fa") for tier in sorted(set(tiers))
+    }
+
+    with ExitStack() as stack:
+        fasta = stack.enter_context(open(fasta_path, "rb"))
+        store = bgzf.BgzfWriter(stack.enter_context(open(store_path, "wb")))
+        index = stack.enter_context(open(index_path, "w"))
+        subsets = [
+            (tier, stack.enter_context(open(path, "wb")))
+            for tier, path in tier_paths.items()
+        ]
+
+        for start, (name, length, lines) in _records(fasta):
+            seq_offset = start + len(lines[0])
+            line_bases = len(lines[1].rstrip(b"\r\n")) if len(lines) > 1 else 0
+            line_width = len(lines[1]) if len(lines) > 1 else 0
+            index.write(
+                f"{name.decode()}\t{length}\t{seq_offset}\t{line_bases}\t{line_width}\n"
+            )
+
+            store.writelines(lines)
+            for tier, subset in subsets:
+                if length >= tier:
+                    subset.writelines(lines)
+
+        bgzf.write_gzi(store.close(), block_index_path)
+
+    for tier, path in list(tier_paths.items()):
+        if path.stat().st_size == 0:
+            path.unlink()
+            del tier_paths[tier]
+
+    return ContigFiles(store_path, index_path, block_index_path, tier_paths)
+
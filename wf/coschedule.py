@@ -0,0 +1,219 @@
+"""
+Run several tools side by side in one task under a CPU and memory budget
+
+Tools are admitted while their estimated peak memory fits the budget and
+their dependencies have finished. The task's cores are split between the
+running tools by weight (each capped at what it can use), and re-split
+through CPU affinity whenever a tool starts or finishes, so the last tools
+standing get the whole node.
+"""
+
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+# A job runs its tool, passing ``on_start`` on to ``runner.run``
+JobFn = Callable[[Callable[[List[int]], None]], None]
+
+
+@dataclass
+class Job:
+    name: str
+    fn: JobFn
+    weight: float = 1.0
+    max_cpus: Optional[int] = None
+    mem_kb: float = 0.0
+    after: List[str] = field(default_factory=list)
+
+
+def task_cpus() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # No CPU affinity on macOS, every core is the task's
+        return list(range(os.cpu_count() or 1))
+
+
+def available_memory_kb() -> float:
+    """The cgroup memory limit if there is one, else the host's available memory"""
+    for limit_file in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            limit = Path(limit_file).read_text().strip()
+        except OSError:
+            continue
+        if limit.isdigit() and int(limit) < 2**60:
+            return int(limit) / 1024
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return float(line.split()[1])
+    except OSError:
+        pass
+    return float("inf")
+
+
+def _descendants(pids: List[int]) -> Set[int]:
+    """``pids`` and every process below them"""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = Path("/proc", entry, "stat").read_text()
+        except OSError:
+            continue
+        # The command name may contain spaces, fields resume after ")"
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    found: Set[int] = set()
+    stack = list(pids)
+    while stack:
+        pid = stack.pop()
+        if pid not in found:
+            found.add(pid)
+            stack.extend(children.get(pid, []))
+    return found
+
+
+def _set_affinity(pids: List[int], cpus: List[int]):
+    """Pin every thread of ``pids`` and their descendants to ``cpus``"""
+    if not hasattr(os, "sched_setaffinity"):
+        # Jobs then share the cores as the OS sees fit
+        return
+    for pid in _descendants(pids):
+        try:
+            threads = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            continue
+        for tid in threads:
+            try:
+                os.sched_setaffinity(int(tid), cpus)
+            except OSError:
+                # Exited in the meantime
+                pass
+
+
+def partition(cpus: List[int], jobs: List[Job]) -> Dict[str, List[int]]:
+    """Split ``cpus`` between ``jobs`` by weight, respecting ``max_cpus``"""
+    shares: Dict[str, int] = {job.name: 1 for job in jobs}
+    spare = len(cpus) - len(jobs)
+    open_jobs = [job for job in jobs if (job.max_cpus or len(cpus)) > 1]
+
+    while spare > 0 and open_jobs:
+        total = sum(job.weight for job in open_jobs)
+        handed_out = 0
+        for job in open_jobs:
+            room = (job.max_cpus or len(cpus)) - shares[job.name]
+            extra = min(room, max(int(spare * job.weight / total), 1))
+            extra = min(extra, spare - handed_out)
+            shares[job.name] += extra
+            handed_out += extra
+        spare -= handed_out
+        open_jobs = [
+            job for job in open_jobs if shares[job.name] < (job.max_cpus or len(cpus))
+        ]
+        if handed_out == 0:
+            break
+
+    assigned: Dict[str, List[int]] = {}
+    start = 0
+    for job in jobs:
+        # More jobs than cores: wrap around and share
+        assigned[job.name] = [
+            cpus[(start + i) % len(cpus)] for i in range(shares[job.name])
+        ]
+        start += shares[job.name]
+    return assigned
+
+
+class CoScheduler:
+    def __init__(
+        self, cpus: Optional[List[int]] = None, mem_budget_kb: Optional[float] = None
+    ):
+        self.cpus = cpus or task_cpus()
+        self.mem_budget_kb = (
+            mem_budget_kb if mem_budget_kb is not None else available_memory_kb()
+        )
+        self.jobs: List[Job] = []
+
+        self._lock = threading.Condition()
+        self._running: Dict[str, Job] = {}
+        self._pids: Dict[str, List[int]] = {}
+        self._done: Set[str] = set()
+        self._errors: Dict[str, BaseException] = {}
+
+    def add(self, job: Job):
+        self.jobs.append(job)
+
+    def _rebalance(self):
+        running = list(self._running.values())
+        if not running:
+            return
+        for name, cpus in partition(self.cpus, running).items():
+            if self._pids.get(name):
+                _set_affinity(self._pids[name], cpus)
+
+    def _ready(self, job: Job) -> bool:
+        if not all(dep in self._done for dep in job.after):
+            return False
+        used = sum(j.mem_kb for j in self._running.values())
+        # A job bigger than the whole budget still runs, but on its own
+        return not self._running or used + job.mem_kb <= self.mem_budget_kb
+
+    def _run_job(self, job: Job):
+        def on_start(pids: List[int]):
+            with self._lock:
+                self._pids[job.name] = self._pids.get(job.name, []) + pids
+                self._rebalance()
+
+        try:
+            job.fn(on_start)
+        except BaseException as e:
+            with self._lock:
+                self._errors[job.name] = e
+        finally:
+            with self._lock:
+                del self._running[job.name]
+                self._pids.pop(job.name, None)
+                self._done.add(job.name)
+                self._rebalance()
+                self._lock.notify_all()
+
+    def run(self):
+        """Run every job, raising the first failure once the others are done"""
+        pending = list(self.jobs)
+        threads = []
+
+        with self._lock:
+            while pending:
+                if self._errors:
+                    # Dependents of a failed job would fail as well
+                    break
+                ready = [job for job in pending if self._ready(job)]
+                if not ready:
+                    if not self._running:
+                        missing = {d for j in pending for d in j.after} - self._done
+                        raise ValueError(f"unknown job dependencies: {sorted(missing)}")
+                    self._lock.wait()
+                    continue
+
+                job = ready[0]
+                pending.remove(job)
+                self._running[job.name] = job
+                thread = threading.Thread(target=self._run_job, args=(job,))
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            raise next(iter(self._errors.values()))
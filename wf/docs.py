@@ -37,6 +37,18 @@ PARAMS = {
     "min_contig_len": LatchParameter(
         display_name="Minimum length of contigs to output",
     ),
+    "assembly_stats_mode": LatchParameter(
+        display_name="Assembly evaluation",
+        description="'fast' computes N50/L50, length and GC histograms and"
+        " contig counts in one pass over the contigs. 'metaquast' runs the"
+        " full MetaQuast evaluation, which is much slower on large assemblies.",
+    ),
+    "contig_length_tiers": LatchParameter(
+        display_name="Contig length tiers",
+        description="Minimum lengths of the contig subsets written after"
+        " assembly. Binning reads the smallest subset holding every contig"
+        " of at least 2500 bp, and GECCO the one for 1000 bp.",
+    ),
     "kaiju_ref_db": LatchParameter(
         display_name="Kaiju reference database (FM-index)",
         description="Kaiju reference database '.fmi' file.",
@@ -57,15 +69,74 @@ PARAMS = {
     ),
     "taxon_rank": LatchParameter(
         display_name="Taxonomic rank (kaiju2table)",
-        description="Taxonomic rank for summary table output (kaiju2table).",
+        description="Taxonomic rank for summary table output (kaiju2table)."
+        " The abundance matrices cover every rank.",
+    ),
+    "kaiju_scatter_min_reads": LatchParameter(
+        display_name="Kaiju scatter threshold (read pairs)",
+        description="Samples with more read pairs than this are split into"
+        " chunks classified on several nodes in parallel.",
+    ),
+    "kaiju_chunk_reads": LatchParameter(
+        display_name="Kaiju chunk size (read pairs)",
+        description="Read pairs per chunk when a sample is scattered.",
+    ),
+    "compact_kaiju_output": LatchParameter(
+        display_name="Compact Kaiju output",
+        description="Store read assignments as a compressed columnar .kjc file"
+        " instead of the text {sample}_kaiju.out. Convert back with"
+        " 'python -m wf.kaiju_format export'.",
     ),
     "prodigal_output_format": LatchParameter(
         display_name="Prodigal output file format",
         description="Specify main output file format (one of gbk, gff or sco).",
     ),
-    "fargene_hmm_model": LatchParameter(
-        display_name="fARGene's HMM model",
-        description="The Hidden Markov Model that should be used to predict ARGs from the data",
+    "fargene_hmm_models": LatchParameter(
+        display_name="fARGene's HMM models",
+        description="The Hidden Markov Models that should be used to predict ARGs"
+        " from the data. Several models are searched in parallel, each into its own"
+        " subdirectory.",
+    ),
+    "fargene_all_models": LatchParameter(
+        display_name="Use all fARGene models",
+        description="Search every fARGene model, whatever is selected above.",
+    ),
+    "share_gene_calls": LatchParameter(
+        display_name="Share Prodigal gene calls",
+        description="Call genes once with Prodigal and give its proteins to"
+        " Macrel (peptides mode) and fARGene (--amino), and its CDS features"
+        " to GECCO, instead of each tool predicting ORFs on the contigs."
+        " Macrel then misses small ORFs that Prodigal does not call.",
+    ),
+    "read_mapper": LatchParameter(
+        display_name="Read mapper",
+        description="Mapper used to align reads to the contigs for the binning"
+        " depth files. bowtie2 builds an index and aligns sensitively; minimap2"
+        " (-x sr) needs no separate index build and is much faster, at a small"
+        " cost in coverage accuracy.",
+    ),
+    "incremental": LatchParameter(
+        display_name="Incremental run",
+        description="Skip samples whose outputs under latch:///metamage/{sample}/"
+        " are complete and were produced from the same reads and parameters,"
+        " according to their manifest.json. Cohort-wide results, such as the"
+        " abundance matrices, still cover every sample.",
+    ),
+    "preview": LatchParameter(
+        display_name="Preview",
+        description="Run the whole workflow on a random subsample of each"
+        " sample's read pairs, as a quick check before a full run. Outputs go"
+        " to latch:///metamage/{sample}/preview/.",
+    ),
+    "preview_read_pairs": LatchParameter(
+        display_name="Preview read pairs",
+        description="Number of read pairs sampled from each sample for a preview.",
+    ),
+    "colocate_functional_tools": LatchParameter(
+        display_name="Run annotation tools in one task",
+        description="Run Prodigal, Macrel, fARGene and GECCO side by side in a"
+        " single task per sample, sharing one copy of the assembly. Cores are"
+        " redistributed to the tools that are still running as others finish.",
     ),
 }
 
@@ -77,11 +148,26 @@ FLOW = [
             " and two files corresponding to the reads (paired-end)"
         ),
         Params("samples"),
+        Params("incremental"),
+        Spoiler("Preview", Params("preview", "preview_read_pairs")),
     ),
     Section(
         "Assembly parameters",
         Text("Parameters for the assembly software MEGAHIT"),
-        Params("k_min", "k_max", "k_step", "min_count", "min_contig_len"),
+        Params(
+            "k_min",
+            "k_max",
+            "k_step",
+            "min_count",
+            "min_contig_len",
+            "assembly_stats_mode",
+            "contig_length_tiers",
+        ),
+    ),
+    Section(
+        "Binning parameters",
+        Text("Parameters for the depth files MetaBAT2 bins from"),
+        Params("read_mapper"),
     ),
     Section(
         "Taxonomic classification",
@@ -90,12 +176,28 @@ FLOW = [
             " choose which database to use and at which taxonomic"
             " level the final TSV report should be generated"
         ),
-        Params("kaiju_ref_db", "kaiju_ref_nodes", "kaiju_ref_names", "taxon_rank"),
+        Params(
+            "kaiju_ref_db",
+            "kaiju_ref_nodes",
+            "kaiju_ref_names",
+            "taxon_rank",
+            "compact_kaiju_output",
+        ),
+        Spoiler(
+            "Scattering deep samples",
+            Params("kaiju_scatter_min_reads", "kaiju_chunk_reads"),
+        ),
     ),
     Section(
         "Functional annotation parameters",
         Text("Options for the functional annotation subworkflow"),
-        Params("prodigal_output_format", "fargene_hmm_model"),
+        Params(
+            "prodigal_output_format",
+            "fargene_hmm_models",
+            "fargene_all_models",
+            "share_gene_calls",
+            "colocate_functional_tools",
+        ),
     ),
 ]
 
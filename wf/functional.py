@@ -1,14 +1,44 @@
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional
 
 from dataclasses_json import dataclass_json
-from latch import map_task, medium_task, message, small_task, workflow
+from flytekit import conditional
+from latch import large_task, medium_task, message, small_task, workflow
 from latch.types import LatchDir, LatchFile
 
-from .assembly import AssemblyOut
-from .types import ProdigalOutput, fARGeneModel
+from .assembly import AssemblyOut, contigs_for
+from .batch import (
+    batch_map,
+    by_sample,
+    out_of_memory_inputs,
+    present,
+    records_out_of_memory,
+)
+from .coschedule import CoScheduler, Job, task_cpus
+from .genbank import write_genbank
+from .images import FUNCTIONAL, GLUE
+from .planner import DEFAULT_MODELS
+from .runner import run
+from .settings import read_settings, write_settings
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import ProdigalOutput, fARGeneModel, output_prefix
+
+# GECCO looks for biosynthetic gene clusters, which span several genes, so
+# it only gets contigs of at least this length. The other tools keep the
+# short contigs, which still carry (partial) genes and small peptides.
+GECCO_MIN_CONTIG = 1000
+
+OnStart = Optional[Callable[[List[int]], None]]
+
+
+@dataclass_json
+@dataclass
+class FunctionalSettings:
+    prodigal_output_format: ProdigalOutput
+    fargene_hmm_models: List[fARGeneModel]
+    share_gene_calls: bool = False
 
 
 @dataclass_json
@@ -16,8 +46,24 @@ from .types import ProdigalOutput, fARGeneModel
 class FunctionalInput:
     sample_name: str
     assembly_data: LatchFile
-    prodigal_output_format: ProdigalOutput
-    fargene_hmm_model: fARGeneModel
+    bgc_assembly_data: LatchFile
+    # FunctionalSettings, one file for every sample of the run
+    settings: LatchFile
+
+
+@dataclass_json
+@dataclass
+class FunctionalToolOut:
+    sample_name: str
+    result: LatchDir
+    metrics: List[TaskMetrics]
+
+
+@dataclass_json
+@dataclass
+class GeneCallsInput:
+    functional_in: FunctionalInput
+    gene_calls: LatchDir
 
 
 @dataclass_json
@@ -28,44 +74,59 @@ class FunctionalOutput:
     macrel_result: LatchDir
     fargene_result: LatchDir
     gecco_result: LatchDir
+    metrics: List[TaskMetrics]
 
 
-@small_task
+@small_task(container_image=GLUE)
 def organize_functional_inputs(
     assembly_data: List[AssemblyOut],
     prodigal_output_format: ProdigalOutput,
-    fargene_hmm_model: fARGeneModel,
+    fargene_hmm_models: List[fARGeneModel],
+    fargene_all_models: bool = False,
+    share_gene_calls: bool = False,
 ) -> List[FunctionalInput]:
 
+    if fargene_all_models:
+        fargene_hmm_models = list(fARGeneModel)
+    # Keep the order, but search each model once
+    fargene_hmm_models = list(dict.fromkeys(fargene_hmm_models))
+    settings = write_settings(
+        FunctionalSettings(
+            prodigal_output_format=prodigal_output_format,
+            fargene_hmm_models=fargene_hmm_models,
+            share_gene_calls=share_gene_calls,
+        )
+    )
+
     ins = []
     for assembly in assembly_data:
         ins.append(
             FunctionalInput(
                 sample_name=assembly.sample_name,
                 assembly_data=assembly.assembly_data,
-                prodigal_output_format=prodigal_output_format,
-                fargene_hmm_model=fargene_hmm_model,
+                bgc_assembly_data=contigs_for(assembly, GECCO_MIN_CONTIG),
+                settings=settings,
             )
         )
 
     return ins
 
 
-@small_task
-def macrel(functional_in: FunctionalInput) -> LatchDir:
-
-    # Assembly data
-    sample_name = functional_in.sample_name
-    assembly_fasta = Path(functional_in.assembly_data.local_path)
+def _run_macrel(
+    sample_name: str,
+    fasta: Path,
+    mode: str = "contigs",
+    threads: int = 8,
+    on_start: OnStart = None,
+) -> Path:
 
-    output_dir_name = "macrel_results"
-    outdir = Path(output_dir_name).resolve()
+    outdir = Path("macrel_results").resolve()
 
     _macrel_cmd = [
         "macrel",
-        "contigs",
+        mode,
         "--fasta",
-        str(assembly_fasta),
+        str(fasta),
         "--output",
         str(outdir),
         "--tag",
@@ -73,47 +134,65 @@ def macrel(functional_in: FunctionalInput) -> LatchDir:
         "--log-file",
         f"{str(outdir)}/{sample_name}_log.txt",
         "--threads",
-        "8",
+        str(threads),
     ]
 
-    subprocess.run(_macrel_cmd)
-
-    return LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}")
-
-
-@small_task
-def fargene(functional_in: FunctionalInput) -> LatchDir:
-
-    # Assembly data
-    sample_name = functional_in.sample_name
-    assembly_fasta = Path(functional_in.assembly_data.local_path)
-
-    output_dir_name = "fargene_results"
-    outdir = Path(output_dir_name).resolve()
-
-    _fargene_cmd = [
-        "fargene",
-        "-i",
-        str(assembly_fasta),
-        "--hmm-model",
-        functional_in.fargene_hmm_model.value,
-        "-o",
-        output_dir_name,
-        "-p",
-        "8",
-    ]
+    run(_macrel_cmd, outputs=[outdir], on_start=on_start)
+    return outdir
+
+
+def _run_fargene(
+    fasta: Path,
+    hmm_models: List[fARGeneModel],
+    amino: bool = False,
+    threads: int = 8,
+    on_start: OnStart = None,
+) -> Path:
+    """Run every model into its own subdirectory of fargene_results
+
+    The models are searched in parallel. Contigs are always searched in
+    fARGene's nucleotide mode, whatever the number of models, so a
+    model's results do not depend on which others were selected; only
+    proteins (``amino``) are searched with ``--amino``.
+    """
+
+    outdir = Path("fargene_results").resolve()
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    workers = min(len(hmm_models), threads)
+    model_threads = max(threads // workers, 1)
+
+    def search(hmm_model: fARGeneModel):
+        model_dir = outdir.joinpath(hmm_model.value)
+
+        _fargene_cmd = [
+            "fargene",
+            "-i",
+            str(fasta),
+            "--hmm-model",
+            hmm_model.value,
+            *(["--amino"] if amino else []),
+            "-o",
+            str(model_dir),
+            "-p",
+            str(model_threads),
+        ]
+
+        run(
+            _fargene_cmd,
+            outputs=[model_dir.joinpath("results_summary.txt")],
+            on_start=on_start,
+        )
 
-    subprocess.run(_fargene_cmd)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(search, hmm_models))
 
-    return LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}")
+    return outdir
 
 
-@small_task
-def gecco(functional_in: FunctionalInput) -> LatchDir:
-
-    # Assembly data
-    sample_name = functional_in.sample_name
-    assembly_fasta = Path(functional_in.assembly_data.local_path)
+def _run_gecco(
+    genome: Path, cds: bool = False, threads: int = 4, on_start: OnStart = None
+) -> Path:
 
     output_dir_name = "gecco_results"
     outdir = Path(output_dir_name).resolve()
@@ -122,30 +201,27 @@ def gecco(functional_in: FunctionalInput) -> LatchDir:
         "gecco",
         "run",
         "-g",
-        str(assembly_fasta),
+        str(genome),
+        *(["--cds-feature", "CDS", "--locus-tag", "locus_tag"] if cds else []),
         "-o",
         output_dir_name,
         "-j",
-        "4",
+        str(threads),
         "--force-tsv",
     ]
 
-    subprocess.run(_gecco_cmd)
-
-    return LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}")
+    run(_gecco_cmd, outputs=[outdir], on_start=on_start)
+    return outdir
 
 
-@medium_task
-def prodigal(functional_in: FunctionalInput) -> LatchDir:
-
-    # Assembly data
-    sample_name = functional_in.sample_name
-    assembly_fasta = Path(functional_in.assembly_data.local_path)
+def _run_prodigal(
+    sample_name: str,
+    fasta: Path,
+    output_format: ProdigalOutput,
+    on_start: OnStart = None,
+) -> Path:
 
-    # A reference to our output.
-    output_format = functional_in.prodigal_output_format
-    output_dir_name = "prodigal_results"
-    output_dir = Path(output_dir_name).resolve()
+    output_dir = Path("prodigal_results").resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
 
     output_file = output_dir.joinpath(f"{sample_name}.{output_format.value}")
@@ -156,7 +232,7 @@ def prodigal(functional_in: FunctionalInput) -> LatchDir:
     _prodigal_cmd = [
         "/root/prodigal",
         "-i",
-        str(assembly_fasta),
+        str(fasta),
         "-f",
         output_format.value,
         "-o",
@@ -169,57 +245,551 @@ def prodigal(functional_in: FunctionalInput) -> LatchDir:
         str(output_scores),
     ]
 
-    subprocess.run(_prodigal_cmd)
+    run(_prodigal_cmd, outputs=[output_file, output_proteins], on_start=on_start)
+    return output_dir
+
+
+def _tool_out(
+    sample_name: str, outdir: Path, metrics: TaskMetrics
+) -> FunctionalToolOut:
+    return FunctionalToolOut(
+        sample_name=sample_name,
+        result=LatchDir(str(outdir), f"{output_prefix(sample_name)}/{outdir.name}"),
+        metrics=[metrics],
+    )
+
+
+@small_task(container_image=FUNCTIONAL)
+@records_out_of_memory()
+def macrel(functional_in: FunctionalInput) -> FunctionalToolOut:
+
+    # Assembly data
+    sample_name = functional_in.sample_name
+    assembly_fasta = Path(functional_in.assembly_data.local_path)
+
+    outdir = _run_macrel(sample_name, assembly_fasta)
+
+    return _tool_out(
+        sample_name,
+        outdir,
+        collect(sample_name, "macrel", assembly_bytes=file_sizes(assembly_fasta)),
+    )
+
+
+@small_task(container_image=FUNCTIONAL)
+@records_out_of_memory()
+def fargene(functional_in: FunctionalInput) -> FunctionalToolOut:
+
+    # Assembly data
+    sample_name = functional_in.sample_name
+    assembly_fasta = Path(functional_in.assembly_data.local_path)
+
+    settings = read_settings(FunctionalSettings, functional_in.settings)
+
+    outdir = _run_fargene(assembly_fasta, settings.fargene_hmm_models)
+
+    return _tool_out(
+        sample_name,
+        outdir,
+        collect(sample_name, "fargene", assembly_bytes=file_sizes(assembly_fasta)),
+    )
+
+
+@small_task(container_image=FUNCTIONAL)
+@records_out_of_memory()
+def gecco(functional_in: FunctionalInput) -> FunctionalToolOut:
+
+    # Assembly data
+    sample_name = functional_in.sample_name
+    assembly_fasta = Path(functional_in.bgc_assembly_data.local_path)
+
+    outdir = _run_gecco(assembly_fasta)
+
+    return _tool_out(
+        sample_name,
+        outdir,
+        collect(sample_name, "gecco", assembly_bytes=file_sizes(assembly_fasta)),
+    )
+
+
+@medium_task(container_image=FUNCTIONAL)
+@records_out_of_memory()
+def prodigal(functional_in: FunctionalInput) -> FunctionalToolOut:
+
+    # Assembly data
+    sample_name = functional_in.sample_name
+    assembly_fasta = Path(functional_in.assembly_data.local_path)
+
+    settings = read_settings(FunctionalSettings, functional_in.settings)
+
+    output_dir = _run_prodigal(
+        sample_name, assembly_fasta, settings.prodigal_output_format
+    )
+
+    return _tool_out(
+        sample_name,
+        output_dir,
+        collect(sample_name, "prodigal", assembly_bytes=file_sizes(assembly_fasta)),
+    )
+
+
+@large_task(container_image=FUNCTIONAL)
+def prodigal_retry(functional_in: FunctionalInput) -> FunctionalToolOut:
+    """prodigal on a bigger node, for samples that ran out of memory"""
+    return prodigal.task_function(functional_in)
+
+
+@medium_task(container_image=FUNCTIONAL)
+def macrel_retry(functional_in: FunctionalInput) -> FunctionalToolOut:
+    """macrel on a bigger node, for samples that ran out of memory"""
+    return macrel.task_function(functional_in)
+
+
+@medium_task(container_image=FUNCTIONAL)
+def fargene_retry(functional_in: FunctionalInput) -> FunctionalToolOut:
+    """fargene on a bigger node, for samples that ran out of memory"""
+    return fargene.task_function(functional_in)
+
+
+@medium_task(container_image=FUNCTIONAL)
+def gecco_retry(functional_in: FunctionalInput) -> FunctionalToolOut:
+    """gecco on a bigger node, for samples that ran out of memory"""
+    return gecco.task_function(functional_in)
+
+
+# Tools whose samples are retried when they run out of memory, by name
+RETRIED_TOOLS = {
+    "prodigal": prodigal,
+    "macrel": macrel,
+    "fargene": fargene,
+    "gecco": gecco,
+}
+
+
+@small_task(container_image=GLUE)
+def failed_functional_inputs(
+    inputs: List[FunctionalInput],
+    results: List[Optional[FunctionalToolOut]],
+    tool: str,
+) -> List[FunctionalInput]:
+    return out_of_memory_inputs(RETRIED_TOOLS[tool], inputs, results)
+
+
+@small_task(container_image=GLUE)
+def merge_tool_outs(
+    results: List[Optional[FunctionalToolOut]],
+    retried_results: List[Optional[FunctionalToolOut]],
+) -> List[FunctionalToolOut]:
+    return present(results + retried_results)
+
+
+@small_task(container_image=GLUE)
+def organize_gene_calls_inputs(
+    inputs: List[FunctionalInput], prodigal_results: List[Optional[FunctionalToolOut]]
+) -> List[GeneCallsInput]:
+
+    gene_calls = by_sample(prodigal_results)
+    return [
+        GeneCallsInput(
+            functional_in=functional_in,
+            gene_calls=gene_calls[functional_in.sample_name].result,
+        )
+        for functional_in in inputs
+        if functional_in.sample_name in gene_calls
+    ]
+
+
+def _gene_calls_element(gene_calls_in: GeneCallsInput) -> str:
+    return gene_calls_in.functional_in.sample_name
+
+
+def _gene_calls(gene_calls_in: GeneCallsInput) -> Path:
+    """Prodigal's predicted proteins for the sample"""
+    sample_name = gene_calls_in.functional_in.sample_name
+    return Path(gene_calls_in.gene_calls.local_path, f"{sample_name}.faa")
+
+
+@small_task(container_image=FUNCTIONAL)
+@records_out_of_memory(_gene_calls_element)
+def macrel_peptides(gene_calls_in: GeneCallsInput) -> FunctionalToolOut:
+    """Macrel on the shared Prodigal proteins instead of its own ORF calling"""
+
+    sample_name = gene_calls_in.functional_in.sample_name
+    proteins = _gene_calls(gene_calls_in)
+
+    outdir = _run_macrel(sample_name, proteins, mode="peptides")
+
+    return _tool_out(
+        sample_name,
+        outdir,
+        collect(sample_name, "macrel_peptides", protein_bytes=file_sizes(proteins)),
+    )
+
+
+@small_task(container_image=FUNCTIONAL)
+@records_out_of_memory(_gene_calls_element)
+def fargene_amino(gene_calls_in: GeneCallsInput) -> FunctionalToolOut:
+    """fARGene on the shared Prodigal proteins instead of translating contigs"""
+
+    functional_in = gene_calls_in.functional_in
+    sample_name = functional_in.sample_name
+    proteins = _gene_calls(gene_calls_in)
+    settings = read_settings(FunctionalSettings, functional_in.settings)
+
+    outdir = _run_fargene(proteins, settings.fargene_hmm_models, amino=True)
+
+    return _tool_out(
+        sample_name,
+        outdir,
+        collect(sample_name, "fargene_amino", protein_bytes=file_sizes(proteins)),
+    )
+
+
+@small_task(container_image=FUNCTIONAL)
+@records_out_of_memory(_gene_calls_element)
+def gecco_cds(gene_calls_in: GeneCallsInput) -> FunctionalToolOut:
+    """GECCO on contigs annotated with the shared Prodigal gene calls"""
+
+    functional_in = gene_calls_in.functional_in
+    sample_name = functional_in.sample_name
+    assembly_fasta = Path(functional_in.bgc_assembly_data.local_path)
+
+    genbank = write_genbank(
+        assembly_fasta,
+        _gene_calls(gene_calls_in),
+        Path(f"{sample_name}.gbk").resolve(),
+    )
+
+    outdir = _run_gecco(genbank, cds=True)
+
+    return _tool_out(
+        sample_name,
+        outdir,
+        collect(sample_name, "gecco_cds", assembly_bytes=file_sizes(assembly_fasta)),
+    )
+
+
+@medium_task(container_image=FUNCTIONAL)
+def macrel_peptides_retry(gene_calls_in: GeneCallsInput) -> FunctionalToolOut:
+    """macrel_peptides on a bigger node, for samples that ran out of memory"""
+    return macrel_peptides.task_function(gene_calls_in)
+
+
+@medium_task(container_image=FUNCTIONAL)
+def fargene_amino_retry(gene_calls_in: GeneCallsInput) -> FunctionalToolOut:
+    """fargene_amino on a bigger node, for samples that ran out of memory"""
+    return fargene_amino.task_function(gene_calls_in)
+
+
+@medium_task(container_image=FUNCTIONAL)
+def gecco_cds_retry(gene_calls_in: GeneCallsInput) -> FunctionalToolOut:
+    """gecco_cds on a bigger node, for samples that ran out of memory"""
+    return gecco_cds.task_function(gene_calls_in)
+
+
+# Tools on the shared gene calls whose samples are retried when they run
+# out of memory, by name
+RETRIED_GENE_CALLS_TOOLS = {
+    "macrel_peptides": macrel_peptides,
+    "fargene_amino": fargene_amino,
+    "gecco_cds": gecco_cds,
+}
+
+
+@small_task(container_image=GLUE)
+def failed_gene_calls_inputs(
+    inputs: List[GeneCallsInput],
+    results: List[Optional[FunctionalToolOut]],
+    tool: str,
+) -> List[GeneCallsInput]:
+    return out_of_memory_inputs(
+        RETRIED_GENE_CALLS_TOOLS[tool], inputs, results, _gene_calls_element
+    )
+
+
+@medium_task(container_image=FUNCTIONAL)
+def annotate_colocated(functional_in: FunctionalInput) -> FunctionalOutput:
+    """All four tools in one task, sharing its cores and memory
+
+    The tools run side by side from a single copy of the assembly. Each is
+    started with as many threads as the task has cores, and the scheduler
+    confines them through CPU affinity to their share, so the cores of a
+    tool that finishes go to the ones still running. Tools are weighted by
+    their expected runtime and only started while their expected peak
+    memory fits.
+    """
+
+    sample_name = functional_in.sample_name
+    assembly_fasta = Path(functional_in.assembly_data.local_path)
+    bgc_fasta = Path(functional_in.bgc_assembly_data.local_path)
+    settings = read_settings(FunctionalSettings, functional_in.settings)
+    share = settings.share_gene_calls
+
+    assembly_bytes = file_sizes(assembly_fasta)
+    threads = len(task_cpus())
+    outdirs: Dict[str, Path] = {}
+
+    def prodigal_job(on_start):
+        outdirs["prodigal"] = _run_prodigal(
+            sample_name,
+            assembly_fasta,
+            settings.prodigal_output_format,
+            on_start=on_start,
+        )
+
+    proteins = Path("prodigal_results", f"{sample_name}.faa").resolve()
+
+    def macrel_job(on_start):
+        outdirs["macrel"] = _run_macrel(
+            sample_name,
+            proteins if share else assembly_fasta,
+            mode="peptides" if share else "contigs",
+            threads=threads,
+            on_start=on_start,
+        )
+
+    def fargene_job(on_start):
+        outdirs["fargene"] = _run_fargene(
+            proteins if share else assembly_fasta,
+            settings.fargene_hmm_models,
+            amino=share,
+            threads=threads,
+            on_start=on_start,
+        )
+
+    def gecco_job(on_start):
+        genome = bgc_fasta
+        if share:
+            genome = write_genbank(
+                bgc_fasta, proteins, Path(f"{sample_name}.gbk").resolve()
+            )
+        outdirs["gecco"] = _run_gecco(
+            genome, cds=share, threads=threads, on_start=on_start
+        )
+
+    # fARGene's work grows with the number of models it searches
+    searches = {"fargene": len(settings.fargene_hmm_models)}
+    scheduler = CoScheduler()
+    for name, fn, max_cpus in [
+        ("prodigal", prodigal_job, 1),
+        ("macrel", macrel_job, None),
+        ("fargene", fargene_job, None),
+        ("gecco", gecco_job, None),
+    ]:
+        model = DEFAULT_MODELS[name]
+        scheduler.add(
+            Job(
+                name=name,
+                fn=fn,
+                weight=model.time(assembly_bytes) * searches.get(name, 1),
+                max_cpus=max_cpus,
+                mem_kb=model.rss_kb(assembly_bytes),
+                after=["prodigal"] if share and name != "prodigal" else [],
+            )
+        )
+    scheduler.run()
+
+    # Split the invocations back up by tool, so the report keeps one stage
+    # per tool as with separate tasks
+    tools = collect(sample_name, "functional").tools
+    stages = {
+        "prodigal": "prodigal",
+        "macrel": "macrel_peptides" if share else "macrel",
+        "fargene": "fargene_amino" if share else "fargene",
+        "gecco": "gecco_cds" if share else "gecco",
+    }
+    features = {
+        "prodigal": {"assembly_bytes": assembly_bytes},
+        "macrel": {"assembly_bytes": assembly_bytes},
+        "fargene": {"assembly_bytes": assembly_bytes},
+        "gecco": {"assembly_bytes": file_sizes(bgc_fasta)},
+    }
+    if share:
+        features["macrel"] = features["fargene"] = {
+            "protein_bytes": file_sizes(proteins)
+        }
+    metrics = [
+        TaskMetrics(
+            sample_name=sample_name,
+            stage=stage,
+            tools=[t for t in tools if t.tool == name],
+            features=features[name],
+        )
+        for name, stage in stages.items()
+    ]
+
+    def result(name: str) -> LatchDir:
+        return LatchDir(
+            str(outdirs[name]),
+            f"{output_prefix(sample_name)}/{outdirs[name].name}",
+        )
 
-    return LatchDir(
-        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    return FunctionalOutput(
+        sample_name=sample_name,
+        prodigal_result=result("prodigal"),
+        macrel_result=result("macrel"),
+        fargene_result=result("fargene"),
+        gecco_result=result("gecco"),
+        metrics=metrics,
     )
 
 
-@small_task
+@small_task(container_image=GLUE)
 def organize_functional_outputs(
     inputs: List[FunctionalInput],
-    prodigal_results: List[LatchDir],
-    macrel_results: List[LatchDir],
-    fargene_results: List[LatchDir],
-    gecco_results: List[LatchDir],
+    prodigal_results: List[Optional[FunctionalToolOut]],
+    macrel_results: List[Optional[FunctionalToolOut]],
+    fargene_results: List[Optional[FunctionalToolOut]],
+    gecco_results: List[Optional[FunctionalToolOut]],
 ) -> List[FunctionalOutput]:
 
+    results = [
+        by_sample(tool_results)
+        for tool_results in (
+            prodigal_results,
+            macrel_results,
+            fargene_results,
+            gecco_results,
+        )
+    ]
+
     outs = []
-    for sample, prod, macr, farg, gecc in zip(
-        inputs, prodigal_results, macrel_results, fargene_results, gecco_results
-    ):
+    for sample in inputs:
+        if not all(sample.sample_name in tool for tool in results):
+            # A tool failed for this sample, it drops out here
+            continue
+        prod, macr, farg, gecc = [tool[sample.sample_name] for tool in results]
 
         cur_out = FunctionalOutput(
             sample_name=sample.sample_name,
-            prodigal_result=prod,
-            macrel_result=macr,
-            fargene_result=farg,
-            gecco_result=gecc,
+            prodigal_result=prod.result,
+            macrel_result=macr.result,
+            fargene_result=farg.result,
+            gecco_result=gecc.result,
+            metrics=prod.metrics + macr.metrics + farg.metrics + gecc.metrics,
         )
         outs.append(cur_out)
 
     return outs
 
 
+@small_task(container_image=GLUE)
+def organize_colocated_outputs(
+    func_outs: List[Optional[FunctionalOutput]],
+) -> List[FunctionalOutput]:
+    return present(func_outs)
+
+
 @workflow
-def functional_wf(
-    assembly_data: List[AssemblyOut],
-    prodigal_output_format: ProdigalOutput,
-    fargene_hmm_model: fARGeneModel,
+def independent_annotation_wf(
+    functional_ins: List[FunctionalInput],
 ) -> List[FunctionalOutput]:
 
-    functional_ins = organize_functional_inputs(
-        assembly_data=assembly_data,
-        prodigal_output_format=prodigal_output_format,
-        fargene_hmm_model=fargene_hmm_model,
+    # Every tool calls genes on the contigs itself
+    first_prodigal_results = batch_map(prodigal)(functional_in=functional_ins)
+    first_macrel_results = batch_map(macrel)(functional_in=functional_ins)
+    first_fargene_results = batch_map(fargene)(functional_in=functional_ins)
+    first_gecco_results = batch_map(gecco)(functional_in=functional_ins)
+
+    # Samples that ran out of memory get one more try on a bigger node
+    prodigal_results = merge_tool_outs(
+        results=first_prodigal_results,
+        retried_results=batch_map(prodigal_retry)(
+            functional_in=failed_functional_inputs(
+                inputs=functional_ins, results=first_prodigal_results, tool="prodigal"
+            )
+        ),
+    )
+    macrel_results = merge_tool_outs(
+        results=first_macrel_results,
+        retried_results=batch_map(macrel_retry)(
+            functional_in=failed_functional_inputs(
+                inputs=functional_ins, results=first_macrel_results, tool="macrel"
+            )
+        ),
+    )
+    fargene_results = merge_tool_outs(
+        results=first_fargene_results,
+        retried_results=batch_map(fargene_retry)(
+            functional_in=failed_functional_inputs(
+                inputs=functional_ins, results=first_fargene_results, tool="fargene"
+            )
+        ),
+    )
+    gecco_results = merge_tool_outs(
+        results=first_gecco_results,
+        retried_results=batch_map(gecco_retry)(
+            functional_in=failed_functional_inputs(
+                inputs=functional_ins, results=first_gecco_results, tool="gecco"
+            )
+        ),
     )
 
-    # Functional annotation
-    prodigal_results = map_task(prodigal)(functional_in=functional_ins)
-    macrel_results = map_task(macrel)(functional_in=functional_ins)
-    fargene_results = map_task(fargene)(functional_in=functional_ins)
-    gecco_results = map_task(gecco)(functional_in=functional_ins)
+    func_outs = organize_functional_outputs(
+        inputs=functional_ins,
+        prodigal_results=prodigal_results,
+        macrel_results=macrel_results,
+        fargene_results=fargene_results,
+        gecco_results=gecco_results,
+    )
+
+    return func_outs
+
+
+@workflow
+def shared_gene_calls_wf(
+    functional_ins: List[FunctionalInput],
+) -> List[FunctionalOutput]:
+
+    # Genes are called once, and the other tools reuse them
+    first_prodigal_results = batch_map(prodigal)(functional_in=functional_ins)
+
+    # Samples that ran out of memory get one more try on a bigger node
+    prodigal_results = merge_tool_outs(
+        results=first_prodigal_results,
+        retried_results=batch_map(prodigal_retry)(
+            functional_in=failed_functional_inputs(
+                inputs=functional_ins, results=first_prodigal_results, tool="prodigal"
+            )
+        ),
+    )
+
+    gene_calls_ins = organize_gene_calls_inputs(
+        inputs=functional_ins, prodigal_results=prodigal_results
+    )
+
+    first_macrel_results = batch_map(macrel_peptides)(gene_calls_in=gene_calls_ins)
+    first_fargene_results = batch_map(fargene_amino)(gene_calls_in=gene_calls_ins)
+    first_gecco_results = batch_map(gecco_cds)(gene_calls_in=gene_calls_ins)
+
+    macrel_results = merge_tool_outs(
+        results=first_macrel_results,
+        retried_results=batch_map(macrel_peptides_retry)(
+            gene_calls_in=failed_gene_calls_inputs(
+                inputs=gene_calls_ins,
+                results=first_macrel_results,
+                tool="macrel_peptides",
+            )
+        ),
+    )
+    fargene_results = merge_tool_outs(
+        results=first_fargene_results,
+        retried_results=batch_map(fargene_amino_retry)(
+            gene_calls_in=failed_gene_calls_inputs(
+                inputs=gene_calls_ins,
+                results=first_fargene_results,
+                tool="fargene_amino",
+            )
+        ),
+    )
+    gecco_results = merge_tool_outs(
+        results=first_gecco_results,
+        retried_results=batch_map(gecco_cds_retry)(
+            gene_calls_in=failed_gene_calls_inputs(
+                inputs=gene_calls_ins, results=first_gecco_results, tool="gecco_cds"
+            )
+        ),
+    )
 
     func_outs = organize_functional_outputs(
         inputs=functional_ins,
@@ -230,3 +800,44 @@ def functional_wf(
     )
 
     return func_outs
+
+
+@workflow
+def colocated_annotation_wf(
+    functional_ins: List[FunctionalInput],
+) -> List[FunctionalOutput]:
+
+    # One task per sample runs all the tools
+    func_outs = batch_map(annotate_colocated)(functional_in=functional_ins)
+
+    return organize_colocated_outputs(func_outs=func_outs)
+
+
+@workflow
+def functional_wf(
+    assembly_data: List[AssemblyOut],
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_models: List[fARGeneModel],
+    fargene_all_models: bool = False,
+    share_gene_calls: bool = False,
+    colocate_tools: bool = False,
+) -> List[FunctionalOutput]:
+
+    functional_ins = organize_functional_inputs(
+        assembly_data=assembly_data,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_models=fargene_hmm_models,
+        fargene_all_models=fargene_all_models,
+        share_gene_calls=share_gene_calls,
+    )
+
+    # Functional annotation
+    return (
+        conditional("gene_calls")
+        .if_(colocate_tools.is_true())
+        .then(colocated_annotation_wf(functional_ins=functional_ins))
+        .elif_(share_gene_calls.is_true())
+        .then(shared_gene_calls_wf(functional_ins=functional_ins))
+        .else_()
+        .then(independent_annotation_wf(functional_ins=functional_ins))
+    )
@@ -0,0 +1,330 @@
+"""
+Cross-sample index of functional annotation hits
+
+Macrel, fARGene, GECCO and Prodigal each leave a directory of differently
+formatted text files per sample. Each is parsed here, streaming, into a
+typed columnar table (see ``wf/hit_table.py``) under
+``latch:///metamage/functional_hits/{tool}/{sample_name}.fht``, so cohort
+questions read a few columns of a few files instead of every output.
+"""
+
+import csv
+import gzip
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+from latch import small_task, workflow
+from latch.types import LatchFile
+
+from . import hit_table
+from .batch import batch_map, present
+from .functional import FunctionalOutput
+from .images import GLUE
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import PREVIEW_SUFFIX
+
+HITS_ROOT = "latch:///metamage/functional_hits"
+
+SCHEMAS: Dict[str, hit_table.Schema] = {
+    "macrel": [
+        ("sample_name", "str"),
+        ("peptide", "str"),
+        ("contig", "str"),
+        ("start", "int"),
+        ("end", "int"),
+        ("strand", "int"),
+        ("sequence", "str"),
+        ("amp_family", "str"),
+        ("amp_probability", "float"),
+        ("hemolytic", "str"),
+        ("hemolytic_probability", "float"),
+    ],
+    "fargene": [
+        ("sample_name", "str"),
+        ("model", "str"),
+        ("gene", "str"),
+        ("contig", "str"),
+        ("start", "int"),
+        ("end", "int"),
+        ("strand", "int"),
+        ("evalue", "float"),
+        ("score", "float"),
+    ],
+    "gecco": [
+        ("sample_name", "str"),
+        ("cluster", "str"),
+        ("contig", "str"),
+        ("start", "int"),
+        ("end", "int"),
+        ("type", "str"),
+        ("average_p", "float"),
+        ("max_p", "float"),
+    ],
+    "prodigal": [
+        ("sample_name", "str"),
+        ("contig", "str"),
+        ("genes", "int"),
+        ("partial_genes", "int"),
+        ("coding_bases", "int"),
+    ],
+}
+
+# (contig, start, end, strand) of a called gene or ORF
+Location = Tuple[str, int, int, int]
+
+
+@dataclass_json
+@dataclass
+class FunctionalHitsOut:
+    sample_name: str
+    # One table per tool, in SCHEMAS order
+    tables: List[LatchFile]
+    metrics: List[TaskMetrics]
+
+
+def hits_prefix(sample_name: str) -> str:
+    """Previews get their own index, so cohort queries only see full runs"""
+    if sample_name.endswith(PREVIEW_SUFFIX):
+        return f"{HITS_ROOT}/preview"
+    return HITS_ROOT
+
+
+def _open_text(path: Path):
+    return gzip.open(path, "rt") if path.suffix == ".gz" else open(path)
+
+
+def _float(value: Optional[str]) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _int(value: Optional[str]) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return hit_table.NO_POSITION
+
+
+def gene_location(header: str) -> Tuple[str, Location]:
+    """Id and location of a gene from a Prodigal-style FASTA header
+
+    ``>contig_7 # 123 # 456 # -1 # ...``, the number after the last
+    underscore is dropped to get the contig unless a ``contig=`` attribute
+    names it. Other headers only give the id.
+    """
+    fields = [field.strip() for field in header.split("#")]
+    gene_id = fields[0].split()[0] if fields[0] else ""
+    if len(fields) >= 4:
+        attributes = dict(
+            attribute.split("=", 1)
+            for attribute in (fields[4] if len(fields) > 4 else "").split(";")
+            if "=" in attribute
+        )
+        return gene_id, (
+            attributes.get("contig", gene_id.rsplit("_", 1)[0]),
+            _int(fields[1]),
+            _int(fields[2]),
+            _int(fields[3]),
+        )
+    return gene_id, (gene_id, hit_table.NO_POSITION, hit_table.NO_POSITION, 0)
+
+
+def _headers(path: Path) -> Iterator[str]:
+    """FASTA headers only, the sequences are not needed"""
+    with _open_text(path) as f:
+        for line in f:
+            if line.startswith(">"):
+                yield line[1:].rstrip()
+
+
+def _tsv_rows(path: Path) -> Iterator[Dict[str, str]]:
+    """Rows of a TSV with a header line, skipping '#' comment lines first"""
+    with _open_text(path) as f:
+        lines = (line for line in f if not line.startswith("#"))
+        yield from csv.DictReader(lines, delimiter="\t")
+
+
+def macrel_rows(sample_name: str, result_dir: Path) -> Iterator[tuple]:
+    predictions = [
+        row
+        for path in sorted(result_dir.glob("*.prediction*"))
+        for row in _tsv_rows(path)
+    ]
+    # Only predicted peptides are kept, so only their ORFs are looked up
+    wanted = {row["Access"] for row in predictions}
+    locations: Dict[str, Location] = {}
+    for path in sorted(result_dir.glob("*.all_orfs.faa*")):
+        for header in _headers(path):
+            orf, location = gene_location(header)
+            if orf in wanted:
+                locations[orf] = location
+
+    for row in predictions:
+        peptide = row["Access"]
+        # Without the ORF's header, the contig is still in the peptide's id
+        contig, start, end, strand = locations.get(
+            peptide, (peptide.rsplit("_", 1)[0], 0, 0, 0)
+        )
+        yield (
+            sample_name,
+            peptide,
+            contig,
+            start,
+            end,
+            strand,
+            row.get("Sequence", ""),
+            row.get("AMP_family", ""),
+            _float(row.get("AMP_probability")),
+            row.get("Hemolytic", ""),
+            _float(row.get("Hemolytic_probability")),
+        )
+
+
+def _hmmer_scores(path: Path) -> Iterator[Tuple[str, float, float]]:
+    """(target, E-value, score) from hmmsearch --tblout or --domtblout output"""
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            # --domtblout has the target length where --tblout has an accession
+            if fields[2].isdigit():
+                yield fields[0], _float(fields[6]), _float(fields[7])
+            else:
+                yield fields[0], _float(fields[4]), _float(fields[5])
+
+
+def fargene_rows(sample_name: str, result_dir: Path) -> Iterator[tuple]:
+    for model_dir in sorted(path for path in result_dir.iterdir() if path.is_dir()):
+        scores: Dict[str, Tuple[float, float]] = {}
+        for path in sorted(model_dir.glob("hmmsearchresults/*")):
+            for target, evalue, score in _hmmer_scores(path):
+                if target not in scores or score > scores[target][1]:
+                    scores[target] = (evalue, score)
+
+        # Predicted genes come as nucleotide and protein FASTAs, once each
+        genes: Dict[str, Location] = OrderedDict()
+        for path in sorted(model_dir.glob("predictedGenes/*.fasta")):
+            if path.name.startswith("retrieved-contigs"):
+                continue
+            for header in _headers(path):
+                gene, location = gene_location(header)
+                genes.setdefault(gene, location)
+
+        for gene, (contig, start, end, strand) in genes.items():
+            evalue, score = scores.get(gene, (math.nan, math.nan))
+            yield (
+                sample_name,
+                model_dir.name,
+                gene,
+                contig,
+                start,
+                end,
+                strand,
+                evalue,
+                score,
+            )
+
+
+def gecco_rows(sample_name: str, result_dir: Path) -> Iterator[tuple]:
+    for path in sorted(result_dir.glob("*.clusters.tsv")):
+        for row in _tsv_rows(path):
+            yield (
+                sample_name,
+                row.get("bgc_id") or row.get("cluster_id", ""),
+                row["sequence_id"],
+                _int(row.get("start")),
+                _int(row.get("end")),
+                row.get("type", ""),
+                _float(row.get("average_p")),
+                _float(row.get("max_p")),
+            )
+
+
+def prodigal_rows(sample_name: str, result_dir: Path) -> Iterator[tuple]:
+    """Gene counts per contig, from the protein FASTA"""
+    contigs: Dict[str, List[int]] = OrderedDict()
+    for path in sorted(result_dir.glob("*.faa")):
+        for header in _headers(path):
+            _, (contig, start, end, _) = gene_location(header)
+            counts = contigs.setdefault(contig, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += "partial=00" not in header
+            counts[2] += end - start + 1 if start else 0
+
+    for contig, (genes, partial, coding_bases) in contigs.items():
+        yield sample_name, contig, genes, partial, coding_bases
+
+
+@small_task(container_image=GLUE)
+def index_functional_hits(functional_output: FunctionalOutput) -> FunctionalHitsOut:
+    """Parse one sample's tool outputs into its partition of each hit table"""
+
+    sample_name = functional_output.sample_name
+    result_dirs = {
+        "macrel": functional_output.macrel_result,
+        "fargene": functional_output.fargene_result,
+        "gecco": functional_output.gecco_result,
+        "prodigal": functional_output.prodigal_result,
+    }
+    parsers = {
+        "macrel": macrel_rows,
+        "fargene": fargene_rows,
+        "gecco": gecco_rows,
+        "prodigal": prodigal_rows,
+    }
+
+    tables = []
+    table_paths = []
+    rows = {}
+    for tool, schema in SCHEMAS.items():
+        result_dir = Path(result_dirs[tool].local_path)
+        table = Path("functional_hits", tool, f"{sample_name}{hit_table.SUFFIX}")
+        table = table.resolve()
+        table.parent.mkdir(parents=True, exist_ok=True)
+
+        rows[f"{tool}_rows"] = float(
+            hit_table.write_table(table, schema, parsers[tool](sample_name, result_dir))
+        )
+        table_paths.append(table)
+        tables.append(
+            LatchFile(str(table), f"{hits_prefix(sample_name)}/{tool}/{table.name}")
+        )
+
+    return FunctionalHitsOut(
+        sample_name=sample_name,
+        tables=tables,
+        metrics=[
+            collect(
+                sample_name,
+                "functional_hits",
+                table_bytes=file_sizes(*table_paths),
+                **rows,
+            )
+        ],
+    )
+
+
+@small_task(container_image=GLUE)
+def organize_functional_hits(
+    results: List[Optional[FunctionalHitsOut]],
+) -> List[FunctionalHitsOut]:
+    return present(results)
+
+
+@workflow
+def functional_hits_wf(
+    functional_results: List[FunctionalOutput],
+) -> List[FunctionalHitsOut]:
+
+    hits = batch_map(index_functional_hits)(functional_output=functional_results)
+
+    return organize_functional_hits(results=hits)
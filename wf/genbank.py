@@ -0,0 +1,82 @@
+"""
+GenBank records from contigs and Prodigal gene calls
+"""
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+# (locus tag, start, end, strand, translation) of a called gene
+Gene = Tuple[str, int, int, int, str]
+
+
+def read_fasta(path: Path) -> Iterator[Tuple[str, str]]:
+    """(header, sequence) of every record"""
+    header = None
+    seq: List[str] = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(seq)
+                header, seq = line[1:], []
+            elif header is not None:
+                seq.append(line)
+    if header is not None:
+        yield header, "".join(seq)
+
+
+def prodigal_genes(proteins_faa: Path) -> Dict[str, List[Gene]]:
+    """Genes by contig, from the headers of Prodigal's ``-a`` output
+
+    Headers look like ``>contig_7 # 123 # 456 # -1 # ID=...``, the gene
+    number after the last underscore is dropped to get the contig name.
+    """
+    genes: Dict[str, List[Gene]] = {}
+    for header, protein in read_fasta(proteins_faa):
+        gene_id, start, end, strand = [f.strip() for f in header.split("#")[:4]]
+        contig = gene_id.rsplit("_", 1)[0]
+        genes.setdefault(contig, []).append(
+            (gene_id, int(start), int(end), int(strand), protein.rstrip("*"))
+        )
+    return genes
+
+
+def _qualifier(name: str, value: str) -> List[str]:
+    text = f'/{name}="{value}"'
+    return [" " * 21 + text[i : i + 58] for i in range(0, len(text), 58)]
+
+
+def _record(name: str, seq: str, genes: List[Gene]) -> str:
+    lines = [
+        f"LOCUS       {name} {len(seq)} bp    DNA     linear   UNK 01-JAN-1980",
+        f"DEFINITION  {name}.",
+        "FEATURES             Location/Qualifiers",
+    ]
+    for gene_id, start, end, strand, protein in genes:
+        location = f"{start}..{end}" if strand > 0 else f"complement({start}..{end})"
+        lines.append(f"     CDS             {location}")
+        lines.extend(_qualifier("locus_tag", gene_id))
+        lines.extend(_qualifier("translation", protein))
+
+    lines.append("ORIGIN")
+    seq = seq.lower()
+    for i in range(0, len(seq), 60):
+        chunk = " ".join(seq[j : j + 10] for j in range(i, min(i + 60, len(seq)), 10))
+        lines.append(f"{i + 1:>9} {chunk}")
+    lines.append("//")
+    return "\n".join(lines) + "\n"
+
+
+def write_genbank(contigs_fasta: Path, proteins_faa: Path, out_path: Path) -> Path:
+    """Annotate every contig with its Prodigal CDS features
+
+    Only contigs present in ``contigs_fasta`` are written, so a length
+    subset of the assembly yields the matching subset of records.
+    """
+    genes = prodigal_genes(proteins_faa)
+    with open(out_path, "w") as out:
+        for header, seq in read_fasta(contigs_fasta):
+            name = header.split()[0]
+            out.write(_record(name, seq, genes.get(name, [])))
+    return out_path
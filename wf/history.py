@@ -0,0 +1,341 @@
+"""
+Local history of tool runtimes and resource usage, with regression checks
+"""
+
+import json
+import math
+import os
+import sqlite3
+import statistics
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_DB = Path(
+    os.environ.get(
+        "METAMAGE_PERF_DB", Path.home().joinpath(".metamage", "perf_history.sqlite")
+    )
+)
+
+# Differences below these are noise, whatever their ratio to the baseline.
+MIN_WALL_TIME_DELTA = 30.0
+MIN_RSS_DELTA_KB = 256 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    recorded_at TEXT NOT NULL,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    sample_name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    tool TEXT NOT NULL,
+    tool_version TEXT NOT NULL,
+    params TEXT NOT NULL,
+    input_bucket INTEGER NOT NULL,
+    input_bytes INTEGER NOT NULL,
+    wall_time REAL NOT NULL,
+    cpu_time REAL NOT NULL,
+    max_rss_kb INTEGER NOT NULL,
+    bytes_read INTEGER NOT NULL,
+    bytes_written INTEGER NOT NULL,
+    output_bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS measurements_key
+    ON measurements (tool, params, input_bucket, tool_version);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    sample_name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    wall_time REAL NOT NULL,
+    cpu_time REAL NOT NULL,
+    max_rss_kb INTEGER NOT NULL,
+    input_bytes INTEGER NOT NULL,
+    output_bytes INTEGER NOT NULL,
+    features TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_stage ON stages (stage);
+"""
+
+
+@dataclass
+class Measurement:
+    sample_name: str
+    stage: str
+    tool: str
+    tool_version: str
+    params: str
+    input_bytes: int
+    wall_time: float
+    cpu_time: float
+    max_rss_kb: int
+    bytes_read: int
+    bytes_written: int
+    output_bytes: int
+
+    @property
+    def input_bucket(self) -> int:
+        return input_bucket(self.input_bytes)
+
+
+@dataclass
+class StageMeasurement:
+    sample_name: str
+    stage: str
+    wall_time: float
+    cpu_time: float
+    max_rss_kb: int
+    input_bytes: int
+    output_bytes: int
+    features: Dict[str, float]
+
+
+@dataclass
+class Regression:
+    measurement: Measurement
+    metric: str
+    observed: float
+    expected: float
+    baseline_runs: int
+    baseline_versions: List[str]
+
+    @property
+    def ratio(self) -> float:
+        return self.observed / self.expected if self.expected else math.inf
+
+
+def input_bucket(input_bytes: int) -> int:
+    """Power-of-two size class, so runs are compared with similar inputs"""
+    return int(math.log2(input_bytes)) if input_bytes > 0 else 0
+
+
+def command_params(command: List[str]) -> str:
+    """The command line with file paths masked, i.e. just the tool's options"""
+    params = []
+    for arg in command[1:]:
+        if "/" in arg or os.path.exists(arg):
+            params.append("<path>")
+        else:
+            params.append(arg)
+    return " ".join(params)
+
+
+def measurements(report: Dict) -> Iterator[Measurement]:
+    """Flatten a run report written by ``telemetry.write_report``"""
+    for sample_name, stages in report["samples"].items():
+        for stage in stages:
+            for tool in stage["tools"]:
+                yield Measurement(
+                    sample_name=sample_name,
+                    stage=stage["stage"],
+                    tool=tool["tool"],
+                    tool_version=tool.get("tool_version", "unknown"),
+                    params=command_params(tool["command"]),
+                    input_bytes=tool["input_bytes"],
+                    wall_time=tool["wall_time"],
+                    cpu_time=tool["cpu_time"],
+                    max_rss_kb=tool["max_rss_kb"],
+                    bytes_read=tool["bytes_read"],
+                    bytes_written=tool["bytes_written"],
+                    output_bytes=tool["output_bytes"],
+                )
+
+
+def stage_measurements(report: Dict) -> Iterator[StageMeasurement]:
+    for sample_name, stages in report["samples"].items():
+        for stage in stages:
+            yield StageMeasurement(
+                sample_name=sample_name,
+                stage=stage["stage"],
+                wall_time=stage["wall_time"],
+                cpu_time=stage["cpu_time"],
+                max_rss_kb=stage["max_rss_kb"],
+                input_bytes=stage["input_bytes"],
+                output_bytes=stage["output_bytes"],
+                features=stage.get("features", {}),
+            )
+
+
+def load_report(path: Path) -> Dict:
+    return json.loads(Path(path).read_text())
+
+
+class PerfHistory:
+    """SQLite store of measurements keyed by tool, version, options and input size"""
+
+    def __init__(self, path: Path = DEFAULT_DB):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> "PerfHistory":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def has_run(self, run_id: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM runs WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        return row is not None
+
+    def record(self, report: Dict, source: Optional[str] = None) -> int:
+        """Store every measurement of a run report, once per run"""
+        run_id = report["generated_at"]
+        if self.has_run(run_id):
+            return 0
+
+        rows = [
+            (
+                run_id,
+                m.sample_name,
+                m.stage,
+                m.tool,
+                m.tool_version,
+                m.params,
+                m.input_bucket,
+                m.input_bytes,
+                m.wall_time,
+                m.cpu_time,
+                m.max_rss_kb,
+                m.bytes_read,
+                m.bytes_written,
+                m.output_bytes,
+            )
+            for m in measurements(report)
+        ]
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?)",
+                (run_id, report["generated_at"], source),
+            )
+            self.conn.executemany(
+                "INSERT INTO measurements VALUES"
+                " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.executemany(
+                "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        s.sample_name,
+                        s.stage,
+                        s.wall_time,
+                        s.cpu_time,
+                        s.max_rss_kb,
+                        s.input_bytes,
+                        s.output_bytes,
+                        json.dumps(s.features),
+                    )
+                    for s in stage_measurements(report)
+                ],
+            )
+        return len(rows)
+
+    def baseline(
+        self, m: Measurement, exclude_run: Optional[str] = None
+    ) -> List[Tuple[str, str, int, float, int]]:
+        """Past (run, version, input size, wall time, peak RSS) for the same invocation
+
+        A run has one row per sample that made the invocation.
+        """
+        return self.conn.execute(
+            "SELECT run_id, tool_version, input_bytes, wall_time, max_rss_kb"
+            " FROM measurements"
+            " WHERE tool = ? AND params = ? AND input_bucket = ?"
+            " AND run_id IS NOT ?",
+            (m.tool, m.params, m.input_bucket, exclude_run),
+        ).fetchall()
+
+    def all_measurements(self, tool: Optional[str] = None) -> List[Measurement]:
+        query = (
+            "SELECT sample_name, stage, tool, tool_version, params, input_bytes,"
+            " wall_time, cpu_time, max_rss_kb, bytes_read, bytes_written,"
+            " output_bytes FROM measurements"
+        )
+        args: Tuple = ()
+        if tool is not None:
+            query += " WHERE tool = ?"
+            args = (tool,)
+        return [Measurement(*row) for row in self.conn.execute(query, args)]
+
+    def stage_history(self, stage: str) -> List[StageMeasurement]:
+        rows = self.conn.execute(
+            "SELECT sample_name, stage, wall_time, cpu_time, max_rss_kb,"
+            " input_bytes, output_bytes, features FROM stages WHERE stage = ?",
+            (stage,),
+        )
+        return [StageMeasurement(*row[:-1], json.loads(row[-1])) for row in rows]
+
+    def compare(
+        self,
+        report: Dict,
+        tolerance: float = 0.25,
+        min_runs: int = 3,
+    ) -> List[Regression]:
+        """Flag tools that got slower or hungrier than usual for their input size
+
+        Wall time is compared per input byte, so a run whose input sits at the
+        edge of a size bucket is not flagged just for being larger. Peak memory
+        is compared as is. A measurement is a regression when it exceeds the
+        median of its baseline by more than ``tolerance``.
+        """
+        run_id = report["generated_at"]
+        regressions = []
+
+        for m in measurements(report):
+            history = self.baseline(m, exclude_run=run_id)
+            # Samples of one run share its conditions, so runs are counted
+            baseline_runs = len({row[0] for row in history})
+            if baseline_runs < min_runs:
+                continue
+
+            versions = sorted({row[1] for row in history})
+            rates = [
+                wall_time / max(input_bytes, 1)
+                for _, _, input_bytes, wall_time, _ in history
+            ]
+            expected_wall = statistics.median(rates) * max(m.input_bytes, 1)
+            expected_rss = statistics.median(row[4] for row in history)
+
+            for metric, observed, expected, min_delta in (
+                ("wall_time", m.wall_time, expected_wall, MIN_WALL_TIME_DELTA),
+                ("max_rss_kb", m.max_rss_kb, expected_rss, MIN_RSS_DELTA_KB),
+            ):
+                if (
+                    observed > expected * (1 + tolerance)
+                    and observed - expected > min_delta
+                ):
+                    regressions.append(
+                        Regression(
+                            measurement=m,
+                            metric=metric,
+                            observed=observed,
+                            expected=expected,
+                            baseline_runs=baseline_runs,
+                            baseline_versions=versions,
+                        )
+                    )
+
+        return regressions
+
+
+def format_regressions(regressions: Iterable[Regression]) -> str:
+    lines = []
+    for r in regressions:
+        m = r.measurement
+        lines.append(
+            f"{m.sample_name}\t{m.stage}\t{m.tool} {m.tool_version}"
+            f" (baseline {', '.join(r.baseline_versions)}, {r.baseline_runs} runs)"
+            f"\t{r.metric}: {r.observed:.1f} vs expected {r.expected:.1f}"
+            f" ({r.ratio:.2f}x)"
+        )
+    return "\n".join(lines)
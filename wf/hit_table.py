@@ -0,0 +1,206 @@
+"""
+Typed columnar tables for functional annotation hits
+
+A ``.fht`` file is a magic line, the table's schema and then independent
+blocks of up to ``BLOCK_ROWS`` rows. The schema is a JSON list of
+``[column, type]`` pairs, with types ``str``, ``int`` (int64) or ``float``
+(float64). Each block starts with its row count and the compressed size
+of every column, followed by the zlib-compressed columns:
+
+- str: the values joined by newlines, UTF-8 encoded
+- int, float: little-endian arrays
+
+A reader skips the columns it was not asked for without decompressing
+them. A cohort's tables are partitioned by tool and sample, as
+``{root}/{tool}/{sample_name}.fht``, so a query only reads the files of
+the samples it needs, and a run adds its samples' partitions without
+rewriting the others.
+
+    python -m wf.hit_table cat fargene/SRR579291.fht [column ...]
+    python -m wf.hit_table cat fargene/ sample_name model contig
+"""
+
+import json
+import math
+import struct
+import sys
+import zlib
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+MAGIC = b"FHT1\n"
+SUFFIX = ".fht"
+BLOCK_ROWS = 65_536
+COMPRESSION_LEVEL = 6
+
+# Unknown coordinates are written as 0, coordinates are 1-based
+NO_POSITION = 0
+
+Schema = List[Tuple[str, str]]
+
+_SCHEMA_LENGTH = struct.Struct("<I")
+_ROWS = struct.Struct("<I")
+_TYPECODES = {"int": "q", "float": "d"}
+
+
+def _encode_column(kind: str, values: List) -> bytes:
+    if kind == "str":
+        data = "\n".join(value.replace("\n", " ") for value in values).encode()
+    else:
+        packed = array(_TYPECODES[kind], values)
+        if sys.byteorder != "little":
+            packed.byteswap()
+        data = packed.tobytes()
+    return zlib.compress(data, COMPRESSION_LEVEL)
+
+
+def _decode_column(kind: str, data: bytes, rows: int) -> List:
+    data = zlib.decompress(data)
+    if kind == "str":
+        return data.decode().split("\n") if rows else []
+    values = array(_TYPECODES[kind])
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tolist()
+
+
+def _encode_block(schema: Schema, rows: List[tuple]) -> bytes:
+    columns = [
+        _encode_column(kind, [row[i] for row in rows])
+        for i, (_, kind) in enumerate(schema)
+    ]
+    sizes = struct.pack(f"<{len(columns)}I", *(len(column) for column in columns))
+    return _ROWS.pack(len(rows)) + sizes + b"".join(columns)
+
+
+def write_table(path: Union[str, Path], schema: Schema, rows: Iterable[tuple]) -> int:
+    """Write rows of ``schema``'s columns, in order, returning the row count"""
+    for column, kind in schema:
+        if kind not in ("str", "int", "float"):
+            raise ValueError(f"column {column} has unknown type {kind!r}")
+
+    written = 0
+    with open(path, "wb") as out:
+        encoded = json.dumps([list(column) for column in schema]).encode()
+        out.write(MAGIC + _SCHEMA_LENGTH.pack(len(encoded)) + encoded)
+
+        block: List[tuple] = []
+        for row in rows:
+            block.append(row)
+            if len(block) == BLOCK_ROWS:
+                out.write(_encode_block(schema, block))
+                written += len(block)
+                block = []
+        # Empty tables still get a block, so readers see an empty column
+        if block or not written:
+            out.write(_encode_block(schema, block))
+            written += len(block)
+    return written
+
+
+def _read_schema(f: BinaryIO) -> Schema:
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{f.name} is not a hit table")
+    (length,) = _SCHEMA_LENGTH.unpack(f.read(_SCHEMA_LENGTH.size))
+    return [tuple(column) for column in json.loads(f.read(length))]
+
+
+def read_schema(path: Union[str, Path]) -> Schema:
+    with open(path, "rb") as f:
+        return _read_schema(f)
+
+
+def read_blocks(
+    path: Union[str, Path], columns: Optional[List[str]] = None
+) -> Iterator[Dict[str, List]]:
+    """The requested columns, all by default, a block of rows at a time"""
+    with open(path, "rb") as f:
+        schema = _read_schema(f)
+        names = [name for name, _ in schema]
+        wanted = set(names if columns is None else columns)
+        missing = wanted.difference(names)
+        if missing:
+            raise KeyError(f"{path} has no column {', '.join(sorted(missing))}")
+
+        sizes_struct = struct.Struct(f"<{len(schema)}I")
+        while True:
+            header = f.read(_ROWS.size)
+            if not header:
+                return
+            (rows,) = _ROWS.unpack(header)
+            sizes = sizes_struct.unpack(f.read(sizes_struct.size))
+
+            block = {}
+            for (name, kind), size in zip(schema, sizes):
+                if name in wanted:
+                    block[name] = _decode_column(kind, f.read(size), rows)
+                else:
+                    f.seek(size, 1)
+            yield {name: block[name] for name in (columns or names)}
+
+
+def read_rows(
+    path: Union[str, Path], columns: Optional[List[str]] = None
+) -> Iterator[tuple]:
+    for block in read_blocks(path, columns):
+        yield from zip(*block.values())
+
+
+def partitions(
+    root: Union[str, Path], tool: str, samples: Optional[Iterable[str]] = None
+) -> List[Path]:
+    """The tool's table of each sample under ``root``, all samples by default"""
+    tool_dir = Path(root, tool)
+    if samples is not None:
+        paths = [tool_dir.joinpath(f"{sample}{SUFFIX}") for sample in samples]
+        return [path for path in paths if path.exists()]
+    return sorted(tool_dir.glob(f"*{SUFFIX}"))
+
+
+def scan(
+    root: Union[str, Path],
+    tool: str,
+    columns: Optional[List[str]] = None,
+    samples: Optional[Iterable[str]] = None,
+) -> Iterator[tuple]:
+    """Rows of the tool's tables across samples, reading only ``columns``"""
+    for path in partitions(root, tool, samples):
+        yield from read_rows(path, columns)
+
+
+def _format(value) -> str:
+    if isinstance(value, float) and math.isnan(value):
+        return ""
+    return str(value)
+
+
+def main(argv: List[str] = None) -> int:
+    command, *args = argv if argv is not None else sys.argv[1:]
+
+    if command == "cat":
+        path, *columns = args
+        path = Path(path)
+        paths = sorted(path.glob(f"*{SUFFIX}")) if path.is_dir() else [path]
+        if not paths:
+            print(f"no tables in {path}", file=sys.stderr)
+            return 1
+        out = sys.stdout
+        out.write("\t".join(columns or [name for name, _ in read_schema(paths[0])]))
+        out.write("\n")
+        try:
+            for table in paths:
+                for row in read_rows(table, columns or None):
+                    out.write("\t".join(map(_format, row)) + "\n")
+            out.flush()
+        except BrokenPipeError:
+            return 0
+    else:
+        print(f"unknown command {command!r}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
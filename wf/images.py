@@ -0,0 +1,59 @@
+"""
+Container images of the workflow's tasks
+
+The root Dockerfile bundles every tool, several GB that a fresh node
+pulls before even the smallest task starts. Each task instead names the
+stage image holding only its tools, built from ``docker/{stage}.Dockerfile``:
+
+- glue: no bioinformatics tools, for the organize tasks and the tasks
+  doing their work in Python
+- assembly: MEGAHIT and QUAST
+- binning: Bowtie2, minimap2, Samtools and MetaBAT2
+- classification: Kaiju and KronaTools
+- functional: Prodigal, Macrel, GECCO and fARGene
+
+    python scripts/build_images.py <registry>
+
+builds and pushes them, and registering with ``METAMAGE_IMAGE_REGISTRY``
+set to the same registry points the tasks at them. Without it, every
+task runs in the workflow's image, as before.
+"""
+
+import os
+from pathlib import Path
+from typing import Optional
+
+REGISTRY_ENV = "METAMAGE_IMAGE_REGISTRY"
+
+STAGES = ["glue", "assembly", "binning", "classification", "functional"]
+
+DOCKER_DIR = Path(__file__).resolve().parents[1].joinpath("docker")
+_VERSION_FILE = Path(__file__).resolve().parents[1].joinpath("version")
+
+
+def version() -> str:
+    # Only read at registration, the task containers do not ship the file
+    if _VERSION_FILE.exists():
+        return _VERSION_FILE.read_text().strip()
+    return "latest"
+
+
+def image_name(registry: str, stage: str) -> str:
+    return f"{registry.rstrip('/')}/metamage-{stage}:{version()}"
+
+
+def stage_image(stage: str) -> Optional[str]:
+    """The stage's image, or None for the workflow's own"""
+    if stage not in STAGES:
+        raise ValueError(f"unknown image stage {stage!r}")
+    registry = os.environ.get(REGISTRY_ENV)
+    if not registry:
+        return None
+    return image_name(registry, stage)
+
+
+GLUE = stage_image("glue")
+ASSEMBLY = stage_image("assembly")
+BINNING = stage_image("binning")
+CLASSIFICATION = stage_image("classification")
+FUNCTIONAL = stage_image("functional")
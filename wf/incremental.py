@@ -0,0 +1,315 @@
+"""
+Incremental cohort runs, which skip samples whose outputs are up to date
+
+Every finished sample gets a manifest at ``{output_prefix}/manifest.json``
+recording a fingerprint of its reads, a hash of the run parameters its
+outputs depend on, and where those outputs were written. On the next run
+with ``incremental`` set, samples whose manifest matches are not processed
+again, and their recorded outputs join the cohort-level results.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from dataclasses_json import dataclass_json
+from flytekit.core.context_manager import FlyteContextManager
+from latch import message, small_task
+from latch.ldata.path import LPath
+from latch.types import LatchDir, LatchFile
+
+from .images import GLUE
+from .kaiju import KaijuTableOut
+from .types import (
+    PREVIEW_SUFFIX,
+    AssemblyStatsMode,
+    ProdigalOutput,
+    ReadMapper,
+    Sample,
+    TaxonRank,
+    fARGeneModel,
+    output_prefix,
+)
+
+MANIFEST_NAME = "manifest.json"
+
+# Outputs the cohort-level results are rebuilt from, so a manifest written
+# without them is out of date
+COHORT_OUTPUTS = ["kaiju2table_outs", "kaiju_taxon_counts"]
+
+
+@dataclass_json
+@dataclass
+class SampleManifest:
+    sample_name: str
+    input_fingerprint: str
+    params_hash: str
+    # Remote paths of the sample's outputs, keyed like WfResults' fields
+    outputs: Dict[str, str]
+
+
+@dataclass_json
+@dataclass
+class CohortState:
+    params_hash: str
+    # Of the samples processed in this run, by name
+    input_fingerprints: Dict[str, str]
+    # Samples that were up to date and skipped
+    complete: List[SampleManifest]
+
+
+class SampleSelection(NamedTuple):
+    pending: List[Sample]
+    cohort: CohortState
+
+
+def _latch_identity(remote: str) -> str:
+    """Path, size, version and modification time of a file on latch"""
+    path = LPath(remote)
+    path.fetch_metadata()
+    modified = path.modify_time()
+    return "\t".join(
+        [
+            remote,
+            str(path.size()),
+            str(path.version_id()),
+            modified.isoformat() if modified else "",
+        ]
+    )
+
+
+def _s3_head(bucket: str, key: str) -> Dict:
+    # boto3 comes with latch, only S3 inputs need it
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+    from botocore.exceptions import NoCredentialsError
+
+    try:
+        return boto3.client("s3").head_object(Bucket=bucket, Key=key)
+    except NoCredentialsError:
+        # Public buckets, like the test data's, are read anonymously
+        anonymous = boto3.client("s3", config=Config(signature_version=UNSIGNED))
+        return anonymous.head_object(Bucket=bucket, Key=key)
+
+
+def _s3_identity(remote: str) -> str:
+    """Path, size, ETag and version of an object on S3"""
+    bucket, _, key = remote[len("s3://") :].partition("/")
+    head = _s3_head(bucket, key)
+    return "\t".join(
+        [
+            remote,
+            str(head["ContentLength"]),
+            head["ETag"].strip('"'),
+            head.get("VersionId", ""),
+        ]
+    )
+
+
+def _remote_identity(remote: str) -> str:
+    try:
+        if remote.startswith("s3://"):
+            return _s3_identity(remote)
+        return _latch_identity(remote)
+    except Exception as e:
+        # Without metadata a replaced file looks like the old one, so the
+        # identity matches no manifest and the sample is processed again
+        message(
+            "warning",
+            {
+                "title": f"Incremental mode is off for {remote}",
+                "body": f"Its size and version could not be read ({e}), so the"
+                " sample is processed again on every run.",
+            },
+        )
+        return f"{remote}\tunknown\t{uuid.uuid4()}"
+
+
+def _file_identity(f: LatchFile) -> str:
+    remote = f.remote_path or str(f.path)
+    local = remote[len("file://") :] if remote.startswith("file://") else remote
+    if os.path.isfile(local):
+        stat = os.stat(local)
+        return f"{remote}\t{stat.st_size}\t{int(stat.st_mtime)}"
+    # Remote files are not hashed, that would mean downloading them here
+    return _remote_identity(remote)
+
+
+def input_fingerprint(sample: Sample) -> str:
+    identity = "\n".join(_file_identity(f) for f in (sample.read1, sample.read2))
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def params_hash(params: Dict[str, object]) -> str:
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _remote_exists(remote: str) -> bool:
+    try:
+        return FlyteContextManager.current_context().file_access.exists(remote)
+    except Exception:
+        # Backends report unsupported or unreachable paths differently
+        return False
+
+
+def fetch_manifest(sample_name: str) -> Optional[SampleManifest]:
+    remote = f"{output_prefix(sample_name)}/{MANIFEST_NAME}"
+    if not _remote_exists(remote):
+        return None
+
+    local = Path(tempfile.mkdtemp()).joinpath(MANIFEST_NAME)
+    FlyteContextManager.current_context().file_access.get_data(remote, str(local))
+    return SampleManifest.from_json(local.read_text())
+
+
+def is_up_to_date(
+    manifest: Optional[SampleManifest], fingerprint: str, run_params: str
+) -> bool:
+    return (
+        manifest is not None
+        and manifest.input_fingerprint == fingerprint
+        and manifest.params_hash == run_params
+        and all(field in manifest.outputs for field in COHORT_OUTPUTS)
+        and all(_remote_exists(path) for path in manifest.outputs.values())
+    )
+
+
+@small_task(container_image=GLUE)
+def select_pending_samples(
+    samples: List[Sample],
+    incremental: bool,
+    preview: bool,
+    kaiju_ref_db: LatchFile,
+    taxon_rank: TaxonRank,
+    compact_kaiju_output: bool,
+    min_count: int,
+    k_min: int,
+    k_max: int,
+    k_step: int,
+    min_contig_len: int,
+    assembly_stats_mode: AssemblyStatsMode,
+    contig_length_tiers: List[int],
+    read_mapper: ReadMapper,
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_models: List[fARGeneModel],
+    fargene_all_models: bool,
+    share_gene_calls: bool,
+) -> SampleSelection:
+    """Split the samples into those to process and those already done
+
+    Only parameters that change a sample's outputs are hashed, so e.g.
+    scattering Kaiju differently does not re-run a cohort.
+    """
+
+    run_params = params_hash(
+        {
+            "kaiju_ref_db": kaiju_ref_db.remote_path,
+            "taxon_rank": taxon_rank.value,
+            "compact_kaiju_output": compact_kaiju_output,
+            "megahit": [min_count, k_min, k_max, k_step, min_contig_len],
+            "assembly_stats_mode": assembly_stats_mode.value,
+            "contig_length_tiers": sorted(contig_length_tiers),
+            "read_mapper": read_mapper.value,
+            "prodigal_output_format": prodigal_output_format.value,
+            "fargene_hmm_models": sorted(m.value for m in fargene_hmm_models),
+            "fargene_all_models": fargene_all_models,
+            "share_gene_calls": share_gene_calls,
+        }
+    )
+
+    pending = []
+    fingerprints = {}
+    complete = []
+    for sample in samples:
+        fingerprint = input_fingerprint(sample)
+        # Previews are quick by design and are always run
+        manifest = (
+            fetch_manifest(sample.sample_name) if incremental and not preview else None
+        )
+        if is_up_to_date(manifest, fingerprint, run_params):
+            complete.append(manifest)
+        else:
+            pending.append(sample)
+            fingerprints[sample.sample_name] = fingerprint
+
+    return SampleSelection(
+        pending=pending,
+        cohort=CohortState(
+            params_hash=run_params,
+            input_fingerprints=fingerprints,
+            complete=complete,
+        ),
+    )
+
+
+@small_task(container_image=GLUE)
+def cohort_kaiju_tables(
+    kaiju_tables: List[KaijuTableOut], cohort: CohortState
+) -> List[KaijuTableOut]:
+    """This run's tables followed by those of the samples that were skipped"""
+
+    return kaiju_tables + [
+        KaijuTableOut(
+            sample_name=manifest.sample_name,
+            kaiju_table=LatchFile(manifest.outputs["kaiju2table_outs"]),
+            taxon_counts=LatchFile(manifest.outputs["kaiju_taxon_counts"]),
+            metrics=[],
+        )
+        for manifest in cohort.complete
+    ]
+
+
+def write_manifests(
+    cohort: CohortState, outputs: Dict[str, Dict[str, str]], out_dir: Path
+) -> List[LatchFile]:
+    """Manifests for the samples processed in this run, given their outputs
+
+    Previews are not recorded, their outputs stand in for no full run.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    manifests = []
+    for sample_name, sample_outputs in outputs.items():
+        if sample_name.endswith(PREVIEW_SUFFIX):
+            continue
+        manifest = SampleManifest(
+            sample_name=sample_name,
+            input_fingerprint=cohort.input_fingerprints[sample_name],
+            params_hash=cohort.params_hash,
+            outputs=sample_outputs,
+        )
+        local = out_dir.joinpath(f"{sample_name}.json")
+        local.write_text(manifest.to_json(indent=2))
+        manifests.append(
+            LatchFile(str(local), f"{output_prefix(sample_name)}/{MANIFEST_NAME}")
+        )
+
+    return manifests
+
+
+def previous_dirs(cohort: CohortState, field: str) -> List[LatchDir]:
+    """The skipped samples' recorded outputs for one WfResults field
+
+    Manifests written before a field existed have no output for it.
+    """
+    return [
+        LatchDir(manifest.outputs[field])
+        for manifest in cohort.complete
+        if field in manifest.outputs
+    ]
+
+
+def previous_files(cohort: CohortState, field: str) -> List[LatchFile]:
+    return [
+        LatchFile(manifest.outputs[field])
+        for manifest in cohort.complete
+        if field in manifest.outputs
+    ]
@@ -2,16 +2,43 @@
 Taxonomic classification of reads
 """
 
-import subprocess
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from dataclasses_json import dataclass_json
-from latch import large_task, map_task, message, small_task, workflow
+from latch import large_task, medium_task, message, small_task, workflow
 from latch.types import LatchFile
 
-from .types import Sample, TaxonRank
+from . import kaiju_format
+from .batch import (
+    batch_map,
+    high_memory_task,
+    out_of_memory_inputs,
+    present,
+    records_out_of_memory,
+)
+from .images import CLASSIFICATION, GLUE
+from .planner import CHUNK_READS, SCATTER_MIN_READS, estimate_reads
+from .preflight import ReadProfile
+from .runner import run, run_pipeline
+from .settings import file_uri, read_settings, write_settings
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import Sample, TaxonRank, output_prefix
+
+
+@dataclass_json
+@dataclass
+class KaijuSettings:
+    # Reference files, by their file_uri
+    kaiju_ref_db: str
+    kaiju_ref_nodes: str
+    kaiju_ref_names: str
+    taxon_rank: TaxonRank
+    scatter_min_reads: int = SCATTER_MIN_READS
+    chunk_reads: int = CHUNK_READS
+    compact_output: bool = False
 
 
 @dataclass_json
@@ -20,10 +47,19 @@ class KaijuSample:
     sample_name: str
     read1: LatchFile
     read2: LatchFile
-    kaiju_ref_db: LatchFile
-    kaiju_ref_nodes: LatchFile
-    kaiju_ref_names: LatchFile
-    taxon_rank: TaxonRank
+    # KaijuSettings, one file for every sample and chunk of the run
+    settings: LatchFile
+    chunk: Optional[int] = None
+    # Counted by the pre-flight checks, estimated from the reads if unknown
+    read_pairs: Optional[int] = None
+
+
+@dataclass_json
+@dataclass
+class KaijuChunks:
+    sample_name: str
+    chunks: List[KaijuSample]
+    metrics: List[TaskMetrics]
 
 
 @dataclass_json
@@ -31,9 +67,26 @@ class KaijuSample:
 class KaijuOut:
     sample_name: str
     kaiju_out: LatchFile
-    kaiju_ref_nodes: LatchFile
-    kaiju_ref_names: LatchFile
-    taxon_rank: TaxonRank
+    settings: LatchFile
+    metrics: List[TaskMetrics]
+    chunk: Optional[int] = None
+
+
+@dataclass_json
+@dataclass
+class KaijuChunkOuts:
+    sample_name: str
+    chunk_outs: List[KaijuOut]
+
+
+@dataclass_json
+@dataclass
+class KaijuTableOut:
+    sample_name: str
+    kaiju_table: LatchFile
+    # Reads per taxon id at any rank, the abundance matrices' input
+    taxon_counts: LatchFile
+    metrics: List[TaskMetrics]
 
 
 @dataclass_json
@@ -41,27 +94,51 @@ class KaijuOut:
 class KronaInput:
     sample_name: str
     krona_txt: LatchFile
+    metrics: List[TaskMetrics]
+
+
+@dataclass_json
+@dataclass
+class KronaOut:
+    sample_name: str
+    krona_plot: LatchFile
+    metrics: List[TaskMetrics]
 
 
-@small_task
+@small_task(container_image=GLUE)
 def organize_kaiju_inputs(
     samples: List[Sample],
+    read_profiles: List[ReadProfile],
     kaiju_ref_db: LatchFile,
     kaiju_ref_nodes: LatchFile,
     kaiju_ref_names: LatchFile,
     taxon_rank: TaxonRank,
+    scatter_min_reads: int = SCATTER_MIN_READS,
+    chunk_reads: int = CHUNK_READS,
+    compact_output: bool = False,
 ) -> List[KaijuSample]:
 
+    read_pairs = {profile.sample_name: profile.read_pairs for profile in read_profiles}
+    settings = write_settings(
+        KaijuSettings(
+            kaiju_ref_db=file_uri(kaiju_ref_db),
+            kaiju_ref_nodes=file_uri(kaiju_ref_nodes),
+            kaiju_ref_names=file_uri(kaiju_ref_names),
+            taxon_rank=taxon_rank,
+            scatter_min_reads=scatter_min_reads,
+            chunk_reads=chunk_reads,
+            compact_output=compact_output,
+        )
+    )
+
     inputs = []
     for sample in samples:
         cur_input = KaijuSample(
             read1=sample.read1,
             read2=sample.read2,
             sample_name=sample.sample_name,
-            kaiju_ref_db=kaiju_ref_db,
-            kaiju_ref_nodes=kaiju_ref_nodes,
-            kaiju_ref_names=kaiju_ref_names,
-            taxon_rank=taxon_rank,
+            settings=settings,
+            read_pairs=read_pairs.get(sample.sample_name),
         )
 
         inputs.append(cur_input)
@@ -69,106 +146,382 @@ def organize_kaiju_inputs(
     return inputs
 
 
-@large_task
+def _split_cmds(read_file: str, chunk_reads: int, prefix: Path) -> List[List[str]]:
+    """Stream a FASTQ into gzipped chunks of ``chunk_reads`` records"""
+    return [
+        ["gzip", "-dcf", read_file],
+        [
+            "split",
+            "-l",
+            str(4 * chunk_reads),
+            "-d",
+            "-a",
+            "4",
+            "--additional-suffix=.fastq.gz",
+            "--filter=gzip -1 > $FILE",
+            "-",
+            str(prefix),
+        ],
+    ]
+
+
+@medium_task(container_image=GLUE)
+def split_kaiju_reads(kaiju_input: KaijuSample) -> KaijuChunks:
+    """Split a deep sample's read pairs into aligned chunks for Kaiju"""
+
+    sample_name = kaiju_input.sample_name
+    settings = read_settings(KaijuSettings, kaiju_input.settings)
+    read_pairs = kaiju_input.read_pairs
+    if read_pairs is None:
+        read_pairs, _ = estimate_reads(Path(kaiju_input.read1.local_path))
+
+    if read_pairs <= settings.scatter_min_reads:
+        return KaijuChunks(sample_name=sample_name, chunks=[kaiju_input], metrics=[])
+
+    message(
+        "info",
+        {
+            "title": f"Scattering Kaiju for {sample_name}",
+            "body": f"~{read_pairs} read pairs, {settings.chunk_reads} per chunk",
+        },
+    )
+
+    chunk_dir = Path(f"{sample_name}_chunks").resolve()
+    chunk_dir.mkdir(exist_ok=True)
+
+    # Both mates are cut at the same record counts, so chunk i of read 1
+    # pairs up with chunk i of read 2.
+    prefixes = [chunk_dir.joinpath(f"{sample_name}_{mate}_") for mate in (1, 2)]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        splits = [
+            pool.submit(
+                run_pipeline, _split_cmds(read.local_path, settings.chunk_reads, prefix)
+            )
+            for read, prefix in zip((kaiju_input.read1, kaiju_input.read2), prefixes)
+        ]
+        for split in splits:
+            split.result()
+
+    read1_chunks, read2_chunks = [
+        sorted(chunk_dir.glob(f"{prefix.name}*.fastq.gz")) for prefix in prefixes
+    ]
+    if len(read1_chunks) != len(read2_chunks):
+        raise RuntimeError(
+            f"{sample_name}: read files split into {len(read1_chunks)} and "
+            f"{len(read2_chunks)} chunks, do they hold the same number of reads?"
+        )
+
+    chunks = [
+        replace(
+            kaiju_input,
+            read1=LatchFile(str(read1)),
+            read2=LatchFile(str(read2)),
+            chunk=i,
+        )
+        for i, (read1, read2) in enumerate(zip(read1_chunks, read2_chunks))
+    ]
+
+    return KaijuChunks(
+        sample_name=sample_name,
+        chunks=chunks,
+        metrics=[
+            collect(
+                sample_name,
+                "kaiju_split",
+                read_bytes=file_sizes(
+                    kaiju_input.read1.local_path, kaiju_input.read2.local_path
+                ),
+            )
+        ],
+    )
+
+
+@small_task(container_image=GLUE)
+def flatten_kaiju_chunks(
+    kaiju_chunks: List[Optional[KaijuChunks]],
+) -> List[KaijuSample]:
+    return [chunk for sample in present(kaiju_chunks) for chunk in sample.chunks]
+
+
+def _kaiju_element(kaiju_input: KaijuSample) -> str:
+    if kaiju_input.chunk is None:
+        return kaiju_input.sample_name
+    return f"{kaiju_input.sample_name}.{kaiju_input.chunk:04d}"
+
+
+@large_task(container_image=CLASSIFICATION)
+@records_out_of_memory(_kaiju_element)
 def taxonomy_classification_task(kaiju_input: KaijuSample) -> KaijuOut:
     """Classify metagenomic reads with Kaiju"""
 
     sample_name = kaiju_input.sample_name
-    output_name = f"{sample_name}_kaiju.out"
+    settings = read_settings(KaijuSettings, kaiju_input.settings)
+    kaiju_ref_db = LatchFile(settings.kaiju_ref_db).local_path
+    suffix = "kjc" if settings.compact_output else "out"
+    output_name = f"{sample_name}_kaiju.{suffix}"
+    if kaiju_input.chunk is not None:
+        output_name = f"{sample_name}_kaiju.{kaiju_input.chunk:04d}.{suffix}"
     kaiju_out = Path(output_name).resolve()
 
     _kaiju_cmd = [
         "kaiju",
         "-t",
-        kaiju_input.kaiju_ref_nodes.local_path,
+        LatchFile(settings.kaiju_ref_nodes).local_path,
         "-f",
-        kaiju_input.kaiju_ref_db.local_path,
+        kaiju_ref_db,
         "-i",
         kaiju_input.read1.local_path,
         "-j",
         kaiju_input.read2.local_path,
         "-z",
         "96",
-        "-o",
-        str(kaiju_out),
     ]
 
-    subprocess.run(_kaiju_cmd)
+    if settings.compact_output:
+        # Without -o, kaiju writes to stdout and the text never hits the disk
+        run_pipeline(
+            [_kaiju_cmd, kaiju_format.encode_cmd(kaiju_out)], outputs=[kaiju_out]
+        )
+    else:
+        run(_kaiju_cmd + ["-o", str(kaiju_out)], outputs=[kaiju_out])
+
+    if kaiju_input.chunk is None:
+        kaiju_file = LatchFile(
+            str(kaiju_out), f"{output_prefix(sample_name)}/kaiju/{output_name}"
+        )
+    else:
+        # Chunk outputs are only kept until they are merged
+        kaiju_file = LatchFile(str(kaiju_out))
 
     return KaijuOut(
         sample_name=kaiju_input.sample_name,
+        kaiju_out=kaiju_file,
+        settings=kaiju_input.settings,
+        chunk=kaiju_input.chunk,
+        metrics=[
+            collect(
+                sample_name,
+                "kaiju",
+                read_bytes=file_sizes(
+                    kaiju_input.read1.local_path, kaiju_input.read2.local_path
+                ),
+                db_bytes=file_sizes(kaiju_ref_db),
+            )
+        ],
+    )
+
+
+@high_memory_task(container_image=CLASSIFICATION)
+def taxonomy_classification_task_retry(kaiju_input: KaijuSample) -> KaijuOut:
+    """Kaiju on a high-memory node, for samples or chunks that ran out of memory"""
+    return taxonomy_classification_task.task_function(kaiju_input)
+
+
+@small_task(container_image=GLUE)
+def failed_kaiju_inputs(
+    inputs: List[KaijuSample], results: List[Optional[KaijuOut]]
+) -> List[KaijuSample]:
+    return out_of_memory_inputs(
+        taxonomy_classification_task, inputs, results, _kaiju_element
+    )
+
+
+@small_task(container_image=GLUE)
+def group_kaiju_chunks(
+    kaiju_chunks: List[Optional[KaijuChunks]],
+    kaiju_outs: List[Optional[KaijuOut]],
+    retried_kaiju_outs: List[Optional[KaijuOut]],
+) -> List[KaijuChunkOuts]:
+
+    by_sample: Dict[str, List[KaijuOut]] = {}
+    for kaiju_out in present(kaiju_outs + retried_kaiju_outs):
+        by_sample.setdefault(kaiju_out.sample_name, []).append(kaiju_out)
+
+    grouped = []
+    for sample in present(kaiju_chunks):
+        chunk_outs = sorted(
+            by_sample.get(sample.sample_name, []), key=lambda out: out.chunk or 0
+        )
+        if len(chunk_outs) != len(sample.chunks):
+            # A chunk failed, a partial output would undercount the sample
+            continue
+        # The split metrics travel with the first chunk to the merged output
+        chunk_outs[0].metrics = sample.metrics + chunk_outs[0].metrics
+        grouped.append(
+            KaijuChunkOuts(sample_name=sample.sample_name, chunk_outs=chunk_outs)
+        )
+
+    return grouped
+
+
+@small_task(container_image=GLUE)
+def merge_kaiju_chunks(kaiju_chunk_outs: KaijuChunkOuts) -> KaijuOut:
+    """Concatenate per-chunk Kaiju outputs in chunk order"""
+
+    chunk_outs = kaiju_chunk_outs.chunk_outs
+    if len(chunk_outs) == 1 and chunk_outs[0].chunk is None:
+        return chunk_outs[0]
+
+    sample_name = kaiju_chunk_outs.sample_name
+    chunk_paths = [out.kaiju_out.local_path for out in chunk_outs]
+
+    if kaiju_format.is_compact(chunk_paths[0]):
+        output_name = f"{sample_name}_kaiju.kjc"
+        kaiju_out = Path(output_name).resolve()
+        kaiju_format.concat(chunk_paths, kaiju_out)
+    else:
+        output_name = f"{sample_name}_kaiju.out"
+        kaiju_out = Path(output_name).resolve()
+        run(["cat", *chunk_paths], stdout=kaiju_out, outputs=[kaiju_out])
+
+    return KaijuOut(
+        sample_name=sample_name,
         kaiju_out=LatchFile(
-            str(kaiju_out), f"latch:///metamage/{sample_name}/kaiju/{output_name}"
+            str(kaiju_out), f"{output_prefix(sample_name)}/kaiju/{output_name}"
         ),
-        kaiju_ref_nodes=kaiju_input.kaiju_ref_nodes,
-        kaiju_ref_names=kaiju_input.kaiju_ref_names,
-        taxon_rank=kaiju_input.taxon_rank,
+        settings=chunk_outs[0].settings,
+        metrics=[metrics for out in chunk_outs for metrics in out.metrics]
+        + [collect(sample_name, "kaiju_merge", chunks=len(chunk_outs))],
     )
 
 
-@small_task
-def kaiju2table_task(kaiju_out: KaijuOut) -> LatchFile:
+def _kaiju_source(kaiju_out: KaijuOut) -> Tuple[List[List[str]], str]:
+    """Commands to pipe ahead of a Kaiju tool, and the input path it reads
+
+    Compact outputs are streamed back as classic text through stdin.
+    """
+    path = kaiju_out.kaiju_out.local_path
+    if kaiju_format.is_compact(path):
+        return [kaiju_format.export_cmd(path)], "/dev/stdin"
+    return [], path
+
+
+@small_task(container_image=CLASSIFICATION)
+@records_out_of_memory()
+def kaiju2table_task(kaiju_out: KaijuOut) -> KaijuTableOut:
     """Convert Kaiju output to TSV format"""
 
     sample_name = kaiju_out.sample_name
+    settings = read_settings(KaijuSettings, kaiju_out.settings)
     output_name = f"{sample_name}_kaiju.tsv"
     kaijutable_tsv = Path(output_name).resolve()
+    source_cmds, kaiju_out_path = _kaiju_source(kaiju_out)
 
     _kaiju2table_cmd = [
         "kaiju2table",
         "-t",
-        kaiju_out.kaiju_ref_nodes.local_path,
+        LatchFile(settings.kaiju_ref_nodes).local_path,
         "-n",
-        kaiju_out.kaiju_ref_names.local_path,
+        LatchFile(settings.kaiju_ref_names).local_path,
         "-r",
-        kaiju_out.taxon_rank.value,
+        settings.taxon_rank.value,
         "-p",
         "-e",
         "-o",
         str(kaijutable_tsv),
-        kaiju_out.kaiju_out.local_path,
+        kaiju_out_path,
     ]
 
-    subprocess.run(_kaiju2table_cmd)
+    run_pipeline(source_cmds + [_kaiju2table_cmd], outputs=[kaijutable_tsv])
 
-    return LatchFile(
-        str(kaijutable_tsv),
-        f"latch:///metamage/{sample_name}/kaiju/{output_name}",
+    # kaiju2table only reports the selected rank, these counts roll up to any
+    counts_name = f"{sample_name}_kaiju_taxa.tsv"
+    counts_tsv = Path(counts_name).resolve()
+    with open(counts_tsv, "w") as f:
+        f.write("taxon_id\treads\n")
+        for taxid, reads in sorted(
+            kaiju_format.taxon_counts(kaiju_out.kaiju_out.local_path).items()
+        ):
+            f.write(f"{taxid}\t{reads}\n")
+
+    return KaijuTableOut(
+        sample_name=sample_name,
+        kaiju_table=LatchFile(
+            str(kaijutable_tsv),
+            f"{output_prefix(sample_name)}/kaiju/{output_name}",
+        ),
+        taxon_counts=LatchFile(
+            str(counts_tsv),
+            f"{output_prefix(sample_name)}/kaiju/{counts_name}",
+        ),
+        metrics=kaiju_out.metrics
+        + [
+            collect(
+                sample_name,
+                "kaiju2table",
+                kaiju_out_bytes=file_sizes(kaiju_out.kaiju_out.local_path),
+            )
+        ],
     )
 
 
-@small_task
+@small_task(container_image=GLUE)
+def organize_table_inputs(kaiju_outs: List[Optional[KaijuOut]]) -> List[KaijuOut]:
+    return present(kaiju_outs)
+
+
+@medium_task(container_image=CLASSIFICATION)
+def kaiju2table_retry(kaiju_out: KaijuOut) -> KaijuTableOut:
+    """kaiju2table_task on a bigger node, for samples that ran out of memory"""
+    return kaiju2table_task.task_function(kaiju_out)
+
+
+@small_task(container_image=GLUE)
+def failed_table_inputs(
+    inputs: List[KaijuOut], results: List[Optional[KaijuTableOut]]
+) -> List[KaijuOut]:
+    return out_of_memory_inputs(kaiju2table_task, inputs, results)
+
+
+@small_task(container_image=GLUE)
+def organize_kaiju_tables(
+    kaiju_tables: List[Optional[KaijuTableOut]],
+    retried_tables: List[Optional[KaijuTableOut]],
+) -> List[KaijuTableOut]:
+    return present(kaiju_tables + retried_tables)
+
+
+@small_task(container_image=CLASSIFICATION)
 def kaiju2krona_task(kaiju_out: KaijuOut) -> KronaInput:
     """Convert Kaiju output to Krona-readable format"""
 
     sample_name = kaiju_out.sample_name
+    settings = read_settings(KaijuSettings, kaiju_out.settings)
     output_name = f"{sample_name}_kaiju2krona.out"
     krona_txt = Path(output_name).resolve()
+    source_cmds, kaiju_out_path = _kaiju_source(kaiju_out)
 
     _kaiju2krona_cmd = [
         "kaiju2krona",
         "-t",
-        kaiju_out.kaiju_ref_nodes.local_path,
+        LatchFile(settings.kaiju_ref_nodes).local_path,
         "-n",
-        kaiju_out.kaiju_ref_names.local_path,
+        LatchFile(settings.kaiju_ref_names).local_path,
         "-i",
-        kaiju_out.kaiju_out.local_path,
+        kaiju_out_path,
         "-o",
         str(krona_txt),
     ]
 
-    subprocess.run(_kaiju2krona_cmd)
+    run_pipeline(source_cmds + [_kaiju2krona_cmd], outputs=[krona_txt])
 
     return KronaInput(
         sample_name=sample_name,
         krona_txt=LatchFile(
-            str(krona_txt), f"latch:///metamage/{sample_name}/kaiju/{output_name}"
+            str(krona_txt), f"{output_prefix(sample_name)}/kaiju/{output_name}"
         ),
+        metrics=[
+            collect(
+                sample_name,
+                "kaiju2krona",
+                kaiju_out_bytes=file_sizes(kaiju_out.kaiju_out.local_path),
+            )
+        ],
     )
 
 
-@small_task
-def plot_krona_task(krona_input: KronaInput) -> LatchFile:
+@small_task(container_image=CLASSIFICATION)
+def plot_krona_task(krona_input: KronaInput) -> KronaOut:
     """Make Krona plot from Kaiju results"""
     sample_name = krona_input.sample_name
     output_name = f"{sample_name}_krona.html"
@@ -181,32 +534,77 @@ def plot_krona_task(krona_input: KronaInput) -> LatchFile:
         krona_input.krona_txt.local_path,
     ]
 
-    subprocess.run(_kaiju2krona_cmd)
+    run(_kaiju2krona_cmd, outputs=[krona_html])
 
-    return LatchFile(
-        str(krona_html), f"latch:///metamage/{sample_name}/kaiju/{output_name}"
+    return KronaOut(
+        sample_name=sample_name,
+        krona_plot=LatchFile(
+            str(krona_html), f"{output_prefix(sample_name)}/kaiju/{output_name}"
+        ),
+        metrics=krona_input.metrics
+        + [
+            collect(
+                sample_name,
+                "krona_plot",
+                krona_txt_bytes=file_sizes(krona_input.krona_txt.local_path),
+            )
+        ],
     )
 
 
 @workflow
 def kaiju_wf(
     samples: List[Sample],
+    read_profiles: List[ReadProfile],
     kaiju_ref_db: LatchFile,
     kaiju_ref_nodes: LatchFile,
     kaiju_ref_names: LatchFile,
     taxon_rank: TaxonRank,
-) -> List[LatchFile]:
+    scatter_min_reads: int = SCATTER_MIN_READS,
+    chunk_reads: int = CHUNK_READS,
+    compact_output: bool = False,
+) -> List[KaijuTableOut]:
 
     kaiju_inputs = organize_kaiju_inputs(
         samples=samples,
+        read_profiles=read_profiles,
         kaiju_ref_db=kaiju_ref_db,
         kaiju_ref_nodes=kaiju_ref_nodes,
         kaiju_ref_names=kaiju_ref_names,
         taxon_rank=taxon_rank,
+        scatter_min_reads=scatter_min_reads,
+        chunk_reads=chunk_reads,
+        compact_output=compact_output,
     )
 
-    kaiju_outfiles = map_task(taxonomy_classification_task)(kaiju_input=kaiju_inputs)
+    kaiju_chunks = batch_map(split_kaiju_reads)(kaiju_input=kaiju_inputs)
+
+    chunk_inputs = flatten_kaiju_chunks(kaiju_chunks=kaiju_chunks)
 
-    kaiju2table_out = map_task(kaiju2table_task)(kaiju_out=kaiju_outfiles)
+    chunk_outfiles = batch_map(taxonomy_classification_task)(
+        kaiju_input=chunk_inputs
+    )
+
+    # Samples or chunks that ran out of memory get one more try on a bigger node
+    retried_chunk_outfiles = batch_map(taxonomy_classification_task_retry)(
+        kaiju_input=failed_kaiju_inputs(inputs=chunk_inputs, results=chunk_outfiles)
+    )
 
-    return kaiju2table_out
+    grouped_outfiles = group_kaiju_chunks(
+        kaiju_chunks=kaiju_chunks,
+        kaiju_outs=chunk_outfiles,
+        retried_kaiju_outs=retried_chunk_outfiles,
+    )
+
+    kaiju_outfiles = batch_map(merge_kaiju_chunks)(kaiju_chunk_outs=grouped_outfiles)
+
+    table_inputs = organize_table_inputs(kaiju_outs=kaiju_outfiles)
+    kaiju2table_out = batch_map(kaiju2table_task)(kaiju_out=table_inputs)
+
+    # Samples that ran out of memory get one more try on a bigger node
+    failed_tables = failed_table_inputs(inputs=table_inputs, results=kaiju2table_out)
+    retried_tables = batch_map(kaiju2table_retry)(kaiju_out=failed_tables)
+
+    return organize_kaiju_tables(
+        kaiju_tables=kaiju2table_out, retried_tables=retried_tables
+    )
@@ -0,0 +1,257 @@
+"""
+Compact columnar storage for Kaiju read assignments
+
+A ``.kjc`` file is a magic line followed by independent blocks of up to
+``BLOCK_RECORDS`` reads. Each block holds three zlib-compressed columns:
+
+- runs: alternating run lengths of unclassified and classified reads,
+  starting with unclassified (uint32)
+- taxids: the taxon of every classified read, in order (uint32)
+- names: read names front-coded against the previous name in the block,
+  as one byte of shared prefix length followed by the rest of the name
+
+Blocks do not refer to each other, so files are concatenated by appending
+blocks. Only the three default columns of ``kaiju`` output are kept.
+
+    python -m wf.kaiju_format encode kaiju.out sample.kjc
+    python -m wf.kaiju_format export sample.kjc > kaiju.out
+"""
+
+import struct
+import sys
+import zlib
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple, Union
+
+MAGIC = b"KJC1\n"
+BLOCK_RECORDS = 1_000_000
+COMPRESSION_LEVEL = 6
+
+# records, then the compressed sizes of the runs, taxids and names columns
+_BLOCK_HEADER = struct.Struct("<IIII")
+
+Record = Tuple[str, bytes, int]
+
+
+def is_compact(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _uint32(values: Iterable[int]) -> bytes:
+    packed = array("I", values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_uint32(data: bytes) -> array:
+    values = array("I")
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _encode_block(records: List[Record]) -> bytes:
+    runs: List[int] = []
+    taxids: List[int] = []
+    names = bytearray()
+
+    classified = False
+    run = 0
+    previous = b""
+    for status, name, taxid in records:
+        is_classified = status == "C"
+        if is_classified != classified:
+            runs.append(run)
+            classified, run = is_classified, 0
+        run += 1
+        if is_classified:
+            taxids.append(taxid)
+
+        shared = 0
+        limit = min(len(name), len(previous), 255)
+        while shared < limit and name[shared] == previous[shared]:
+            shared += 1
+        names.append(shared)
+        names += name[shared:]
+        names.append(0x0A)
+        previous = name
+    runs.append(run)
+
+    columns = [
+        zlib.compress(column, COMPRESSION_LEVEL)
+        for column in (_uint32(runs), _uint32(taxids), bytes(names))
+    ]
+    header = _BLOCK_HEADER.pack(len(records), *(len(c) for c in columns))
+    return header + b"".join(columns)
+
+
+def _decode_block(header: bytes, f: BinaryIO) -> Iterator[Record]:
+    n, *sizes = _BLOCK_HEADER.unpack(header)
+    runs, taxids, names = (zlib.decompress(f.read(size)) for size in sizes)
+    runs, taxids = _unpack_uint32(runs), _unpack_uint32(taxids)
+
+    pos = 0
+    previous = b""
+    taxid_index = 0
+    for run_index, run in enumerate(runs):
+        classified = run_index % 2 == 1
+        for _ in range(run):
+            shared = names[pos]
+            end = names.index(b"\n", pos + 1)
+            name = previous[:shared] + names[pos + 1 : end]
+            pos, previous = end + 1, name
+
+            if classified:
+                yield "C", name, taxids[taxid_index]
+                taxid_index += 1
+            else:
+                yield "U", name, 0
+
+
+def parse_text(lines: Iterable[bytes]) -> Iterator[Record]:
+    """Records from classic ``kaiju`` output lines"""
+    for line in lines:
+        status, name, taxid = line.rstrip(b"\n").split(b"\t")[:3]
+        yield status.decode(), name, int(taxid)
+
+
+def write_records(records: Iterable[Record], out: BinaryIO):
+    out.write(MAGIC)
+    block: List[Record] = []
+    for record in records:
+        block.append(record)
+        if len(block) == BLOCK_RECORDS:
+            out.write(_encode_block(block))
+            block = []
+    if block:
+        out.write(_encode_block(block))
+
+
+def _blocks(f: BinaryIO) -> Iterator[Tuple[bytes, bytes]]:
+    """(header, compressed columns) of every block, without decoding them"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{f.name} is not a compact Kaiju file")
+    while True:
+        header = f.read(_BLOCK_HEADER.size)
+        if not header:
+            return
+        if len(header) < _BLOCK_HEADER.size:
+            raise ValueError(f"{f.name} is truncated")
+        _, *sizes = _BLOCK_HEADER.unpack(header)
+        yield header, f.read(sum(sizes))
+
+
+def read_records(path: Union[str, Path]) -> Iterator[Record]:
+    """Stream (status, read name, taxid) from a ``.kjc`` or text file"""
+    if not is_compact(path):
+        with open(path, "rb") as f:
+            yield from parse_text(f)
+        return
+
+    with open(path, "rb") as f:
+        f.read(len(MAGIC))
+        while True:
+            header = f.read(_BLOCK_HEADER.size)
+            if not header:
+                return
+            yield from _decode_block(header, f)
+
+
+def taxon_counts(path: Union[str, Path]) -> Dict[int, int]:
+    """Reads assigned to each taxon, unclassified reads under taxon 0
+
+    Compact files are counted from their runs and taxids columns alone,
+    without decoding the read names.
+    """
+    counts: Counter = Counter()
+    if not is_compact(path):
+        for status, _, taxid in read_records(path):
+            counts[taxid if status == "C" else 0] += 1
+        return dict(counts)
+
+    with open(path, "rb") as f:
+        for header, columns in _blocks(f):
+            _, runs_size, taxids_size, _ = _BLOCK_HEADER.unpack(header)
+            runs = _unpack_uint32(zlib.decompress(columns[:runs_size]))
+            taxids = _unpack_uint32(
+                zlib.decompress(columns[runs_size : runs_size + taxids_size])
+            )
+            counts[0] += sum(runs[::2])
+            counts.update(taxids)
+    return {taxid: reads for taxid, reads in counts.items() if reads}
+
+
+def encode(text: BinaryIO, out_path: Union[str, Path]):
+    with open(out_path, "wb") as out:
+        write_records(parse_text(text), out)
+
+
+def export(path: Union[str, Path], out: BinaryIO):
+    """Write the classic tab-separated ``kaiju`` output"""
+    for status, name, taxid in read_records(path):
+        out.write(b"%s\t%s\t%d\n" % (status.encode(), name, taxid))
+
+
+def concat(paths: Iterable[Union[str, Path]], out_path: Union[str, Path]):
+    with open(out_path, "wb") as out:
+        out.write(MAGIC)
+        for path in paths:
+            with open(path, "rb") as f:
+                for header, columns in _blocks(f):
+                    out.write(header)
+                    out.write(columns)
+
+
+def _command(*args: str) -> List[str]:
+    # Executing this file directly would put wf/ first on the path, where
+    # wf/types.py shadows the stdlib, so it is loaded by location instead.
+    # That also skips importing the workflow package and its dependencies.
+    loader = (
+        "import sys, importlib.util as u;"
+        f" s = u.spec_from_file_location('kaiju_format', {str(Path(__file__).resolve())!r});"
+        " m = u.module_from_spec(s); s.loader.exec_module(m); sys.exit(m.main())"
+    )
+    return [sys.executable, "-c", loader, *args]
+
+
+def encode_cmd(out_path: Union[str, Path]) -> List[str]:
+    """Command that compacts ``kaiju`` output from stdin into ``out_path``"""
+    return _command("encode", "-", str(out_path))
+
+
+def export_cmd(path: Union[str, Path]) -> List[str]:
+    """Command that streams ``path`` as classic ``kaiju`` output to stdout"""
+    return _command("export", str(path))
+
+
+def main(argv: List[str] = None) -> int:
+    command, *args = argv if argv is not None else sys.argv[1:]
+
+    if command == "encode":
+        source, out_path = args
+        if source == "-":
+            encode(sys.stdin.buffer, out_path)
+        else:
+            with open(source, "rb") as text:
+                encode(text, out_path)
+    elif command == "export":
+        (path,) = args
+        try:
+            export(path, sys.stdout.buffer)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader stopped early, let it report the error
+            return 0
+    else:
+        print(f"unknown command {command!r}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,679 @@
+"""
+Run the metamage_quick DAG on a local process pool, off-platform
+"""
+
+import dataclasses
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib import import_module
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from latch.types import LatchDir, LatchFile
+
+from . import telemetry
+from .batch import MIN_SUCCESS_RATIO, OOM_MARKERS_ENV
+from .runner import STANDIN_ENV
+from .types import (
+    AssemblyStatsMode,
+    ProdigalOutput,
+    ReadMapper,
+    Sample,
+    TaxonRank,
+    fARGeneModel,
+)
+
+STANDIN_TOOL = Path(__file__).resolve().parents[1].joinpath(
+    "scripts", "standin_tool.py"
+)
+
+
+class _PathRef(NamedTuple):
+    is_dir: bool
+    local: str
+    remote: Optional[str]
+
+
+class _Record(NamedTuple):
+    cls: type
+    fields: Dict[str, Any]
+
+
+def _freeze(obj: Any) -> Any:
+    """Turn task values into plain picklable data to cross process boundaries"""
+    if isinstance(obj, (LatchFile, LatchDir)):
+        return _PathRef(isinstance(obj, LatchDir), str(obj.path), obj.remote_path)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return _Record(
+            type(obj),
+            {f.name: _freeze(getattr(obj, f.name)) for f in dataclasses.fields(obj)},
+        )
+    if isinstance(obj, list):
+        return [_freeze(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: _freeze(v) for k, v in obj.items()}
+    return obj
+
+
+def _thaw(obj: Any) -> Any:
+    if isinstance(obj, _PathRef):
+        cls = LatchDir if obj.is_dir else LatchFile
+        # Outputs name their latch:/// destination, which nothing uploads to
+        # off the platform, and latch would download from it on first access
+        if obj.remote and obj.remote.startswith("file://"):
+            return cls(obj.local, obj.remote)
+        return cls(obj.local)
+    if isinstance(obj, _Record):
+        return obj.cls(**{k: _thaw(v) for k, v in obj.fields.items()})
+    if isinstance(obj, list):
+        return [_thaw(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: _thaw(v) for k, v in obj.items()}
+    return obj
+
+
+def _function(task: Any):
+    """The plain Python function behind a latch task"""
+    return getattr(task, "task_function", task)
+
+
+def _run_task(module: str, name: str, workdir: str, kwargs: Dict[str, Any]) -> Any:
+    fn = _function(getattr(import_module(module), name))
+
+    # Tasks write their outputs relative to the working directory, as they
+    # do in their own container on the platform.
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+    telemetry.start_task()
+
+    return _freeze(fn(**{k: _thaw(v) for k, v in kwargs.items()}))
+
+
+def local_file(path: str) -> str:
+    return path[len("file://") :] if path.startswith("file://") else path
+
+
+def use_standins(profile: Optional[Path] = None):
+    """Replace every tool with scripts/standin_tool.py in this and child processes"""
+    os.environ[STANDIN_ENV] = str(STANDIN_TOOL)
+    if profile is not None:
+        os.environ["METAMAGE_STANDIN_PROFILE"] = str(Path(profile).resolve())
+
+
+class LocalExecutor:
+    """Runs map tasks on a process pool, one working directory per task"""
+
+    def __init__(self, workdir: Path, max_workers: Optional[int] = None):
+        self.workdir = Path(workdir).resolve()
+        self.workdir.mkdir(parents=True, exist_ok=True)
+
+        # Tasks that run out of memory leave their markers here rather than
+        # on latch, for the failed_*_inputs tasks to pick up
+        markers = self.workdir.joinpath("out_of_memory")
+        shutil.rmtree(markers, ignore_errors=True)
+        os.environ[OOM_MARKERS_ENV] = str(markers)
+
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self) -> "LocalExecutor":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def map(self, task: Any, **inputs: List[Any]) -> List[Any]:
+        """Like ``batch_map(task)(name=values)``, waiting for every element
+
+        Failed elements give None, as on the platform, unless fewer than
+        ``MIN_SUCCESS_RATIO`` of the elements succeed.
+        """
+        ((arg_name, values),) = inputs.items()
+        fn = _function(task)
+
+        labels = [getattr(value, "sample_name", None) for value in values]
+        futures = []
+        for i, value in enumerate(values):
+            label = labels[i]
+            if label is None or labels.count(label) > 1:
+                # e.g. the chunks of a scattered sample
+                label = f"{label}.{i:05d}" if label else f"{i:05d}"
+            workdir = self.workdir.joinpath(fn.__name__, label)
+            futures.append(
+                self.pool.submit(
+                    _run_task,
+                    fn.__module__,
+                    fn.__name__,
+                    str(workdir),
+                    {arg_name: _freeze(value)},
+                )
+            )
+
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(_thaw(future.result()))
+            except Exception as e:
+                results.append(None)
+                errors.append(e)
+
+        if errors and len(values) - len(errors) < MIN_SUCCESS_RATIO * len(values):
+            raise errors[0]
+        return results
+
+    def run(self, task: Any, **inputs: Any) -> Any:
+        """Run a single task on the pool, in its own working directory"""
+        fn = _function(task)
+        future = self.pool.submit(
+            _run_task,
+            fn.__module__,
+            fn.__name__,
+            str(self.workdir.joinpath(fn.__name__)),
+            _freeze(inputs),
+        )
+        return _thaw(future.result())
+
+    def call(self, task: Any, **inputs: Any) -> Any:
+        """Run a cheap organizing task in this process"""
+        return _function(task)(**inputs)
+
+
+def assembly_wf(
+    ex: LocalExecutor,
+    samples: List[Sample],
+    min_count: int,
+    k_min: int,
+    k_max: int,
+    k_step: int,
+    min_contig_len: int,
+    stats_mode: AssemblyStatsMode = AssemblyStatsMode.fast,
+    contig_length_tiers: Optional[List[int]] = None,
+):
+    from . import assembly
+
+    settings = ex.call(
+        assembly.organize_assembly_settings,
+        min_count=min_count,
+        k_min=k_min,
+        k_max=k_max,
+        k_step=k_step,
+        min_contig_len=min_contig_len,
+        length_tiers=contig_length_tiers or assembly.CONTIG_LENGTH_TIERS,
+        stats_mode=stats_mode,
+    )
+    megahit_inputs = ex.call(
+        assembly.organize_megahit_inputs, samples=samples, settings=settings
+    )
+    first_assembly_data = ex.map(assembly.megahit, megahit_input=megahit_inputs)
+    assembly_data = ex.call(
+        assembly.merge_megahit_outs,
+        results=first_assembly_data,
+        retried_results=ex.map(
+            assembly.megahit_retry,
+            megahit_input=ex.call(
+                assembly.failed_megahit_inputs,
+                inputs=megahit_inputs,
+                results=first_assembly_data,
+            ),
+        ),
+    )
+    evaluation_inputs = ex.call(
+        assembly.organize_evaluation_inputs,
+        megahit_outs=assembly_data,
+        settings=settings,
+    )
+    metaquast_results = ex.map(
+        assembly.evaluate_assembly, evaluation_input=evaluation_inputs
+    )
+    retried_results = ex.map(
+        assembly.evaluate_assembly_retry,
+        evaluation_input=ex.call(
+            assembly.failed_evaluation_inputs,
+            inputs=evaluation_inputs,
+            results=metaquast_results,
+        ),
+    )
+
+    return ex.call(
+        assembly.organize_assembly_outs,
+        megahit_outs=assembly_data,
+        metaquast_results=metaquast_results,
+        retried_results=retried_results,
+    )
+
+
+def binning_wf(
+    ex: LocalExecutor,
+    samples: List[Sample],
+    megahit_out: List[Any],
+    read_mapper: ReadMapper = ReadMapper.bowtie2,
+):
+    from . import binning
+
+    bwalign_inputs = ex.call(
+        binning.organize_bw_inputs,
+        assembly_outs=megahit_out,
+        samples=samples,
+        read_mapper=read_mapper,
+    )
+    jgi_inputs = ex.map(binning.map_reads, bwalign_input=bwalign_inputs)
+    retried_jgi_inputs = ex.map(
+        binning.map_reads_retry,
+        bwalign_input=ex.call(
+            binning.failed_mapping_inputs, inputs=bwalign_inputs, results=jgi_inputs
+        ),
+    )
+    depth_inputs = ex.call(
+        binning.organize_depth_inputs,
+        jgi_inputs=jgi_inputs,
+        retried_jgi_inputs=retried_jgi_inputs,
+    )
+    depth_files = ex.map(binning.summarize_contig_depths, jgi_input=depth_inputs)
+    retried_depth_files = ex.map(
+        binning.summarize_contig_depths_retry,
+        jgi_input=ex.call(
+            binning.failed_depth_inputs, inputs=depth_inputs, results=depth_files
+        ),
+    )
+    metabat_inputs = ex.call(
+        binning.organize_metabat_inputs,
+        assembly_data=megahit_out,
+        depth_files=depth_files,
+        retried_depth_files=retried_depth_files,
+    )
+    binning_results = ex.map(binning.metabat2, metabat_input=metabat_inputs)
+    retried_binning_results = ex.map(
+        binning.metabat2_retry,
+        metabat_input=ex.call(
+            binning.failed_metabat_inputs,
+            inputs=metabat_inputs,
+            results=binning_results,
+        ),
+    )
+    return ex.call(
+        binning.organize_binning_outs,
+        binning_results=binning_results,
+        retried_binning_results=retried_binning_results,
+    )
+
+
+def bin_taxonomy_wf(
+    ex: LocalExecutor,
+    binning_results: List[Any],
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+):
+    from . import bin_taxonomy
+
+    taxonomy_index = ex.run(
+        bin_taxonomy.build_taxonomy_index,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+    )
+    bin_contigs = ex.run(
+        bin_taxonomy.classify_bin_contigs,
+        binning_results=binning_results,
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+    )
+    inputs = ex.call(
+        bin_taxonomy.organize_bin_taxonomy_inputs,
+        bin_contigs=bin_contigs,
+        taxonomy_index=taxonomy_index,
+    )
+    results = ex.map(bin_taxonomy.annotate_bins, bin_taxonomy_input=inputs)
+    return ex.call(bin_taxonomy.organize_bin_taxonomy_outs, results=results)
+
+
+def kaiju_wf(
+    ex: LocalExecutor,
+    samples: List[Sample],
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    taxon_rank: TaxonRank,
+    scatter_min_reads: Optional[int] = None,
+    chunk_reads: Optional[int] = None,
+    compact_output: bool = False,
+    read_profiles: Optional[List[Any]] = None,
+):
+    from . import kaiju
+
+    kaiju_inputs = ex.call(
+        kaiju.organize_kaiju_inputs,
+        samples=samples,
+        read_profiles=read_profiles or [],
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+        taxon_rank=taxon_rank,
+        scatter_min_reads=scatter_min_reads or kaiju.SCATTER_MIN_READS,
+        chunk_reads=chunk_reads or kaiju.CHUNK_READS,
+        compact_output=compact_output,
+    )
+    kaiju_chunks = ex.map(kaiju.split_kaiju_reads, kaiju_input=kaiju_inputs)
+    chunk_inputs = ex.call(kaiju.flatten_kaiju_chunks, kaiju_chunks=kaiju_chunks)
+    chunk_outfiles = ex.map(
+        kaiju.taxonomy_classification_task, kaiju_input=chunk_inputs
+    )
+    retried_chunk_outfiles = ex.map(
+        kaiju.taxonomy_classification_task_retry,
+        kaiju_input=ex.call(
+            kaiju.failed_kaiju_inputs, inputs=chunk_inputs, results=chunk_outfiles
+        ),
+    )
+    grouped_outfiles = ex.call(
+        kaiju.group_kaiju_chunks,
+        kaiju_chunks=kaiju_chunks,
+        kaiju_outs=chunk_outfiles,
+        retried_kaiju_outs=retried_chunk_outfiles,
+    )
+    kaiju_outfiles = ex.map(kaiju.merge_kaiju_chunks, kaiju_chunk_outs=grouped_outfiles)
+    table_inputs = ex.call(kaiju.organize_table_inputs, kaiju_outs=kaiju_outfiles)
+    kaiju_tables = ex.map(kaiju.kaiju2table_task, kaiju_out=table_inputs)
+    retried_tables = ex.map(
+        kaiju.kaiju2table_retry,
+        kaiju_out=ex.call(
+            kaiju.failed_table_inputs, inputs=table_inputs, results=kaiju_tables
+        ),
+    )
+    return ex.call(
+        kaiju.organize_kaiju_tables,
+        kaiju_tables=kaiju_tables,
+        retried_tables=retried_tables,
+    )
+
+
+def functional_wf(
+    ex: LocalExecutor,
+    assembly_data: List[Any],
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_models: List[fARGeneModel],
+    fargene_all_models: bool = False,
+    share_gene_calls: bool = False,
+    colocate_tools: bool = False,
+):
+    from . import functional
+
+    functional_ins = ex.call(
+        functional.organize_functional_inputs,
+        assembly_data=assembly_data,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_models=fargene_hmm_models,
+        fargene_all_models=fargene_all_models,
+        share_gene_calls=share_gene_calls,
+    )
+
+    if colocate_tools:
+        return ex.call(
+            functional.organize_colocated_outputs,
+            func_outs=ex.map(
+                functional.annotate_colocated, functional_in=functional_ins
+            ),
+        )
+
+    def with_retry(retry_task, tool, results):
+        retried = ex.map(
+            retry_task,
+            functional_in=ex.call(
+                functional.failed_functional_inputs,
+                inputs=functional_ins,
+                results=results,
+                tool=tool,
+            ),
+        )
+        return ex.call(
+            functional.merge_tool_outs, results=results, retried_results=retried
+        )
+
+    if share_gene_calls:
+        prodigal_results = with_retry(
+            functional.prodigal_retry,
+            "prodigal",
+            ex.map(functional.prodigal, functional_in=functional_ins),
+        )
+        gene_calls_ins = ex.call(
+            functional.organize_gene_calls_inputs,
+            inputs=functional_ins,
+            prodigal_results=prodigal_results,
+        )
+        with ThreadPoolExecutor(max_workers=3) as tools:
+            futures = [
+                tools.submit(ex.map, task, gene_calls_in=gene_calls_ins)
+                for task in (
+                    functional.macrel_peptides,
+                    functional.fargene_amino,
+                    functional.gecco_cds,
+                )
+            ]
+        macrel_results, fargene_results, gecco_results = [
+            ex.call(
+                functional.merge_tool_outs,
+                results=f.result(),
+                retried_results=ex.map(
+                    retry_task,
+                    gene_calls_in=ex.call(
+                        functional.failed_gene_calls_inputs,
+                        inputs=gene_calls_ins,
+                        results=f.result(),
+                        tool=tool,
+                    ),
+                ),
+            )
+            for f, retry_task, tool in zip(
+                futures,
+                (
+                    functional.macrel_peptides_retry,
+                    functional.fargene_amino_retry,
+                    functional.gecco_cds_retry,
+                ),
+                ("macrel_peptides", "fargene_amino", "gecco_cds"),
+            )
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=4) as tools:
+            futures = [
+                tools.submit(ex.map, task, functional_in=functional_ins)
+                for task in (
+                    functional.prodigal,
+                    functional.macrel,
+                    functional.fargene,
+                    functional.gecco,
+                )
+            ]
+        prodigal_results, macrel_results, fargene_results, gecco_results = [
+            with_retry(retry_task, tool, f.result())
+            for retry_task, tool, f in zip(
+                (
+                    functional.prodigal_retry,
+                    functional.macrel_retry,
+                    functional.fargene_retry,
+                    functional.gecco_retry,
+                ),
+                ("prodigal", "macrel", "fargene", "gecco"),
+                futures,
+            )
+        ]
+
+    return ex.call(
+        functional.organize_functional_outputs,
+        inputs=functional_ins,
+        prodigal_results=prodigal_results,
+        macrel_results=macrel_results,
+        fargene_results=fargene_results,
+        gecco_results=gecco_results,
+    )
+
+
+def functional_hits_wf(ex: LocalExecutor, functional_results: List[Any]):
+    from . import functional_hits
+
+    hits = ex.map(
+        functional_hits.index_functional_hits, functional_output=functional_results
+    )
+    return ex.call(functional_hits.organize_functional_hits, results=hits)
+
+
+def metamage_quick(
+    ex: LocalExecutor,
+    samples: List[Sample],
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    taxon_rank: TaxonRank = TaxonRank.species,
+    kaiju_scatter_min_reads: Optional[int] = None,
+    kaiju_chunk_reads: Optional[int] = None,
+    compact_kaiju_output: bool = False,
+    min_count: int = 2,
+    k_min: int = 21,
+    k_max: int = 141,
+    k_step: int = 12,
+    min_contig_len: int = 200,
+    assembly_stats_mode: AssemblyStatsMode = AssemblyStatsMode.fast,
+    contig_length_tiers: Optional[List[int]] = None,
+    read_mapper: ReadMapper = ReadMapper.bowtie2,
+    prodigal_output_format: ProdigalOutput = ProdigalOutput.gbk,
+    fargene_hmm_models: Optional[List[fARGeneModel]] = None,
+    fargene_all_models: bool = False,
+    share_gene_calls: bool = False,
+    colocate_functional_tools: bool = False,
+    preview: bool = False,
+    preview_read_pairs: Optional[int] = None,
+):
+    """Same DAG as ``wf.metamage_quick``, with independent branches in parallel"""
+    from . import organize_final_outputs
+    from .abundance import build_abundance_matrix
+    from .assembly import CONTIG_LENGTH_TIERS
+    from .incremental import cohort_kaiju_tables, select_pending_samples
+    from .preflight import organize_preflight_outputs, preflight_reads
+    from .preview import (
+        PREVIEW_READ_PAIRS,
+        full_samples,
+        organize_preview_inputs,
+        previewed_samples,
+        subsample_reads,
+    )
+
+    fargene_hmm_models = fargene_hmm_models or [fARGeneModel.class_a]
+
+    # Local outputs are never uploaded, so there are no manifests to skip
+    # samples by, but the selection still provides the run's cohort state
+    samples, cohort = ex.call(
+        select_pending_samples,
+        samples=samples,
+        incremental=False,
+        preview=preview,
+        kaiju_ref_db=kaiju_ref_db,
+        taxon_rank=taxon_rank,
+        compact_kaiju_output=compact_kaiju_output,
+        min_count=min_count,
+        k_min=k_min,
+        k_max=k_max,
+        k_step=k_step,
+        min_contig_len=min_contig_len,
+        assembly_stats_mode=assembly_stats_mode,
+        contig_length_tiers=contig_length_tiers or CONTIG_LENGTH_TIERS,
+        read_mapper=read_mapper,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_models=fargene_hmm_models,
+        fargene_all_models=fargene_all_models,
+        share_gene_calls=share_gene_calls,
+    )
+
+    if preview:
+        preview_inputs = ex.call(
+            organize_preview_inputs,
+            samples=samples,
+            read_pairs=preview_read_pairs or PREVIEW_READ_PAIRS,
+        )
+        samples = ex.call(
+            previewed_samples,
+            samples=ex.map(subsample_reads, preview_input=preview_inputs),
+        )
+    else:
+        samples = ex.call(full_samples, samples=samples)
+
+    run_samples = samples
+    samples, read_profiles = ex.call(
+        organize_preflight_outputs,
+        samples=run_samples,
+        profiles=ex.map(preflight_reads, sample=run_samples),
+    )
+
+    with ThreadPoolExecutor(max_workers=3) as branches:
+        kaiju_results = branches.submit(
+            kaiju_wf,
+            ex,
+            samples,
+            kaiju_ref_db,
+            kaiju_ref_nodes,
+            kaiju_ref_names,
+            taxon_rank,
+            kaiju_scatter_min_reads,
+            kaiju_chunk_reads,
+            compact_kaiju_output,
+            read_profiles,
+        )
+        assembly_dirs = assembly_wf(
+            ex,
+            samples,
+            min_count,
+            k_min,
+            k_max,
+            k_step,
+            min_contig_len,
+            assembly_stats_mode,
+            contig_length_tiers,
+        )
+        binning_results = branches.submit(
+            binning_wf, ex, samples, assembly_dirs, read_mapper
+        )
+        functional_results = branches.submit(
+            functional_wf,
+            ex,
+            assembly_dirs,
+            prodigal_output_format,
+            fargene_hmm_models,
+            fargene_all_models,
+            share_gene_calls,
+            colocate_functional_tools,
+        )
+
+        binning_outs = binning_results.result()
+        bin_taxonomy = bin_taxonomy_wf(
+            ex, binning_outs, kaiju_ref_db, kaiju_ref_nodes, kaiju_ref_names
+        )
+
+        kaiju2table_outs = kaiju_results.result()
+        abundance_matrix = ex.run(
+            build_abundance_matrix,
+            kaiju_tables=ex.call(
+                cohort_kaiju_tables, kaiju_tables=kaiju2table_outs, cohort=cohort
+            ),
+            kaiju_ref_nodes=kaiju_ref_nodes,
+            kaiju_ref_names=kaiju_ref_names,
+            preview=preview,
+        )
+
+        functional_outs = functional_results.result()
+        functional_hits = functional_hits_wf(ex, functional_outs)
+
+        os.chdir(ex.workdir)
+        return ex.call(
+            organize_final_outputs,
+            samples=run_samples,
+            read_profiles=read_profiles,
+            assembly_results=assembly_dirs,
+            binning_results=binning_outs,
+            bin_taxonomy=bin_taxonomy,
+            kaiju2table_outs=kaiju2table_outs,
+            abundance_matrix=abundance_matrix,
+            functional_results=functional_outs,
+            functional_hits=functional_hits,
+            cohort=cohort,
+        )
@@ -0,0 +1,183 @@
+"""
+Read mappers for the contig depths that binning needs
+
+Each mapper turns a contig FASTA and a read pair into SAM on stdout,
+optionally after building an index. The runner pipes that SAM straight
+into ``samtools sort``, so every mapper yields the same sorted BAM.
+
+The sort holds as many records in memory as its share of the task's
+memory allows and spills the rest to a local scratch directory, so its
+temporary files do not land on a network volume or in memory-backed tmpfs.
+"""
+
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .runner import Command
+from .types import ReadMapper
+
+
+@dataclass
+class Mapper:
+    # (contigs, index prefix, threads) -> commands that build the index
+    index: Callable[[Path, Path, int], List[Command]]
+    # (contigs, index prefix, read1, read2, threads) -> command writing SAM
+    align: Callable[[Path, Path, str, str, int], Command]
+
+
+def _bowtie2_index(contigs: Path, prefix: Path, threads: int) -> List[Command]:
+    return [
+        [
+            "bowtie2/bowtie2-build",
+            str(contigs),
+            str(prefix),
+            "--threads",
+            str(threads),
+        ]
+    ]
+
+
+def _bowtie2_align(
+    contigs: Path, prefix: Path, read1: str, read2: str, threads: int
+) -> Command:
+    return [
+        "bowtie2/bowtie2",
+        "-x",
+        str(prefix),
+        "-1",
+        read1,
+        "-2",
+        read2,
+        "--threads",
+        str(threads),
+    ]
+
+
+def _minimap2_align(
+    contigs: Path, prefix: Path, read1: str, read2: str, threads: int
+) -> Command:
+    # The short-read preset indexes the contigs on the fly, which takes
+    # seconds, instead of a separate index build
+    return [
+        "minimap2",
+        "-a",
+        "-x",
+        "sr",
+        "-t",
+        str(threads),
+        str(contigs),
+        read1,
+        read2,
+    ]
+
+
+MAPPERS: Dict[ReadMapper, Mapper] = {
+    ReadMapper.bowtie2: Mapper(index=_bowtie2_index, align=_bowtie2_align),
+    ReadMapper.minimap2: Mapper(index=lambda *_: [], align=_minimap2_align),
+}
+
+
+# Share of the task's memory the sort may buffer in, the aligner and its
+# index need the rest
+SORT_MEMORY_SHARE = 0.5
+# Smaller buffers mean hundreds of spill files to merge, larger ones gain
+# little once a sample's records fit
+MIN_SORT_MEMORY_PER_THREAD = 64 * 1024 * 1024
+MAX_SORT_MEMORY_PER_THREAD = 4 * 1024 * 1024 * 1024
+
+SCRATCH_ENV = "METAMAGE_SCRATCH"
+# Local disks in order of preference, the task's working directory is the
+# last resort
+SCRATCH_DIRS = ["/scratch", "/mnt/scratch", "/local", tempfile.gettempdir()]
+# Remote filesystems, and memory-backed ones whose files count against the
+# task's memory limit
+_NOT_SCRATCH = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "lustre",
+    "gpfs",
+    "ceph",
+    "tmpfs",
+    "ramfs",
+}
+
+
+def sort_memory(threads: int, memory_kb: float) -> Tuple[int, int]:
+    """Sort threads and bytes per thread that fit the sort's memory share
+
+    ``samtools sort`` buffers up to ``-m`` bytes per thread before spilling,
+    so threads are dropped rather than buffers shrunk below the minimum.
+    """
+    budget = memory_kb * 1024 * SORT_MEMORY_SHARE
+    if budget == float("inf"):
+        return threads, MAX_SORT_MEMORY_PER_THREAD
+    threads = max(1, min(threads, int(budget // MIN_SORT_MEMORY_PER_THREAD)))
+    per_thread = min(int(budget // threads), MAX_SORT_MEMORY_PER_THREAD)
+    return threads, max(per_thread, MIN_SORT_MEMORY_PER_THREAD)
+
+
+def sort_cmd(
+    output: Path, threads: int, memory_per_thread: int, spill_dir: Path
+) -> Command:
+    """``samtools sort`` of SAM on stdin, spilling to ``spill_dir``"""
+    return [
+        "samtools",
+        "sort",
+        "-@",
+        str(threads),
+        "-m",
+        f"{memory_per_thread // (1024 * 1024)}M",
+        "-T",
+        str(spill_dir.joinpath("sort")),
+        "-o",
+        str(output),
+        "-",
+    ]
+
+
+def _fs_type(path: Path) -> Optional[str]:
+    """Filesystem type of the mount holding ``path``"""
+    path = path.resolve()
+    best, fs_type = None, None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = Path(fields[1].replace("\\040", " "))
+                if (mount == path or mount in path.parents) and (
+                    best is None or len(mount.parts) > len(best.parts)
+                ):
+                    best, fs_type = mount, fields[2]
+    except OSError:
+        pass
+    return fs_type
+
+
+def scratch_dir(min_free_bytes: float) -> Path:
+    """The first local scratch directory with ``min_free_bytes`` free
+
+    ``METAMAGE_SCRATCH`` overrides the search.
+    """
+    override = os.environ.get(SCRATCH_ENV)
+    if override:
+        return Path(override)
+
+    for candidate in SCRATCH_DIRS:
+        path = Path(candidate)
+        if not (path.is_dir() and os.access(path, os.W_OK)):
+            continue
+        fs_type = _fs_type(path) or ""
+        if fs_type in _NOT_SCRATCH or fs_type.startswith("fuse"):
+            continue
+        if shutil.disk_usage(path).free < min_free_bytes:
+            continue
+        return path
+    return Path.cwd()
@@ -0,0 +1,438 @@
+"""
+Runtime and memory estimates for a planned metamage_quick batch
+"""
+
+import csv
+import gzip
+import json
+import math
+import statistics
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from .batch import DEFAULT_CONCURRENCY, MAP_CONCURRENCY
+
+if TYPE_CHECKING:
+    # Tasks import the planner for its estimates, sqlite3 is only needed
+    # when calibrating from a history
+    from .history import PerfHistory
+
+# Number of reads parsed from the head of each file to estimate its size.
+SAMPLED_READS = 20000
+
+# CPUs of the node each task type is scheduled on.
+TASK_CPUS = {"small": 2, "medium": 32, "large": 96}
+
+# Map task running each stage's elements, for its concurrency in
+# batch.MAP_CONCURRENCY.
+STAGE_TASKS = {
+    "assembly_stats": "evaluate_assembly",
+    "read_mapping": "map_reads",
+    "contig_depths": "summarize_contig_depths",
+    "kaiju": "taxonomy_classification_task",
+    "kaiju2table": "kaiju2table_task",
+}
+
+# Samples with more read pairs than this are classified in chunks on
+# several nodes, and chunks hold this many read pairs.
+SCATTER_MIN_READS = 100_000_000
+CHUNK_READS = 25_000_000
+SCATTERED_STAGE = "kaiju"
+
+
+@dataclass
+class PowerLaw:
+    """y = coef * x ** exponent, fitted in log-log space"""
+
+    coef: float
+    exponent: float
+    points: int = 0
+
+    def __call__(self, x: float) -> float:
+        return self.coef * max(x, 1.0) ** self.exponent
+
+    @classmethod
+    def fit(
+        cls, xs: Sequence[float], ys: Sequence[float], prior: "PowerLaw"
+    ) -> "PowerLaw":
+        pairs = [(math.log(x), math.log(y)) for x, y in zip(xs, ys) if x > 0 and y > 0]
+        if not pairs:
+            return prior
+
+        log_x = [p[0] for p in pairs]
+        log_y = [p[1] for p in pairs]
+
+        # With few points or no spread in input sizes the exponent can't be
+        # trusted, so only rescale the prior to the observations.
+        if len(pairs) < 3 or statistics.pstdev(log_x) < 0.1:
+            offsets = [y - prior.exponent * x for x, y in pairs]
+            return cls(
+                math.exp(statistics.median(offsets)), prior.exponent, len(pairs)
+            )
+
+        mean_x, mean_y = statistics.fmean(log_x), statistics.fmean(log_y)
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in pairs) / sum(
+            (x - mean_x) ** 2 for x in log_x
+        )
+        return cls(math.exp(mean_y - slope * mean_x), slope, len(pairs))
+
+
+@dataclass
+class StageModel:
+    """How a stage's runtime, peak memory and output size scale with its inputs"""
+
+    task_type: str
+    depends_on: List[str]
+    # Runtime and memory scale with the product of these features
+    time_features: List[str]
+    rss_features: List[str]
+    time: PowerLaw
+    rss_kb: PowerLaw
+    # Feature name under which the stage's output size is passed downstream,
+    # and the features that size scales with
+    output_feature: Optional[str] = None
+    output_features: List[str] = field(default_factory=list)
+    output: Optional[PowerLaw] = None
+
+
+def _stage(
+    task_type: str,
+    depends_on: List[str],
+    features: List[str],
+    time_coef: float,
+    rss_coef: float,
+    rss_features: Optional[List[str]] = None,
+    output_feature: Optional[str] = None,
+    output_coef: float = 0.0,
+) -> StageModel:
+    return StageModel(
+        task_type=task_type,
+        depends_on=depends_on,
+        time_features=features,
+        rss_features=rss_features or features,
+        time=PowerLaw(time_coef, 1.0),
+        rss_kb=PowerLaw(rss_coef, 1.0),
+        output_feature=output_feature,
+        output_features=["read_bytes"] if output_feature else [],
+        output=PowerLaw(output_coef, 1.0) if output_feature else None,
+    )
+
+
+# Uncalibrated priors (seconds and KiB per input byte), replaced by fits to
+# the performance history wherever it has measurements for a stage.
+DEFAULT_MODELS: Dict[str, StageModel] = {
+    "megahit": _stage(
+        "large", [], ["read_bytes"], 7e-7, 1e-3, None, "assembly_bytes", 0.05
+    ),
+    "assembly_stats": _stage("small", ["megahit"], ["assembly_bytes"], 2e-8, 1e-4),
+    "read_mapping": _stage(
+        "large", ["megahit"], ["read_bytes"], 4e-7, 5e-4, None, "bam_bytes", 0.3
+    ),
+    "contig_depths": _stage("small", ["read_mapping"], ["bam_bytes"], 1.2e-7, 1e-4),
+    "metabat2": _stage("large", ["contig_depths"], ["assembly_bytes"], 6e-6, 4e-3),
+    "kaiju": _stage(
+        "large",
+        [],
+        ["read_bytes", "db_bytes"],
+        7e-18,
+        1.1e-3,
+        ["db_bytes"],
+        "kaiju_out_bytes",
+        0.5,
+    ),
+    "kaiju2table": _stage("small", ["kaiju"], ["kaiju_out_bytes"], 3e-8, 1e-4),
+    "prodigal": _stage("medium", ["megahit"], ["assembly_bytes"], 1.8e-5, 2e-3),
+    "macrel": _stage("small", ["megahit"], ["assembly_bytes"], 1.2e-5, 4e-3),
+    "fargene": _stage("small", ["megahit"], ["assembly_bytes"], 3.6e-5, 2e-3),
+    "gecco": _stage("small", ["megahit"], ["assembly_bytes"], 3.6e-5, 8e-3),
+}
+
+
+@dataclass
+class PlannedSample:
+    sample_name: str
+    read_files: List[Path]
+    read_bytes: int
+    read_pairs: int
+    mean_read_length: float
+    features: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class StageEstimate:
+    sample_name: str
+    stage: str
+    seconds: float
+    rss_kb: float
+    # Set for each chunk of a scattered sample
+    chunk: Optional[int] = None
+
+
+def _local_path(path: str) -> Path:
+    return Path(path[len("file://") :] if path.startswith("file://") else path)
+
+
+def estimate_reads(path: Path, sampled_reads: int = SAMPLED_READS) -> Tuple[int, float]:
+    """Estimate (read count, mean read length) from the head of a FASTQ file
+
+    The on-disk bytes consumed per record in the first ``sampled_reads``
+    records, compressed or not, are extrapolated to the whole file.
+    """
+    size = path.stat().st_size
+    with open(path, "rb") as raw:
+        stream = gzip.GzipFile(fileobj=raw) if path.suffix == ".gz" else raw
+
+        reads = 0
+        bases = 0
+        while reads < sampled_reads:
+            header = stream.readline()
+            if not header:
+                # The whole file was read, the count is exact
+                return reads, bases / reads if reads else 0.0
+            seq = stream.readline()
+            stream.readline()
+            stream.readline()
+            reads += 1
+            bases += len(seq.rstrip())
+
+        consumed = raw.tell()
+
+    return int(size * reads / consumed), bases / reads
+
+
+def read_sample_sheet(path: Path) -> List[Tuple[str, List[Path]]]:
+    """Samples from a JSON list or a CSV/TSV with sample_name, read1 and read2"""
+    path = Path(path)
+    if path.suffix == ".json":
+        rows = json.loads(path.read_text())
+    else:
+        dialect = "excel-tab" if path.suffix in (".tsv", ".txt") else "excel"
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f, dialect=dialect))
+
+    return [
+        (row["sample_name"], [_local_path(row["read1"]), _local_path(row["read2"])])
+        for row in rows
+    ]
+
+
+def plan_sample(sample_name: str, read_files: List[Path]) -> PlannedSample:
+    read_counts = [estimate_reads(f) for f in read_files]
+    read_bytes = sum(f.stat().st_size for f in read_files)
+
+    return PlannedSample(
+        sample_name=sample_name,
+        read_files=read_files,
+        read_bytes=read_bytes,
+        read_pairs=read_counts[0][0],
+        mean_read_length=statistics.fmean(length for _, length in read_counts),
+        features={"read_bytes": float(read_bytes)},
+    )
+
+
+def _feature_product(features: Dict[str, float], names: List[str]) -> Optional[float]:
+    if not all(name in features for name in names):
+        return None
+    return math.prod(features[name] for name in names)
+
+
+def calibrate(history: Optional["PerfHistory"]) -> Dict[str, StageModel]:
+    """Fit each stage's scaling models to its recorded runs"""
+    if history is None:
+        return dict(DEFAULT_MODELS)
+
+    models = {}
+    for stage, prior in DEFAULT_MODELS.items():
+        runs = history.stage_history(stage)
+
+        def fit(names: List[str], ys: List[float], prior_law: PowerLaw):
+            xs = [_feature_product(run.features, names) for run in runs]
+            points = [(x, y) for x, y in zip(xs, ys) if x is not None]
+            return PowerLaw.fit(
+                [p[0] for p in points], [p[1] for p in points], prior_law
+            )
+
+        output = None
+        if prior.output_feature:
+            output = fit(
+                prior.output_features, [r.output_bytes for r in runs], prior.output
+            )
+
+        models[stage] = StageModel(
+            task_type=prior.task_type,
+            depends_on=prior.depends_on,
+            time_features=prior.time_features,
+            rss_features=prior.rss_features,
+            time=fit(prior.time_features, [r.wall_time for r in runs], prior.time),
+            rss_kb=fit(prior.rss_features, [r.max_rss_kb for r in runs], prior.rss_kb),
+            output_feature=prior.output_feature,
+            output_features=prior.output_features,
+            output=output,
+        )
+
+    return models
+
+
+def _stage_order(models: Dict[str, StageModel]) -> List[str]:
+    order: List[str] = []
+
+    def visit(stage: str):
+        if stage in order:
+            return
+        for dep in models[stage].depends_on:
+            visit(dep)
+        order.append(stage)
+
+    for stage in models:
+        visit(stage)
+    return order
+
+
+def kaiju_chunks(
+    read_pairs: int,
+    scatter_min_reads: int = SCATTER_MIN_READS,
+    chunk_reads: int = CHUNK_READS,
+) -> int:
+    """Number of elements Kaiju classifies a sample's reads in"""
+    if read_pairs <= scatter_min_reads:
+        return 1
+    return math.ceil(read_pairs / chunk_reads)
+
+
+def estimate(
+    samples: List[PlannedSample],
+    models: Dict[str, StageModel],
+    db_bytes: float,
+    scatter_min_reads: int = SCATTER_MIN_READS,
+    chunk_reads: int = CHUNK_READS,
+) -> List[StageEstimate]:
+    """Runtime and peak memory of every element of every stage
+
+    A scattered sample's Kaiju chunks are separate elements, each taking its
+    share of the sample's runtime.
+    """
+    estimates = []
+    order = _stage_order(models)
+
+    for sample in samples:
+        features = dict(sample.features, db_bytes=db_bytes)
+        for stage in order:
+            model = models[stage]
+            x = _feature_product(features, model.time_features)
+            if x is None:
+                continue
+            if model.output_feature:
+                features[model.output_feature] = model.output(
+                    _feature_product(features, model.output_features)
+                )
+
+            chunks = 1
+            if stage == SCATTERED_STAGE:
+                chunks = kaiju_chunks(sample.read_pairs, scatter_min_reads, chunk_reads)
+            for chunk in range(chunks):
+                estimates.append(
+                    StageEstimate(
+                        sample_name=sample.sample_name,
+                        stage=stage,
+                        seconds=model.time(x / chunks),
+                        rss_kb=model.rss_kb(
+                            _feature_product(features, model.rss_features) or x
+                        ),
+                        chunk=chunk if chunks > 1 else None,
+                    )
+                )
+
+    return estimates
+
+
+def stage_concurrency(stage: str) -> int:
+    task = STAGE_TASKS.get(stage, stage)
+    return MAP_CONCURRENCY.get(task, DEFAULT_CONCURRENCY)
+
+
+def map_duration(seconds: Sequence[float], concurrency: int) -> float:
+    """Runtime of a map task over elements lasting ``seconds``
+
+    At most ``concurrency`` elements run at once, so the elements are taken
+    in ceil(n / concurrency) waves, longest first, each lasting as long as
+    its slowest element.
+    """
+    ordered = sorted(seconds, reverse=True)
+    return sum(ordered[::concurrency])
+
+
+def critical_path(
+    estimates: List[StageEstimate], models: Dict[str, StageModel]
+) -> Tuple[List[str], float]:
+    """Longest chain of stages, each lasting as long as its map task
+
+    Every stage is a map task over all samples, or all chunks for a
+    scattered stage, so the next stage starts only once the last wave of
+    elements is done.
+    """
+    durations: Dict[str, List[float]] = {}
+    for e in estimates:
+        durations.setdefault(e.stage, []).append(e.seconds)
+    makespan = {
+        stage: map_duration(seconds, stage_concurrency(stage))
+        for stage, seconds in durations.items()
+    }
+
+    finish: Dict[str, float] = {}
+    previous: Dict[str, Optional[str]] = {}
+    for stage in _stage_order(models):
+        if stage not in makespan:
+            continue
+        deps = [d for d in models[stage].depends_on if d in finish]
+        start_after = max(deps, key=lambda d: finish[d]) if deps else None
+        previous[stage] = start_after
+        finish[stage] = (finish[start_after] if start_after else 0.0) + makespan[stage]
+
+    if not finish:
+        return [], 0.0
+
+    last: Optional[str] = max(finish, key=lambda s: finish[s])
+    total = finish[last]
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    return path[::-1], total
+
+
+def format_plan(
+    samples: List[PlannedSample],
+    estimates: List[StageEstimate],
+    models: Dict[str, StageModel],
+) -> str:
+    lines = ["sample\tread_pairs\tmean_length\tread_gib"]
+    for s in samples:
+        lines.append(
+            f"{s.sample_name}\t{s.read_pairs}\t{s.mean_read_length:.0f}"
+            f"\t{s.read_bytes / 2**30:.2f}"
+        )
+
+    lines.append("")
+    lines.append("stage\ttask\tcalibration_runs\tmax_hours\tmax_peak_gib")
+    for stage in _stage_order(models):
+        stage_estimates = [e for e in estimates if e.stage == stage]
+        if not stage_estimates:
+            continue
+        model = models[stage]
+        lines.append(
+            f"{stage}\t{model.task_type}\t{model.time.points}"
+            f"\t{max(e.seconds for e in stage_estimates) / 3600:.2f}"
+            f"\t{max(e.rss_kb for e in stage_estimates) / 2**20:.1f}"
+        )
+
+    path, total = critical_path(estimates, models)
+    node_hours = sum(e.seconds for e in estimates) / 3600
+    cpu_hours = (
+        sum(e.seconds * TASK_CPUS[models[e.stage].task_type] for e in estimates) / 3600
+    )
+
+    lines.append("")
+    lines.append(f"Critical path: {' -> '.join(path)} ({total / 3600:.2f} h)")
+    lines.append(f"Total node-hours: {node_hours:.1f} ({cpu_hours:.0f} CPU-hours)")
+    return "\n".join(lines)
@@ -0,0 +1,298 @@
+"""
+Pre-flight validation and profiling of each sample's read pair
+
+Problems in the reads, like mates that do not pair up, a truncated gzip
+file or an unexpected quality encoding, otherwise only surface hours in
+when an assembler or aligner crashes. Both files are streamed once, in
+large chunks of records that are checked and counted with bytes-level
+operations rather than per-character Python code, and a sample fails at
+the first problem found. The counts are kept as a per-sample profile.
+"""
+
+import json
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from itertools import zip_longest
+from operator import itemgetter
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional
+
+from dataclasses_json import dataclass_json
+from latch import small_task, workflow
+from latch.types import LatchFile
+
+from .batch import batch_map, by_sample
+from .images import GLUE
+from .preview import open_fastq
+from .telemetry import TaskMetrics, collect, file_sizes
+from .types import Sample, output_prefix
+
+# Records checked at a time, per mate
+BATCH_RECORDS = 65_536
+
+# Decompressed bytes read from a file at a time
+READ_CHUNK_BYTES = 8 * 1024 * 1024
+
+# Quality characters below this are Phred+33 only, a file whose lowest
+# character is at or above PHRED64_MIN is most likely Phred+64.
+PHRED33_OFFSET = 33
+PHRED64_MIN = 64
+
+_NUCLEOTIDES = b"ACGTNacgtn"
+_PRINTABLE = bytes(range(PHRED33_OFFSET, ord("~") + 1))
+
+_first_byte = itemgetter(slice(0, 1))
+
+
+class PreflightError(RuntimeError):
+    """A sample's reads are malformed or do not pair up"""
+
+
+@dataclass_json
+@dataclass
+class ReadProfile:
+    sample_name: str
+    read_pairs: int
+    bases: int
+    # JSON with the read length and quality distributions
+    profile: LatchFile
+    metrics: List[TaskMetrics]
+
+
+class PreflightResult(NamedTuple):
+    samples: List[Sample]
+    profiles: List[ReadProfile]
+
+
+class _Batch(NamedTuple):
+    headers: List[bytes]
+    seqs: List[bytes]
+    pluses: List[bytes]
+    quals: List[bytes]
+
+
+def _lines(stream: BinaryIO, path: Path) -> Iterator[List[bytes]]:
+    """Complete lines of the file, a large chunk at a time"""
+    rest = b""
+    while True:
+        try:
+            chunk = stream.read(READ_CHUNK_BYTES)
+        except (EOFError, OSError, zlib.error) as e:
+            raise PreflightError(f"{path} is truncated or corrupt ({e})")
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
+
+
+def _batches(path: Path) -> Iterator[_Batch]:
+    """The file's records, BATCH_RECORDS at a time"""
+    with open_fastq(path) as stream:
+        pending: List[bytes] = []
+        for lines in _lines(stream, path):
+            pending.extend(lines)
+            while len(pending) >= 4 * BATCH_RECORDS:
+                batch = pending[: 4 * BATCH_RECORDS]
+                del pending[: 4 * BATCH_RECORDS]
+                yield _Batch(batch[0::4], batch[1::4], batch[2::4], batch[3::4])
+
+        if pending and not pending[-1]:
+            # A trailing blank line
+            pending.pop()
+        if len(pending) % 4:
+            raise PreflightError(f"{path} ends in an incomplete record")
+        if pending:
+            yield _Batch(pending[0::4], pending[1::4], pending[2::4], pending[3::4])
+
+
+def _read_name(header: bytes) -> bytes:
+    name = (header[1:].split(None, 1) or [b""])[0]
+    if name[-2:] in (b"/1", b"/2"):
+        return name[:-2]
+    return name
+
+
+class _Profiler:
+    def __init__(self):
+        self.read_pairs = 0
+        self.bases = 0
+        self.gc = 0
+        self.n = 0
+        self.lengths: List[Counter] = [Counter(), Counter()]
+        self.qualities: Counter = Counter()
+
+    def check(self, path: Path, batch: _Batch, first_record: int):
+        """Fail on the first malformed record of one mate's batch"""
+        records = len(batch.seqs)
+        well_formed = (
+            b"".join(map(_first_byte, batch.headers)) == b"@" * records
+            and b"".join(map(_first_byte, batch.pluses)) == b"+" * records
+            and list(map(len, batch.seqs)) == list(map(len, batch.quals))
+        )
+        if not well_formed:
+            # Only now look at the records one by one, to name the culprit
+            for i, (header, seq, plus, qual) in enumerate(zip(*batch)):
+                if (
+                    not header.startswith(b"@")
+                    or not plus.startswith(b"+")
+                    or len(seq) != len(qual)
+                ):
+                    raise PreflightError(
+                        f"{path}: record {first_record + i + 1} is malformed "
+                        f"(header {header[:80]!r})"
+                    )
+
+        for lines, allowed, kind in (
+            (batch.seqs, _NUCLEOTIDES, "sequences"),
+            (batch.quals, _PRINTABLE, "qualities"),
+        ):
+            invalid = b"".join(lines).translate(None, allowed)
+            if invalid:
+                characters = "".join(sorted(set(invalid.decode(errors="replace"))))
+                raise PreflightError(
+                    f"{path}: unexpected characters {characters!r} in the {kind} "
+                    f"of records {first_record + 1}-{first_record + records}"
+                )
+
+    def add(self, mate: int, batch: _Batch):
+        seqs = b"".join(batch.seqs)
+        self.bases += len(seqs)
+        self.gc += sum(seqs.count(base) for base in (b"G", b"C", b"g", b"c"))
+        self.n += seqs.count(b"N") + seqs.count(b"n")
+        self.lengths[mate].update(map(len, batch.seqs))
+        # Binned qualities use only a handful of values, counting each
+        # present one over the whole batch beats a per-character count
+        quals = b"".join(batch.quals)
+        for q in _PRINTABLE:
+            if q in quals:
+                self.qualities[q] += quals.count(bytes([q]))
+
+    def profile(self, sample_name: str) -> Dict:
+        if not self.qualities:
+            raise PreflightError(f"{sample_name}: the read files are empty")
+
+        lowest = min(self.qualities)
+        if lowest >= PHRED64_MIN:
+            raise PreflightError(
+                f"{sample_name}: qualities look Phred+64 encoded (lowest "
+                f"{chr(lowest)!r}), convert the reads to Phred+33"
+            )
+
+        def summary(lengths: Counter) -> Dict:
+            reads = sum(lengths.values())
+            return {
+                "reads": reads,
+                "min_length": min(lengths),
+                "max_length": max(lengths),
+                "mean_length": round(
+                    sum(length * n for length, n in lengths.items()) / reads, 2
+                ),
+                "length_histogram": dict(sorted(lengths.items())),
+            }
+
+        return {
+            "sample_name": sample_name,
+            "read_pairs": self.read_pairs,
+            "bases": self.bases,
+            "gc_fraction": round(self.gc / self.bases, 4) if self.bases else 0.0,
+            "n_fraction": round(self.n / self.bases, 6) if self.bases else 0.0,
+            "quality_encoding": "phred33",
+            "quality_histogram": {
+                q - PHRED33_OFFSET: n for q, n in sorted(self.qualities.items())
+            },
+            "mates": [summary(lengths) for lengths in self.lengths],
+        }
+
+
+def profile_pair(sample_name: str, read1: Path, read2: Path) -> Dict:
+    """Validate a read pair in one pass and return its profile
+
+    Raises PreflightError on the first problem found.
+    """
+    profiler = _Profiler()
+    paths = (read1, read2)
+
+    for batch1, batch2 in zip_longest(_batches(read1), _batches(read2)):
+        if batch1 is None or batch2 is None or len(batch1.seqs) != len(batch2.seqs):
+            raise PreflightError(
+                f"{sample_name}: {read1} and {read2} hold different numbers of "
+                f"reads (they differ after {profiler.read_pairs} pairs)"
+            )
+
+        for mate, batch in enumerate((batch1, batch2)):
+            profiler.check(paths[mate], batch, profiler.read_pairs)
+
+        names1 = list(map(_read_name, batch1.headers))
+        names2 = list(map(_read_name, batch2.headers))
+        if names1 != names2:
+            i = next(i for i, (a, b) in enumerate(zip(names1, names2)) if a != b)
+            raise PreflightError(
+                f"{sample_name}: read pair {profiler.read_pairs + i + 1} does not "
+                f"match ({names1[i].decode(errors='replace')} in {read1}, "
+                f"{names2[i].decode(errors='replace')} in {read2})"
+            )
+
+        for mate, batch in enumerate((batch1, batch2)):
+            profiler.add(mate, batch)
+        profiler.read_pairs += len(batch1.seqs)
+
+    return profiler.profile(sample_name)
+
+
+def load_profile(path: Path) -> Dict:
+    return json.loads(Path(path).read_text())
+
+
+@small_task(container_image=GLUE)
+def preflight_reads(sample: Sample) -> ReadProfile:
+    """Fail a sample with malformed or unpaired reads before any tool runs"""
+
+    sample_name = sample.sample_name
+    read1, read2 = Path(sample.read1.local_path), Path(sample.read2.local_path)
+
+    profile = profile_pair(sample_name, read1, read2)
+
+    output_name = f"{sample_name}_read_profile.json"
+    profile_json = Path(output_name).resolve()
+    profile_json.write_text(json.dumps(profile, indent=2))
+
+    return ReadProfile(
+        sample_name=sample_name,
+        read_pairs=profile["read_pairs"],
+        bases=profile["bases"],
+        profile=LatchFile(
+            str(profile_json), f"{output_prefix(sample_name)}/preflight/{output_name}"
+        ),
+        metrics=[
+            collect(sample_name, "preflight", read_bytes=file_sizes(read1, read2))
+        ],
+    )
+
+
+@small_task(container_image=GLUE)
+def organize_preflight_outputs(
+    samples: List[Sample], profiles: List[Optional[ReadProfile]]
+) -> PreflightResult:
+    """The samples that passed, and their profiles"""
+
+    passed = by_sample(profiles)
+    return PreflightResult(
+        samples=[sample for sample in samples if sample.sample_name in passed],
+        profiles=[
+            passed[sample.sample_name]
+            for sample in samples
+            if sample.sample_name in passed
+        ],
+    )
+
+
+@workflow
+def preflight_wf(samples: List[Sample]) -> PreflightResult:
+
+    profiles = batch_map(preflight_reads)(sample=samples)
+
+    return organize_preflight_outputs(samples=samples, profiles=profiles)
@@ -0,0 +1,153 @@
+"""
+Subsampled previews of samples, for a quick check before a full run
+"""
+
+import gzip
+import math
+import random
+import zlib
+from dataclasses import dataclass
+from itertools import islice, zip_longest
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from dataclasses_json import dataclass_json
+from latch import medium_task, small_task, workflow
+from latch.types import LatchFile
+
+from .batch import batch_map, present
+from .images import GLUE
+from .types import PREVIEW_SUFFIX, Sample, output_prefix
+
+# Read pairs kept per sample in a preview
+PREVIEW_READ_PAIRS = 500_000
+
+Pair = Tuple[bytes, bytes]
+
+
+@dataclass_json
+@dataclass
+class PreviewInput:
+    sample: Sample
+    read_pairs: int
+
+
+def open_fastq(path: Path) -> BinaryIO:
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    return gzip.open(path, "rb") if magic == b"\x1f\x8b" else open(path, "rb")
+
+
+def _records(stream: BinaryIO) -> Iterator[bytes]:
+    """Every FASTQ record, as its four raw lines"""
+    while True:
+        record = b"".join(islice(stream, 4))
+        if not record:
+            return
+        yield record
+
+
+def _pairs(read1: Path, read2: Path) -> Iterator[Pair]:
+    with open_fastq(read1) as r1, open_fastq(read2) as r2:
+        for pair in zip_longest(_records(r1), _records(r2)):
+            if None in pair:
+                raise ValueError(
+                    f"{read1} and {read2} hold different numbers of reads"
+                )
+            yield pair
+
+
+def reservoir_sample(pairs: Iterator[Pair], k: int, rng: random.Random) -> List[Pair]:
+    """A uniform sample of ``k`` pairs in one pass (Li's algorithm L)
+
+    Instead of drawing a random number for every pair, the number of pairs
+    to skip before the next replacement is drawn, so the pass costs little
+    more than reading the files.
+    """
+    reservoir = list(islice(pairs, k))
+    if len(reservoir) < k:
+        return reservoir
+
+    w = math.exp(math.log(rng.random()) / k)
+    while True:
+        skip = math.floor(math.log(rng.random()) / math.log(1 - w))
+        pair = next(islice(pairs, skip, None), None)
+        if pair is None:
+            return reservoir
+        reservoir[rng.randrange(k)] = pair
+        w *= math.exp(math.log(rng.random()) / k)
+
+
+def subsample_pairs(
+    read1: Path, read2: Path, read_pairs: int, out1: Path, out2: Path
+) -> int:
+    """Write a random subset of ``read_pairs`` pairs, keeping mates together
+
+    The seed comes from the input names, so a preview is reproducible.
+    """
+    rng = random.Random(zlib.crc32(f"{read1.name}\t{read2.name}".encode()))
+    sampled = reservoir_sample(_pairs(read1, read2), read_pairs, rng)
+
+    with gzip.open(out1, "wb", compresslevel=1) as f1, gzip.open(
+        out2, "wb", compresslevel=1
+    ) as f2:
+        for record1, record2 in sampled:
+            f1.write(record1)
+            f2.write(record2)
+
+    return len(sampled)
+
+
+@small_task(container_image=GLUE)
+def organize_preview_inputs(
+    samples: List[Sample], read_pairs: int
+) -> List[PreviewInput]:
+
+    return [PreviewInput(sample=sample, read_pairs=read_pairs) for sample in samples]
+
+
+@medium_task(container_image=GLUE)
+def subsample_reads(preview_input: PreviewInput) -> Sample:
+
+    sample = preview_input.sample
+    sample_name = f"{sample.sample_name}{PREVIEW_SUFFIX}"
+
+    outputs = []
+    for mate in (1, 2):
+        file_name = f"{sample_name}_{mate}.fastq.gz"
+        outputs.append((Path(file_name).resolve(), file_name))
+
+    subsample_pairs(
+        Path(sample.read1.local_path),
+        Path(sample.read2.local_path),
+        preview_input.read_pairs,
+        outputs[0][0],
+        outputs[1][0],
+    )
+
+    read1, read2 = [
+        LatchFile(str(path), f"{output_prefix(sample_name)}/reads/{file_name}")
+        for path, file_name in outputs
+    ]
+    return Sample(read1=read1, read2=read2, sample_name=sample_name)
+
+
+@small_task(container_image=GLUE)
+def full_samples(samples: List[Sample]) -> List[Sample]:
+    """The samples as they are, when not previewing"""
+    return samples
+
+
+@small_task(container_image=GLUE)
+def previewed_samples(samples: List[Optional[Sample]]) -> List[Sample]:
+    return present(samples)
+
+
+@workflow
+def preview_wf(samples: List[Sample], read_pairs: int) -> List[Sample]:
+
+    preview_inputs = organize_preview_inputs(samples=samples, read_pairs=read_pairs)
+
+    previews = batch_map(subsample_reads)(preview_input=preview_inputs)
+
+    return previewed_samples(samples=previews)
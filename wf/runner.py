@@ -0,0 +1,370 @@
+"""
+Run external tools with fail-fast error handling, timeouts and output checks
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import (
+    IO,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from . import telemetry
+
+StrPath = Union[str, Path]
+Command = Sequence[StrPath]
+
+# Wall-clock limits (in seconds) for each tool, keyed by executable name.
+TOOL_TIMEOUTS: Dict[str, int] = {
+    "megahit": 48 * 3600,
+    "metaquast.py": 12 * 3600,
+    "bowtie2-build": 12 * 3600,
+    "bowtie2": 24 * 3600,
+    "minimap2": 12 * 3600,
+    "samtools": 24 * 3600,
+    "jgi_summarize_bam_contig_depths": 6 * 3600,
+    "metabat2": 12 * 3600,
+    "kaiju": 24 * 3600,
+    "kaiju2table": 2 * 3600,
+    "kaiju2krona": 2 * 3600,
+    "ktImportText": 2 * 3600,
+    "prodigal": 12 * 3600,
+    "macrel": 12 * 3600,
+    "fargene": 12 * 3600,
+    "gecco": 12 * 3600,
+    "gzip": 12 * 3600,
+    "split": 12 * 3600,
+    "cat": 6 * 3600,
+}
+DEFAULT_TIMEOUT = 24 * 3600
+
+# Number of stderr lines kept from each failing stage for the error message.
+STDERR_TAIL_LINES = 50
+
+# Upper bound on the delay between polls for finished stages.
+MAX_POLL_INTERVAL = 1.0
+
+# Files counting the kernel's OOM kills in the task's cgroup, for cgroup v2
+# and v1 respectively.
+OOM_COUNTERS = [
+    Path("/sys/fs/cgroup/memory.events"),
+    Path("/sys/fs/cgroup/memory/memory.oom_control"),
+]
+
+# Path to scripts/standin_tool.py, set to run every tool through the stand-in
+# instead of the real executable (see wf.local).
+STANDIN_ENV = "METAMAGE_STANDIN"
+
+
+class ToolError(RuntimeError):
+    """An external tool failed, timed out or did not produce its outputs"""
+
+    def __init__(self, tool: str, reason: str, stderr_tail: str = ""):
+        self.tool = tool
+        self.reason = reason
+        self.stderr_tail = stderr_tail
+
+        message = f"{tool}: {reason}"
+        if stderr_tail:
+            message = f"{message}\n--- last lines of stderr ---\n{stderr_tail}"
+        super().__init__(message)
+
+    def __reduce__(self):
+        # Rebuilt from the constructor's arguments, so the error survives
+        # pickling across process boundaries, e.g. out of wf/local.py's pool
+        return type(self), (self.tool, self.reason, self.stderr_tail)
+
+
+class OutOfMemoryError(ToolError):
+    """A tool was killed by the kernel for exceeding the task's memory"""
+
+
+def oom_kills() -> Optional[int]:
+    """OOM kills so far in the task's cgroup, None if this is not known"""
+    for counter in OOM_COUNTERS:
+        try:
+            lines = counter.read_text().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            key, _, value = line.partition(" ")
+            if key == "oom_kill":
+                return int(value)
+    return None
+
+
+def tool_name(cmd: Command) -> str:
+    return Path(str(cmd[0])).name
+
+
+def tool_timeout(cmd: Command) -> int:
+    return TOOL_TIMEOUTS.get(tool_name(cmd), DEFAULT_TIMEOUT)
+
+
+def _launch_args(cmd: List[str]) -> List[str]:
+    standin = os.environ.get(STANDIN_ENV)
+    if standin:
+        return [sys.executable, standin, *cmd]
+    return cmd
+
+
+def _drain(stream: IO[bytes], tail: Deque[bytes]):
+    """Forward a child's stderr to ours while keeping its last lines"""
+    for line in iter(stream.readline, b""):
+        sys.stderr.buffer.write(line)
+        sys.stderr.flush()
+        tail.append(line)
+    stream.close()
+
+
+def _exit_status(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _stream_io(pid: int) -> Tuple[int, int]:
+    """Bytes a process passed through read and write calls, pipes included"""
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def _reap(procs: List[subprocess.Popen], deadline: float) -> Tuple[
+    Dict[int, resource.struct_rusage], Dict[int, float], Dict[int, Tuple[int, int]]
+]:
+    """Wait for every process, returning its own resource usage and stream I/O
+
+    Stages are reaped as soon as they exit, in any order, so each one's wall
+    time ends when it actually finished. An exited stage's I/O counters are
+    read before it is reaped, while the kernel still keeps them.
+    """
+    usage: Dict[int, resource.struct_rusage] = {}
+    ended: Dict[int, float] = {}
+    stream_io: Dict[int, Tuple[int, int]] = {}
+    interval = 0.01
+
+    while len(usage) < len(procs):
+        for i, proc in enumerate(procs):
+            if i in usage:
+                continue
+            exited = os.waitid(
+                os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT
+            )
+            if exited is None:
+                continue
+            ended[i] = time.monotonic()
+            stream_io[i] = _stream_io(proc.pid)
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = _exit_status(status)
+            usage[i] = rusage
+
+        if len(usage) < len(procs):
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(procs[0].args, 0)
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    return usage, ended, stream_io
+
+
+def _format_tail(tail: Deque[bytes]) -> str:
+    return b"".join(tail).decode(errors="replace").rstrip()
+
+
+def check_outputs(tool: str, outputs: Iterable[StrPath]):
+    """Fail if any expected file or directory is missing or empty"""
+    for output in outputs:
+        path = Path(output)
+        if not path.exists():
+            raise ToolError(tool, f"expected output {path} was not created")
+        if path.is_dir():
+            if not any(path.iterdir()):
+                raise ToolError(tool, f"expected output directory {path} is empty")
+        elif path.stat().st_size == 0:
+            raise ToolError(tool, f"expected output {path} is empty")
+
+
+def run_pipeline(
+    cmds: Sequence[Command],
+    *,
+    outputs: Iterable[StrPath] = (),
+    stdin: Optional[StrPath] = None,
+    stdout: Optional[StrPath] = None,
+    timeout: Optional[float] = None,
+    cwd: Optional[StrPath] = None,
+    on_start: Optional[Callable[[List[int]], None]] = None,
+) -> List[telemetry.ToolMetrics]:
+    """Run commands connected stdout-to-stdin, failing if any stage fails
+
+    Every stage's exit status is checked, so a crash half-way through a
+    pipeline is reported instead of silently truncating its output. The
+    whole pipeline is killed once ``timeout`` seconds (by default the largest
+    limit in ``TOOL_TIMEOUTS`` among its tools) have elapsed. The resource
+    usage of each stage is recorded in ``telemetry`` and returned.
+    ``on_start`` is called with the stages' process ids once they have all
+    been started.
+    """
+    if timeout is None:
+        timeout = max(tool_timeout(cmd) for cmd in cmds)
+
+    cmds = [[str(arg) for arg in cmd] for cmd in cmds]
+    input_bytes = [telemetry.input_size(cmd) for cmd in cmds]
+    if stdin is not None:
+        input_bytes[0] += telemetry.path_size(Path(stdin))
+
+    kills_before = oom_kills()
+
+    stdin_file = open(stdin, "rb") if stdin is not None else None
+    stdout_file = open(stdout, "wb") if stdout is not None else None
+
+    procs: List[subprocess.Popen] = []
+    readers: List[threading.Thread] = []
+    tails: List[Deque[bytes]] = []
+    started: List[float] = []
+    start_times: List[float] = []
+
+    try:
+        upstream = stdin_file
+        for i, cmd in enumerate(cmds):
+            is_last = i == len(cmds) - 1
+            try:
+                started.append(time.monotonic())
+                start_times.append(time.time())
+                proc = subprocess.Popen(
+                    _launch_args(cmd),
+                    stdin=upstream,
+                    stdout=stdout_file if is_last else subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    cwd=cwd,
+                )
+            except OSError as e:
+                raise ToolError(tool_name(cmd), f"could not be started ({e})")
+
+            # Only the child keeps the pipe open, so an early exit downstream
+            # reaches the upstream stage as SIGPIPE instead of a hang.
+            if i > 0:
+                upstream.close()
+            upstream = proc.stdout
+
+            tail: Deque[bytes] = deque(maxlen=STDERR_TAIL_LINES)
+            reader = threading.Thread(target=_drain, args=(proc.stderr, tail))
+            reader.daemon = True
+            reader.start()
+
+            procs.append(proc)
+            readers.append(reader)
+            tails.append(tail)
+
+        if on_start is not None:
+            on_start([proc.pid for proc in procs])
+
+        try:
+            usage, ended, stream_io = _reap(procs, time.monotonic() + timeout)
+        except subprocess.TimeoutExpired:
+            running = [cmd for cmd, proc in zip(cmds, procs) if proc.returncode is None]
+            raise ToolError(
+                tool_name(running[0]), f"timed out after {int(timeout)} seconds"
+            )
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        for reader in readers:
+            reader.join()
+        for f in (stdin_file, stdout_file):
+            if f is not None:
+                f.close()
+
+    output_bytes = sum(telemetry.path_size(Path(output)) for output in outputs)
+    if stdout is not None:
+        output_bytes += telemetry.path_size(Path(stdout))
+
+    recorded = [
+        telemetry.record(
+            command=cmd,
+            exit_status=proc.returncode,
+            start_time=start_times[i],
+            wall_time=ended[i] - started[i],
+            rusage=usage[i],
+            input_bytes=input_bytes[i],
+            output_bytes=output_bytes if i == len(cmds) - 1 else 0,
+            stream_io=stream_io[i],
+        )
+        for i, (cmd, proc) in enumerate(zip(cmds, procs))
+    ]
+
+    # Report the stage that actually failed rather than the upstream stages
+    # it took down with a broken pipe.
+    failed = [
+        (cmd, proc, tail)
+        for cmd, proc, tail in zip(cmds, procs, tails)
+        if proc.returncode != 0
+    ]
+    failed.sort(key=lambda f: f[1].returncode == -13)
+    if failed:
+        cmd, proc, tail = failed[0]
+        kills_after = oom_kills()
+        if (
+            proc.returncode == -9
+            and kills_before is not None
+            and kills_after is not None
+            and kills_after > kills_before
+        ):
+            raise OutOfMemoryError(
+                tool_name(cmd),
+                "was killed for running out of memory",
+                _format_tail(tail),
+            )
+        raise ToolError(
+            tool_name(cmd),
+            f"exited with status {proc.returncode}",
+            _format_tail(tail),
+        )
+
+    check_outputs(tool_name(cmds[-1]), outputs)
+    return recorded
+
+
+def run(
+    cmd: Command,
+    *,
+    outputs: Iterable[StrPath] = (),
+    stdin: Optional[StrPath] = None,
+    stdout: Optional[StrPath] = None,
+    timeout: Optional[float] = None,
+    cwd: Optional[StrPath] = None,
+    on_start: Optional[Callable[[List[int]], None]] = None,
+) -> telemetry.ToolMetrics:
+    """Run a single tool, failing on errors, timeouts or missing outputs"""
+    (recorded,) = run_pipeline(
+        [cmd],
+        outputs=outputs,
+        stdin=stdin,
+        stdout=stdout,
+        timeout=timeout,
+        cwd=cwd,
+        on_start=on_start,
+    )
+    return recorded
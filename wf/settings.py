@@ -0,0 +1,32 @@
+"""
+Run-wide inputs shared by every element of a map task
+
+Map tasks take a single record per element, so reference files and
+settings that are the same for every sample would be copied into each
+record, and serialized again at every task boundary. A stage writes them
+once to a settings file instead, which its per-sample records refer to.
+"""
+
+import tempfile
+from pathlib import Path
+from typing import Type, TypeVar
+
+from latch.types import LatchFile
+
+T = TypeVar("T")
+
+
+def file_uri(f: LatchFile) -> str:
+    """Where a file is, for a settings record to name it by"""
+    return f.remote_path or str(f.path)
+
+
+def write_settings(settings) -> LatchFile:
+    """A ``dataclass_json`` settings record as a file of its own"""
+    path = Path(tempfile.mkdtemp()).joinpath(f"{type(settings).__name__}.json")
+    path.write_text(settings.to_json())
+    return LatchFile(str(path))
+
+
+def read_settings(cls: Type[T], settings: LatchFile) -> T:
+    return cls.from_json(Path(settings.local_path).read_text())
@@ -0,0 +1,185 @@
+"""
+Compact NCBI taxonomy index and length-weighted taxonomy of contig sets
+
+The index holds the parent, rank and scientific name of every taxon of
+Kaiju's ``nodes.dmp`` and ``names.dmp`` in flat arrays, so it loads in a
+few reads instead of re-parsing the dump files for every sample.
+"""
+
+import struct
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b"MGTAX001"
+_HEADER = struct.Struct("<8sI")
+
+RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+_OTHER_RANK = 254
+_NO_TAXON = 255
+
+ROOT = 1
+
+# A bin is assigned the deepest taxon that more than this share of its
+# classified contig length supports
+MIN_SUPPORT = 0.5
+
+
+def _dmp_rows(path: Path) -> Iterable[List[str]]:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = [field.strip() for field in line.rstrip("\t|\n").split("\t|\t")]
+            if len(fields) >= 3 and fields[0].isdigit():
+                yield fields
+
+
+def build_index(nodes_dmp: Path, names_dmp: Path, out_path: Path) -> Path:
+    """Write the index for a ``nodes.dmp`` and ``names.dmp`` pair"""
+    parents = array("I")
+    ranks = array("B")
+    rank_codes = {rank: code for code, rank in enumerate(RANKS)}
+
+    for taxid, parent, rank, *_ in _dmp_rows(nodes_dmp):
+        taxid = int(taxid)
+        if taxid >= len(parents):
+            grow = taxid + 1 - len(parents)
+            parents.extend([0] * grow)
+            ranks.extend([_NO_TAXON] * grow)
+        parents[taxid] = int(parent)
+        ranks[taxid] = rank_codes.get(rank, _OTHER_RANK)
+
+    names: Dict[int, bytes] = {}
+    for taxid, name, _, name_class, *_ in _dmp_rows(names_dmp):
+        if name_class == "scientific name":
+            names[int(taxid)] = name.encode()
+
+    offsets = array("Q", [0])
+    blob = bytearray()
+    for taxid in range(len(parents)):
+        blob += names.get(taxid, b"")
+        offsets.append(len(blob))
+
+    with open(out_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(parents)))
+        parents.tofile(f)
+        ranks.tofile(f)
+        offsets.tofile(f)
+        f.write(blob)
+
+    return out_path
+
+
+class TaxonomyIndex:
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            magic, size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a taxonomy index")
+            self.parents = array("I")
+            self.parents.fromfile(f, size)
+            self.ranks = array("B")
+            self.ranks.fromfile(f, size)
+            self.offsets = array("Q")
+            self.offsets.fromfile(f, size + 1)
+            self.names = f.read()
+        self._lineages: Dict[int, Tuple[int, ...]] = {}
+
+    def __contains__(self, taxid: int) -> bool:
+        return 0 < taxid < len(self.ranks) and self.ranks[taxid] != _NO_TAXON
+
+    def name(self, taxid: int) -> str:
+        return self.names[self.offsets[taxid] : self.offsets[taxid + 1]].decode()
+
+    def rank(self, taxid: int) -> str:
+        code = self.ranks[taxid]
+        return RANKS[code] if code < len(RANKS) else "no rank"
+
+    def lineage(self, taxid: int) -> Tuple[int, ...]:
+        """The taxon and its ancestors, from the root down"""
+        if taxid not in self._lineages:
+            path = []
+            node = taxid
+            # The root is its own parent, a broken dump could loop elsewhere
+            while node in self and node not in path:
+                path.append(node)
+                if node == ROOT:
+                    break
+                node = self.parents[node]
+            self._lineages[taxid] = tuple(reversed(path))
+        return self._lineages[taxid]
+
+    def ranked_lineage(self, taxid: int) -> str:
+        """Names of the taxon's ancestors at the main ranks, ';'-separated"""
+        return ";".join(
+            self.name(node)
+            for node in self.lineage(taxid)
+            if self.ranks[node] < len(RANKS)
+        )
+
+
+@dataclass
+class SetTaxonomy:
+    taxon_id: int
+    # Share of the classified length supporting the taxon
+    confidence: float
+    # Share of the classified length assigned to taxa off the taxon's lineage
+    contamination: float
+    # Share of the total length with a classification
+    classified_fraction: float
+
+
+def weighted_lca(
+    contigs: Iterable[Tuple[int, int]],
+    index: TaxonomyIndex,
+    min_support: float = MIN_SUPPORT,
+) -> SetTaxonomy:
+    """Taxonomy of a set of (length, taxon id) contigs, such as a bin
+
+    Every contig's length counts for its taxon and each of its ancestors.
+    The set gets the deepest taxon supported by more than ``min_support``
+    of the classified length, a length-weighted majority vote that falls
+    back towards the root where the contigs disagree.
+    """
+    total = 0
+    classified: List[Tuple[int, Tuple[int, ...]]] = []
+    support: Dict[int, int] = {}
+    for length, taxid in contigs:
+        total += length
+        lineage = index.lineage(taxid) if taxid in index else ()
+        if not lineage:
+            continue
+        classified.append((length, lineage))
+        for node in lineage:
+            support[node] = support.get(node, 0) + length
+
+    classified_length = sum(length for length, _ in classified)
+    if not classified_length:
+        return SetTaxonomy(0, 0.0, 0.0, 0.0)
+
+    assigned: Optional[Tuple[int, ...]] = None
+    for length, lineage in classified:
+        for depth in range(len(lineage), 0, -1):
+            if support[lineage[depth - 1]] > min_support * classified_length:
+                if assigned is None or depth > len(assigned):
+                    assigned = lineage[:depth]
+                break
+
+    if assigned is None:
+        return SetTaxonomy(
+            0, 0.0, 0.0, round(classified_length / total, 4) if total else 0.0
+        )
+
+    taxon = assigned[-1]
+    # Contigs on the taxon's lineage, above or below it, agree with it
+    conflicting = sum(
+        length
+        for length, lineage in classified
+        if taxon not in lineage and lineage != assigned[: len(lineage)]
+    )
+    return SetTaxonomy(
+        taxon_id=taxon,
+        confidence=round(support[taxon] / classified_length, 4),
+        contamination=round(conflicting / classified_length, 4),
+        classified_fraction=round(classified_length / total, 4),
+    )
@@ -0,0 +1,311 @@
+"""
+Resource usage of tool invocations and the per-run performance report
+"""
+
+import html
+import json
+import os
+import re
+import resource
+import subprocess
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from dataclasses_json import dataclass_json
+
+
+@dataclass_json
+@dataclass
+class ToolMetrics:
+    tool: str
+    tool_version: str
+    command: List[str]
+    exit_status: int
+    # Seconds since the epoch at which the tool was started
+    start_time: float
+    wall_time: float
+    cpu_time: float
+    # Average number of busy cores and the share of the task's cores it used
+    avg_cpu_cores: float
+    cpu_utilization: float
+    # Peak resident set size of the tool and its children
+    max_rss_kb: int
+    # Block I/O that actually hit storage, as counted by the kernel
+    bytes_read: int
+    bytes_written: int
+    input_bytes: int
+    output_bytes: int
+    # Bytes passed through read and write calls, pipes included, and the
+    # rate the tool read at
+    stream_bytes_in: int = 0
+    stream_bytes_out: int = 0
+    throughput_mb_s: float = 0.0
+
+
+@dataclass_json
+@dataclass
+class TaskMetrics:
+    sample_name: str
+    stage: str
+    tools: List[ToolMetrics] = field(default_factory=list)
+    # Sizes of the task's inputs that its runtime scales with, e.g. read_bytes
+    features: Dict[str, float] = field(default_factory=dict)
+
+
+# Invocations recorded by the runner since the last call to collect(). A
+# process can run several tasks, as wf/local.py's pool workers do, so
+# start_task() drops what an earlier task left behind, e.g. by failing
+# before its collect().
+_pending: List[ToolMetrics] = []
+
+# Arguments that make each tool print its version, when it isn't --version.
+VERSION_ARGS: Dict[str, List[str]] = {
+    "kaiju": ["-h"],
+    "kaiju2table": ["-h"],
+    "kaiju2krona": ["-h"],
+    "metabat2": ["-h"],
+    "jgi_summarize_bam_contig_depths": ["-h"],
+    "prodigal": ["-v"],
+}
+
+_VERSION_RE = re.compile(r"\d+\.\d+(?:\.\d+)*")
+_versions: Dict[str, str] = {}
+
+
+def tool_version(executable: str) -> str:
+    """Version reported by a tool, looked up once per executable"""
+    if executable in _versions:
+        return _versions[executable]
+
+    args = VERSION_ARGS.get(Path(executable).name, ["--version"])
+    version: Optional[str] = None
+    try:
+        proc = subprocess.run(
+            [executable, *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=30,
+        )
+        match = _VERSION_RE.search(proc.stdout.decode(errors="replace"))
+        version = match.group(0) if match else None
+    except (OSError, subprocess.SubprocessError):
+        pass
+
+    _versions[executable] = version or "unknown"
+    return _versions[executable]
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def path_size(path: Path) -> int:
+    """Size of a file, or of all files below a directory"""
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    if path.is_file():
+        return path.stat().st_size
+    return 0
+
+
+def input_size(args: Iterable[str]) -> int:
+    """Total size of the arguments of a command that name existing files"""
+    total = 0
+    for arg in args:
+        try:
+            if os.path.isfile(arg):
+                total += os.path.getsize(arg)
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def record(
+    command: List[str],
+    exit_status: int,
+    start_time: float,
+    wall_time: float,
+    rusage: resource.struct_rusage,
+    input_bytes: int,
+    output_bytes: int,
+    stream_io: Tuple[int, int] = (0, 0),
+) -> ToolMetrics:
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    avg_cores = cpu_time / wall_time if wall_time > 0 else 0.0
+    stream_in, stream_out = stream_io
+
+    metrics = ToolMetrics(
+        tool=Path(command[0]).name,
+        tool_version=tool_version(command[0]),
+        command=command,
+        exit_status=exit_status,
+        start_time=round(start_time, 3),
+        wall_time=round(wall_time, 3),
+        cpu_time=round(cpu_time, 3),
+        avg_cpu_cores=round(avg_cores, 2),
+        cpu_utilization=round(avg_cores / available_cpus(), 3),
+        max_rss_kb=rusage.ru_maxrss,
+        bytes_read=rusage.ru_inblock * 512,
+        bytes_written=rusage.ru_oublock * 512,
+        input_bytes=input_bytes,
+        output_bytes=output_bytes,
+        stream_bytes_in=stream_in,
+        stream_bytes_out=stream_out,
+        throughput_mb_s=round(stream_in / wall_time / 1e6, 2) if wall_time else 0.0,
+    )
+    _pending.append(metrics)
+    return metrics
+
+
+def file_sizes(*paths: Union[str, Path]) -> float:
+    return float(sum(path_size(Path(path)) for path in paths))
+
+
+def start_task():
+    """Forget invocations recorded before the current task started"""
+    _pending.clear()
+
+
+def collect(sample_name: str, stage: str, **features: float) -> TaskMetrics:
+    """Hand over the invocations recorded so far in this task"""
+    tools = list(_pending)
+    _pending.clear()
+
+    return TaskMetrics(
+        sample_name=sample_name, stage=stage, tools=tools, features=features
+    )
+
+
+def _stage_summary(task: TaskMetrics) -> Dict:
+    tools = task.tools
+    # Pipeline stages overlap, so the stage lasts from the first start to the
+    # last finish rather than the sum of its tools' wall times.
+    wall_time = max((t.start_time + t.wall_time for t in tools), default=0) - min(
+        (t.start_time for t in tools), default=0
+    )
+    cpu_time = sum(t.cpu_time for t in tools)
+
+    return {
+        "stage": task.stage,
+        "wall_time": round(wall_time, 3),
+        "cpu_time": round(cpu_time, 3),
+        "avg_cpu_cores": round(cpu_time / wall_time, 2) if wall_time else 0.0,
+        "max_rss_kb": max((t.max_rss_kb for t in tools), default=0),
+        "bytes_read": sum(t.bytes_read for t in tools),
+        "bytes_written": sum(t.bytes_written for t in tools),
+        "input_bytes": max((t.input_bytes for t in tools), default=0),
+        "output_bytes": sum(t.output_bytes for t in tools),
+        "features": task.features,
+        "tools": [t.to_dict() for t in tools],
+    }
+
+
+def build_report(tasks: Iterable[TaskMetrics]) -> Dict:
+    """Group task metrics by sample and stage and find each sample's bottleneck"""
+    samples: Dict[str, List[Dict]] = {}
+    for task in tasks:
+        samples.setdefault(task.sample_name, []).append(_stage_summary(task))
+
+    stages: Dict[str, Dict] = {}
+    for summaries in samples.values():
+        for summary in summaries:
+            totals = stages.setdefault(
+                summary["stage"],
+                {"samples": 0, "wall_time": 0.0, "cpu_time": 0.0, "max_rss_kb": 0},
+            )
+            totals["samples"] += 1
+            totals["wall_time"] = round(totals["wall_time"] + summary["wall_time"], 3)
+            totals["cpu_time"] = round(totals["cpu_time"] + summary["cpu_time"], 3)
+            totals["max_rss_kb"] = max(totals["max_rss_kb"], summary["max_rss_kb"])
+
+    bottlenecks = {
+        sample_name: max(summaries, key=lambda s: s["wall_time"])["stage"]
+        for sample_name, summaries in samples.items()
+        if summaries
+    }
+
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "samples": samples,
+        "stages": stages,
+        "bottlenecks": bottlenecks,
+    }
+
+
+def _fmt_bytes(n: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TiB"
+
+
+def render_html(report: Dict) -> str:
+    """A small self-contained HTML summary of a run report"""
+    rows = []
+    for sample_name, summaries in sorted(report["samples"].items()):
+        longest = max((s["wall_time"] for s in summaries), default=0) or 1
+        for s in sorted(summaries, key=lambda s: -s["wall_time"]):
+            width = int(200 * s["wall_time"] / longest)
+            rows.append(
+                "<tr>"
+                f"<td>{html.escape(sample_name)}</td>"
+                f"<td>{html.escape(s['stage'])}</td>"
+                f"<td>{s['wall_time']:.1f}"
+                f"<div class='bar' style='width:{width}px'></div></td>"
+                f"<td>{s['cpu_time']:.1f}</td>"
+                f"<td>{s['avg_cpu_cores']:.2f}</td>"
+                f"<td>{_fmt_bytes(s['max_rss_kb'] * 1024)}</td>"
+                f"<td>{_fmt_bytes(s['bytes_read'])} / {_fmt_bytes(s['bytes_written'])}</td>"
+                f"<td>{_fmt_bytes(s['input_bytes'])} / {_fmt_bytes(s['output_bytes'])}</td>"
+                "</tr>"
+            )
+
+    bottlenecks = "".join(
+        f"<li>{html.escape(sample)}: {html.escape(stage)}</li>"
+        for sample, stage in sorted(report["bottlenecks"].items())
+    )
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>metamage-quick run report</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; }}
+td, th {{ border: 1px solid #ccc; padding: 2px 6px; text-align: right; }}
+td:first-child, td:nth-child(2) {{ text-align: left; }}
+.bar {{ background: #4a90d9; height: 4px; }}
+</style>
+</head>
+<body>
+<h1>metamage-quick run report</h1>
+<p>Generated {html.escape(report["generated_at"])}</p>
+<h2>Slowest stage per sample</h2>
+<ul>{bottlenecks}</ul>
+<h2>Stages</h2>
+<table>
+<tr><th>Sample</th><th>Stage</th><th>Wall time (s)</th><th>CPU time (s)</th>
+<th>Avg. cores</th><th>Peak RSS</th><th>Disk read / written</th>
+<th>Input / output size</th></tr>
+{"".join(rows)}
+</table>
+</body>
+</html>
+"""
+
+
+def write_report(tasks: Iterable[TaskMetrics], output_dir: Path) -> Path:
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    report = build_report(tasks)
+    output_dir.joinpath("run_report.json").write_text(json.dumps(report, indent=2))
+    output_dir.joinpath("run_report.html").write_text(render_html(report))
+
+    return output_dir
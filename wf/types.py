@@ -5,6 +5,10 @@ from dataclasses_json import dataclass_json
 from latch.types import LatchFile
 
 
+# Appended to the name of a sample's subsampled preview (see wf.preview)
+PREVIEW_SUFFIX = ".preview"
+
+
 @dataclass_json
 @dataclass
 class Sample:
@@ -13,6 +17,13 @@ class Sample:
     sample_name: str
 
 
+def output_prefix(sample_name: str) -> str:
+    """Remote directory for a sample's outputs, previews go below the full run's"""
+    if sample_name.endswith(PREVIEW_SUFFIX):
+        return f"latch:///metamage/{sample_name[: -len(PREVIEW_SUFFIX)]}/preview"
+    return f"latch:///metamage/{sample_name}"
+
+
 class TaxonRank(Enum):
     superkingdom = "superkingdom"
     phylum = "phylum"
@@ -23,6 +34,16 @@ class TaxonRank(Enum):
     species = "species"
 
 
+class AssemblyStatsMode(Enum):
+    fast = "fast"
+    metaquast = "metaquast"
+
+
+class ReadMapper(Enum):
+    bowtie2 = "bowtie2"
+    minimap2 = "minimap2"
+
+
 class ProdigalOutput(Enum):
     gbk = "gbk"
     gff = "gff"